@@ -6,15 +6,34 @@ ngrok / cloudflared で HTTPS 公開する手順は README.md の「他端末か
 """
 from werkzeug.middleware.proxy_fix import ProxyFix
 import os
+import re
+import json
 import time
+import random
 import secrets
+import signal
+import atexit
+import hashlib
+from collections import OrderedDict
+from datetime import timedelta, timezone
 import eventlet
-from flask import Flask, render_template, request, redirect, url_for, session
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, abort
+from flask.sessions import SecureCookieSessionInterface
+from flask_socketio import SocketIO, emit, join_room, leave_room, ConnectionRefusedError
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
-from authlib.integrations.flask_client import OAuth
 from dotenv import load_dotenv
+from state_store import create_state_store
+from tracing import Tracer
+from metrics import Metrics
+from db_executor import DBExecutor
+from ratelimit import RateLimiter, OutboundMonitor, parse_rules
+from room_model import ChatHistory, Participant, Room, PrivateSession
+from itsdangerous import URLSafeTimedSerializer
+from snapshot import write_snapshot, read_snapshot
+from assets import AssetPipeline
+from media_quality import MediaReport, summarize as summarize_media_reports
+from study_stats import Leaderboard, split_by_day, period_starts, advance_streak, current_streak, local_day
 
 # ローカル .env を読む（Render 等で設定した環境変数は上書きしない＝Render の値を優先）
 load_dotenv()
@@ -35,12 +54,102 @@ if db_url.startswith('postgres://'):
     db_url = db_url.replace('postgres://', 'postgresql://', 1)
 app.config['SQLALCHEMY_DATABASE_URI'] = db_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# コネクションプール: Render の Postgres はアイドル接続を切るので、使う前に確認（pre_ping）し定期的に張り直す
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))           # 秒。空き接続を待つ上限
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))           # 秒
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))  # Postgres のみ。0 で無制限
+engine_options = {'pool_pre_ping': True, 'pool_recycle': DB_POOL_RECYCLE}
+if not db_url.startswith('sqlite'):
+    engine_options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+if db_url.startswith('postgresql') and DB_STATEMENT_TIMEOUT_MS > 0:
+    engine_options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'index'
-oauth = OAuth(app)
+# ルーム状態の保存先: STATE_STORE_URL（redis://...）があれば共有ストア、なければプロセス内 dict
+STATE_STORE_URL = os.environ.get('STATE_STORE_URL', '')
+state_store = create_state_store(STATE_STORE_URL)
+# 複数ワーカー時は emit をメッセージキュー経由で全ワーカーに配送する（既定は STATE_STORE_URL と同じ Redis）
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', STATE_STORE_URL) or None
+# 1メッセージの上限バイト数。これを超えるフレームは engine.io が受け取らない（旧クライアントの data_url 画像の上限もここから決める）
+SOCKET_MAX_MESSAGE_BYTES = int(os.environ.get('SOCKET_MAX_MESSAGE_BYTES', 1000000))
+# Socket.IO のパケット形式。'msgpack' にするとバイナリ（MessagePack）で送る（JSON よりシグナリングのバイト数が少ない）。
+# クライアントも合わせる必要があるので、テンプレートは socketio_client_js の msgpack 版 socket.io を読み込む
+SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'json')
 # Render では gunicorn + eventlet で起動するため、async_mode を eventlet に統一
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', message_queue=SOCKETIO_MESSAGE_QUEUE,
+                    max_http_buffer_size=SOCKET_MAX_MESSAGE_BYTES,
+                    serializer='msgpack' if SOCKETIO_SERIALIZER == 'msgpack' else 'default')
+SOCKETIO_CLIENT_JS = 'https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.7.4/socket.io{}.min.js'.format(
+    '.msgpack' if SOCKETIO_SERIALIZER == 'msgpack' else '')
+
+
+@app.context_processor
+def _socketio_client_js():
+    return {'socketio_client_js': SOCKETIO_CLIENT_JS}
+# イベントトレース（TRACE_ENABLED=1 のときだけ記録。無効時はほぼノーコスト）
+tracer = Tracer(
+    os.environ.get('TRACE_LOG_PATH') or os.path.join(app.instance_path, 'trace.log'),
+    enabled=os.environ.get('TRACE_ENABLED', '0') == '1',
+    sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', 1.0)),
+    max_bytes=int(os.environ.get('TRACE_MAX_BYTES', 5 * 1024 * 1024)),
+)
+tracer.start(socketio.start_background_task, socketio.sleep)
+atexit.register(tracer.flush)
+# Prometheus 形式のメトリクス（/metrics）。ルーム・接続の数が見えるので、METRICS_TOKEN（Bearer トークン）を
+# 設定したときだけ有効にし、トークンなしでは配信しない
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1' if METRICS_TOKEN else '0') == '1'
+metrics = Metrics()
+if METRICS_ENABLED:
+    metrics.instrument_flask(app)
+    metrics.describe('db_call_seconds', 'call', 'Database calls run through the DB executor, in seconds (including thread wait).')
+# DB 呼び出しは tpool のスレッドで実行し、遅いクエリでハブ（全ソケット）を止めない。DB_OFFLOAD=0 で従来どおり直接実行
+DB_OFFLOAD = os.environ.get('DB_OFFLOAD', '1') == '1'
+DB_THREADS = int(os.environ.get('DB_THREADS', DB_POOL_SIZE + DB_MAX_OVERFLOW))
+db_executor = DBExecutor(
+    app, threads=DB_THREADS, enabled=DB_OFFLOAD,
+    observe=(lambda name, seconds, error: metrics.observe('db_call_seconds', name, seconds, error)) if METRICS_ENABLED else None,
+)
+# Socket.IO イベントの流量制限: イベント -> (毎秒の補充数, バケットの容量)。sid ごとに別のバケットを持つ。
+# SOCKET_RATE_LIMITS="offer=5/30,ice_candidate=50/300" のように指定したイベントだけ上書きできる
+SOCKET_RATE_LIMITS = {
+    'join_room': (1, 10),
+    'request_room_state': (2, 10),
+    'hand_raise': (2, 10),
+    'offer': (5, 30),
+    'answer': (5, 30),
+    'ice_candidate': (50, 300),
+    'ice_candidates': (10, 60),
+    'start_private_session': (1, 5),
+    'join_private_room': (1, 10),
+    'private_media_ready': (2, 10),
+    'end_private_session': (1, 5),
+    'private_chat': (5, 20),
+    'private_chat_image': (1, 10),
+    'private_chat_history': (1, 10),
+    'watch_room_overview': (1, 5),
+    'media_stats': (1, 5),
+}
+SOCKET_RATE_LIMITS.update(parse_rules(os.environ.get('SOCKET_RATE_LIMITS', '')))
+SOCKET_MAX_EVENT_BYTES = int(os.environ.get('SOCKET_MAX_EVENT_BYTES', 64 * 1024))  # 画像以外のイベント1件の上限
+# 旧クライアントの data_url 画像の上限。イベント名・パケットの枠の分を残し、engine.io が接続ごと切る前に too_large を返す
+SOCKET_MAX_IMAGE_BYTES = SOCKET_MAX_MESSAGE_BYTES - 1024
+rate_limiter = RateLimiter(
+    SOCKET_RATE_LIMITS,
+    default=(10, 50),
+    max_bytes={'*': SOCKET_MAX_EVENT_BYTES, 'private_chat_image': SOCKET_MAX_IMAGE_BYTES},
+    disconnect_after=int(os.environ.get('SOCKET_RATE_DISCONNECT_AFTER', 200)),
+)
+# 送信キューが溜まった遅い受信者: OUTBOUND_QUEUE_DROP 以上で ICE の中継を間引き、OUTBOUND_QUEUE_DISCONNECT 以上で切断
+outbound = OutboundMonitor(
+    socketio,
+    drop_depth=int(os.environ.get('OUTBOUND_QUEUE_DROP', 256)),
+    disconnect_depth=int(os.environ.get('OUTBOUND_QUEUE_DISCONNECT', 1024)),
+)
 
 
 # ---------- User モデル ----------
@@ -69,112 +178,745 @@ class User(db.Model):
         return False
 
 
+# ---------- 学習記録（追記専用） ----------
+class StudySession(db.Model):
+    __tablename__ = 'study_sessions'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    room_id = db.Column(db.String(64))
+    started_at = db.Column(db.Float, nullable=False)  # UNIX 時刻（秒）
+    ended_at = db.Column(db.Float, nullable=False)    # UNIX 時刻（秒）
+    seconds = db.Column(db.Integer, nullable=False)
+
+
+# ---------- 学習時間の集計（学習記録の書き込み時に加算で更新） ----------
+class StudyDaily(db.Model):
+    """ユーザー × 日付（STATS_UTC_OFFSET_HOURS の0時区切り）ごとの学習秒数。"""
+    __tablename__ = 'study_daily'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True, index=True)
+    seconds = db.Column(db.Integer, nullable=False, default=0)
+
+
+class StudyRankBucket(db.Model):
+    """総学習時間（分）ごとのユーザー数。学習記録の書き込みで移し替え、全体の順位はこの累積和で出す。"""
+    __tablename__ = 'study_rank_buckets'
+    minutes = db.Column(db.Integer, primary_key=True)
+    users = db.Column(db.Integer, nullable=False, default=0)
+
+
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    current_streak = db.Column(db.Integer, nullable=False, default=0)  # 最終学習日までの連続日数
+    longest_streak = db.Column(db.Integer, nullable=False, default=0)
+    last_study_day = db.Column(db.Date)
+
+
+# 全体ランキング（ORDER BY total_study_time DESC LIMIT N）用。既存の users テーブルにも起動時に作成する
+users_total_study_time_index = db.Index('ix_users_total_study_time', User.total_study_time)
+
+
+# ---------- ログインユーザーのキャッシュ（プロセス内 LRU） ----------
+# 認証済みリクエストのたびに User を SELECT しないよう、DB セッションから切り離したスナップショットを
+# current_user にする。User を書き換えたら invalidate_user_profile() が user_versions を進めるので、
+# ほかのワーカーのキャッシュも次のリクエストで読み直される（版の確認は Redis でも HGET 1回）。
+USER_CACHE_MAX = int(os.environ.get('USER_CACHE_MAX', 4096))
+_user_cache = OrderedDict()  # User.id -> UserSnapshot
+# User.id -> 版番号（書き込みのたびに +1）
+user_versions = state_store.namespace('user_versions')
+
+
+class UserSnapshot:
+    """current_user 用の User の読み取り専用コピー。書き込みは User を引き直すか UPDATE 文で行う。"""
+    __slots__ = ('id', 'google_id', 'name', 'email', 'profile_image', 'total_study_time', 'version')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, user, version):
+        self.id = user.id
+        self.google_id = user.google_id
+        self.name = user.name
+        self.email = user.email
+        self.profile_image = user.profile_image
+        self.total_study_time = user.total_study_time
+        self.version = version
+
+    def get_id(self):
+        return str(self.id)
+
+
+def _load_user_snapshot(uid, version):
+    user = User.query.get(uid)
+    return UserSnapshot(user, version) if user is not None else None
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    try:
-        return User.query.get(int(user_id))
-    except (ValueError, TypeError):
+    uid = _to_user_db_id(user_id)
+    if uid is None:
+        return None
+    # 版を先に読む（読み込み中に書き込まれても、版が進むので次のリクエストで読み直される）
+    version = user_versions.get(uid, 0)
+    cached = _user_cache.get(uid)
+    if cached is not None and cached.version == version:
+        _user_cache.move_to_end(uid)
+        return cached
+    snapshot = db_executor.run(_load_user_snapshot, uid, version)
+    if snapshot is None:
+        _user_cache.pop(uid, None)
         return None
+    _user_cache[uid] = snapshot
+    _user_cache.move_to_end(uid)
+    while len(_user_cache) > USER_CACHE_MAX:
+        _user_cache.popitem(last=False)
+    return snapshot
 
 
 # Google OAuth: 環境変数 GOOGLE_CLIENT_ID / GOOGLE_CLIENT_SECRET を config に渡す
 app.config['GOOGLE_CLIENT_ID'] = os.environ.get('GOOGLE_CLIENT_ID', '')
 app.config['GOOGLE_CLIENT_SECRET'] = os.environ.get('GOOGLE_CLIENT_SECRET', '')
-oauth.register(
-    'google',
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    client_kwargs={'scope': 'openid profile email'},
-)
+GOOGLE_METADATA_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+# OpenID のメタデータ（エンドポイント・署名鍵）はワーカーごとに取りに行かず、ファイルに置いて使い回す
+OAUTH_METADATA_CACHE = os.environ.get('OAUTH_METADATA_CACHE') or os.path.join(app.instance_path, 'google-openid-configuration.json')
+OAUTH_METADATA_TTL = int(os.environ.get('OAUTH_METADATA_TTL', 86400))  # 秒
+_google_client = None
+_google_metadata_cached = False  # OAUTH_METADATA_CACHE から読めたか（読めなければログイン成功時に書く）
+
+
+def google_oauth():
+    """Google の OAuth クライアント。authlib の import とメタデータの読み込みは最初のログインまで遅らせる。"""
+    global _google_client, _google_metadata_cached
+    if _google_client is None:
+        from authlib.integrations.flask_client import OAuth
+        client = OAuth(app).register(
+            'google',
+            server_metadata_url=GOOGLE_METADATA_URL,
+            client_kwargs={'scope': 'openid profile email'},
+        )
+        metadata = _read_oauth_metadata()
+        if metadata:
+            # '_loaded_at' が入っているので authlib は取りに行かない（鍵が合わなければ jwks だけ取り直す）
+            client.server_metadata.update(metadata)
+            _google_metadata_cached = True
+        _google_client = client
+    return _google_client
 
-# room_id -> { sid -> { user_name, role } }  (legacy lookup; private_rooms でも使用)
-room_users = {}
-# room_id -> { sid -> bool (hand raised) }
-hand_raise_states = {}
-# sid -> room_id (for disconnect cleanup)
-sid_to_room = {}
-# private session_id -> { main_room, admin_sid, student_sid }
-private_rooms = {}
 
-# ----- ルーム管理（メインルーム・最大4人・サーバーが唯一の正解） -----
-# room_id -> [ { sid, user_name, role, user_id, connected }, ... ] 入室順・最大4、先頭がホスト
-room_participants = {}
+def _read_oauth_metadata():
+    try:
+        if time.time() - os.path.getmtime(OAUTH_METADATA_CACHE) > OAUTH_METADATA_TTL:
+            return None
+        with open(OAUTH_METADATA_CACHE, encoding='utf-8') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return metadata if isinstance(metadata, dict) and '_loaded_at' in metadata else None
+
+
+def _save_oauth_metadata(metadata):
+    """ログインに成功したときのメタデータ（取得済みの jwks を含む）をファイルに書く。"""
+    global _google_metadata_cached
+    _google_metadata_cached = True
+    try:
+        os.makedirs(os.path.dirname(OAUTH_METADATA_CACHE), exist_ok=True)
+        tmp = f'{OAUTH_METADATA_CACHE}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+        os.replace(tmp, OAUTH_METADATA_CACHE)
+    except OSError:
+        pass  # 書けなくても次のワーカーが取りに行くだけ
+
+# 以下のルーム状態はすべて state_store 上にある（既定は dict そのもの）。
+# 値（Room / PrivateSession など）を変更したら、Redis バックエンドでも反映されるよう必ず代入し直すこと。
+# sid -> room_id（メインルーム or 個別指導の session_id。切断時の片付け・中継先チェック用）
+sid_to_room = state_store.namespace('sid_to_room')
+# private session_id -> PrivateSession（main_room, admin_sid, student_sid, 入室済みの参加者）
+private_rooms = state_store.namespace('private_rooms', model=PrivateSession)
+# sid -> private session_id（開始時に管理者・生徒の両方を登録。切断時に private_rooms を走査しないための逆引き）
+private_session_by_sid = state_store.namespace('private_session_by_sid')
+
+# ----- ルーム管理（メインルーム・定員制・サーバーが唯一の正解） -----
+# room_id -> Room（participants は入室順・最大 capacity、先頭がホスト。挙手・接続状態は Participant が持つ）
+main_rooms = state_store.namespace('main_rooms', model=Room)
+# room_id -> { mode, capacity, idle_since }（管理者が作った大部屋の設定。最初の1人が入室したときにこの設定で Room を作る）
+# idle_since は作った時刻か最後に空になった時刻。空のまま HALL_IDLE_TTL 秒たった設定は監査で消す
+room_configs = state_store.namespace('room_configs')
+
+MAX_ROOM_SIZE = Room.MESH_CAPACITY  # 自動で割り当てる（mesh の）ルームの定員
+# 空席インデックス: 人数 -> { room_id: None }（dict を挿入順つき集合として使う）
+# 満室でない mesh のメインルームだけを人数別バケットで保持し、入室先探索を O(1) にする（大部屋は招待URLで入る）
+free_rooms_by_size = {n: state_store.namespace(f'free_rooms_{n}') for n in range(MAX_ROOM_SIZE)}
+# room_id -> 現在登録されているバケットの人数
+_free_room_bucket = state_store.namespace('free_room_bucket')
+# room_id / session_id -> Room.summary() / PrivateSession.summary()（管理者向けのルーム一覧用。書き込みのたびに更新）
+room_summaries = state_store.namespace('room_summaries')
+# 'all' -> room_summaries を更新するたびに進める番号、'pushed' -> 管理者に最後に配信した番号
+overview_revisions = state_store.namespace('overview_revisions')
+
+
+def update_free_room_index(room_id, size=None):
+    """空席インデックスを room_id の現在の人数 size に合わせる（入室・退出のたびに呼ぶ。None はルーム削除）。"""
+    prev = _free_room_bucket.pop(room_id, None)
+    if prev is not None:
+        free_rooms_by_size[prev].pop(room_id, None)
+    if size is not None and size < MAX_ROOM_SIZE and is_main_room(room_id):
+        free_rooms_by_size[size][room_id] = None
+        _free_room_bucket[room_id] = size
+
+
+def find_room_with_free_seat():
+    """空きのあるメインルームを1つ返す。人数の多いルームから埋める（なければ None）。"""
+    for size in range(MAX_ROOM_SIZE - 1, -1, -1):
+        bucket = free_rooms_by_size[size]
+        if bucket:
+            return next(iter(bucket))
+    return None
+
+
+def update_room_summary(room_id, members):
+    """Room / PrivateSession を書き戻したら呼ぶ（管理者向けの一覧の要約を差し替える）。"""
+    room_summaries[room_id] = members.summary()
+    state_store.incr('overview_revisions', 'all')
+
+
+def remove_room_summary(room_id):
+    if room_summaries.pop(room_id, None) is not None:
+        state_store.incr('overview_revisions', 'all')
+
+
+# ----- 大部屋（SFU）: 各自が中継サーバー（media_relay.py）に1本だけ送り、中継サーバーがほかの参加者へ配る -----
+# SFU_URL（ブラウザから届く中継サーバーの URL）を設定すると、管理者がルーム一覧から定員つきの大部屋を作れる。
+# 入室した参加者には中継サーバー用のトークン（ルーム・sid に署名したもの。中継サーバーと SFU_SECRET を共有）を渡す。
+SFU_URL = os.environ.get('SFU_URL', '').rstrip('/')
+SFU_SECRET = os.environ.get('SFU_SECRET') or app.secret_key
+SFU_ROOM_CAPACITY = int(os.environ.get('SFU_ROOM_CAPACITY', 16))  # 大部屋の既定の定員
+SFU_MAX_CAPACITY = int(os.environ.get('SFU_MAX_CAPACITY', 50))
+HALL_IDLE_TTL = int(os.environ.get('HALL_IDLE_TTL', 24 * 60 * 60))  # 秒。空の大部屋の設定を残しておく時間（0 で消さない）
+_sfu_signer = URLSafeTimedSerializer(SFU_SECRET, salt='sfu')
+
+
+def sfu_token(room_id, sid):
+    return _sfu_signer.dumps({'room': room_id, 'sid': sid})
+
+
+def new_main_room(room_id):
+    """room_id のメインルームを新しく作る（管理者が作った大部屋なら、その mode・定員で）。"""
+    config = room_configs.get(room_id) if SFU_URL else None
+    if config:
+        return Room(room_id, mode=config['mode'], capacity=config['capacity'])
+    return Room(room_id)
+
+
+def save_main_room(room):
+    """Room を書き戻し、空席インデックスと一覧の要約を更新する（空になったルームは削除する）。"""
+    if room.participants:
+        main_rooms[room.room_id] = room
+        update_free_room_index(room.room_id, len(room.participants) if room.mode == 'mesh' else None)
+        update_room_summary(room.room_id, room)
+    else:
+        remove_main_room(room.room_id)
+
+
+def remove_main_room(room_id):
+    """メインルームを main_rooms・空席インデックス・rev／差分ログ・一覧の要約から削除する。"""
+    main_rooms.pop(room_id, None)
+    update_free_room_index(room_id)
+    remove_room_summary(room_id)
+    room_revisions.pop(room_id, None)
+    room_delta_logs.pop(room_id, None)
+    config = room_configs.get(room_id)
+    if config is not None:  # 大部屋は空になってからも HALL_IDLE_TTL 秒は招待URLで同じ設定のまま入れる
+        config['idle_since'] = time.time()
+        room_configs[room_id] = config
+
+
+# ----- ルーム状態のリビジョンと差分配信 -----
+# メインルームの状態が変わるたびに rev を1つ進め、全員には差分イベント（入室・退出・ホスト交代・挙手など）だけを送る。
+# クライアントは rev の飛びを検知したら request_room_state で自分の rev を送り、差分ログから追いつく
+# （ログにない古い rev ならスナップショットを返す）。
+ROOM_DELTA_LOG_SIZE = 32
+# room_id -> 現在の rev
+room_revisions = state_store.namespace('room_revisions')
+# room_id -> [ [event, payload], ... ]（直近 ROOM_DELTA_LOG_SIZE 件）
+room_delta_logs = state_store.namespace('room_delta_logs')
+
+
+def emit_room_assigned(room_id, sid, is_host, state):
+    """本人に入室先の全体状態を送る。rev は state を作った後に配信した差分も含む現在値。大部屋なら中継サーバーの接続先も付ける。"""
+    payload = {'room_id': room_id, 'is_host': is_host, 'participants': state['participants'],
+               'rev': room_revisions.get(room_id, 0), 'mode': state['mode'], 'capacity': state['capacity']}
+    if state['mode'] == 'sfu':
+        payload['sfu'] = {'url': SFU_URL, 'token': sfu_token(room_id, sid)}
+    emit('room_assigned', payload, room=sid)
+
+
+def emit_room_delta(room, event, payload, skip_sid=None):
+    """メインルームの差分イベントに rev を付けて配信し、差分ログに残す。
+
+    rev の発行・差分ログの読み書き・配信はルームごとのロックの中で行う（複数ワーカーのとき、
+    ログの書き戻しで他のワーカーの差分を消したり、rev の順番が入れ替わったりしないように）。
+    呼び出し元が 'rooms' のロックを持っていることもあるので、別の名前のロックにする。
+    """
+    with state_store.lock('room_delta:' + room):
+        rev = state_store.incr('room_revisions', room)
+        payload = dict(payload, rev=rev)
+        log = room_delta_logs.get(room) or []
+        log.append([event, payload])
+        del log[:-ROOM_DELTA_LOG_SIZE]
+        room_delta_logs[room] = log
+        socketio.emit(event, payload, to=room, skip_sid=skip_sid)
+
+
+def find_wire_participant(state, sid):
+    """build_room_state の participants から sid の要素を探す（なければ空の dict）。
+
+    build_room_state はプロフィールの取得で待つので、その間にほかの人が入退室して位置がずれることがある。
+    """
+    return next((p for p in state['participants'] if p['s'] == sid), {})
+
+
+def get_room_deltas_since(room, rev):
+    """rev より後の差分を順に返す。ログから欠けなく揃えられなければ None（スナップショットが必要）。"""
+    current = room_revisions.get(room, 0)
+    if rev >= current:
+        return []
+    missed = [entry for entry in (room_delta_logs.get(room) or []) if entry[1]['rev'] > rev]
+    if len(missed) != current - rev or missed[0][1]['rev'] != rev + 1:
+        return None
+    return missed
 
 
 def get_room():
     return request.referrer or request.args.get('room')  # fallback
 
 
-def get_hand_states(room):
-    return [
-        {"sid": sid, "user_name": room_users.get(room, {}).get(sid, {}).get("user_name", ""), "role": room_users.get(room, {}).get(sid, {}).get("role", "student"), "raised": hand_raise_states.get(room, {}).get(sid, False)}
-        for sid in hand_raise_states.get(room, {})
-    ]
+def get_hand_states(members):
+    """Room / PrivateSession の参加者の挙手状態一覧（短いキー。Participant.wire_hand_state）。"""
+    return [p.wire_hand_state() for p in members.participants]
 
 
 def is_main_room(room_id):
     return room_id and not room_id.startswith('private_')
 
 
-def get_connected_count(participants_list):
-    return sum(1 for p in participants_list if p.get('connected'))
+# ---------- ユーザープロフィールキャッシュ（プロセス内 LRU + TTL） ----------
+# User.id -> (有効期限, { name, profile_image, total_study_time })
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 300))  # 秒
+PROFILE_CACHE_MAX = int(os.environ.get('PROFILE_CACHE_MAX', 4096))
+_profile_cache = OrderedDict()
 
 
-def _participant_total_study_minutes(user_db_id):
-    """DBの user_db_id (User.id) から総勉強時間（分）を返す。"""
-    if user_db_id is None:
-        return 0
+def _to_user_db_id(user_db_id):
     try:
-        u = User.query.get(int(user_db_id))
-        return (u.total_study_time or 0) if u else 0
+        return int(user_db_id) if user_db_id is not None else None
     except (ValueError, TypeError):
-        return 0
+        return None
+
+
+def _cache_user_profile(uid, profile):
+    _profile_cache[uid] = (time.time() + PROFILE_CACHE_TTL, profile)
+    _profile_cache.move_to_end(uid)
+    while len(_profile_cache) > PROFILE_CACHE_MAX:
+        _profile_cache.popitem(last=False)
+
+
+def invalidate_user_profile(user_db_id):
+    """プロフィール・学習時間を書き換えたら呼ぶ（次回参照時に DB から読み直す）。"""
+    uid = _to_user_db_id(user_db_id)
+    if uid is None:
+        return
+    _profile_cache.pop(uid, None)
+    _user_cache.pop(uid, None)
+    state_store.incr('user_versions', uid)
+
+
+def get_user_profiles(user_db_ids):
+    """User.id のリストから { id: profile } を返す。キャッシュにないものは IN (...) の1クエリでまとめて取得。"""
+    now = time.time()
+    profiles = {}
+    misses = []
+    for uid in user_db_ids:
+        uid = _to_user_db_id(uid)
+        if uid is None or uid in profiles:
+            continue
+        cached = _profile_cache.get(uid)
+        if cached and cached[0] > now:
+            _profile_cache.move_to_end(uid)
+            profiles[uid] = cached[1]
+        else:
+            misses.append(uid)
+    if misses:
+        for uid, profile in db_executor.run(_fetch_user_profiles, misses):
+            _cache_user_profile(uid, profile)
+            profiles[uid] = profile
+    return profiles
+
+
+def _fetch_user_profiles(user_db_ids):
+    return [(u.id, {
+        'name': u.name or '',
+        'profile_image': u.profile_image or '',
+        'total_study_time': u.total_study_time or 0,
+    }) for u in User.query.filter(User.id.in_(user_db_ids)).all()]
 
 
 def build_room_state(room_id):
-    """メインルーム用: 最大4スロットの参加者リストとホストsidを返す。"""
-    if not is_main_room(room_id) or room_id not in room_participants:
+    """メインルーム用: 参加者リスト（入室順・挙手状態つき。短いキー）・ホストsid・現在の rev・mode・定員を返す。"""
+    room = main_rooms.get(room_id) if is_main_room(room_id) else None
+    if room is None:
         return {'participants': [], 'host_sid': None}
-    plist = room_participants[room_id]
-    host_sid = plist[0]['sid'] if plist else None
+    profiles = get_user_profiles([p.user_db_id for p in room.participants])
     participants = []
-    for i, p in enumerate(plist):
-        total_min = _participant_total_study_minutes(p.get('user_db_id'))
-        participants.append({
-            'sid': p['sid'],
-            'user_name': p.get('user_name', ''),
-            'role': p.get('role', 'student'),
-            'connected': p.get('connected', True),
-            'is_host': (i == 0),
-            'total_study_time_minutes': total_min,
-        })
-    return {'participants': participants, 'host_sid': host_sid}
+    for i, p in enumerate(room.participants):
+        profile = profiles.get(_to_user_db_id(p.user_db_id))
+        participants.append(p.wire_state(i == 0, profile['total_study_time'] if profile else 0))
+    host_sid = room.host.sid if room.participants else None
+    return {'participants': participants, 'host_sid': host_sid, 'rev': room_revisions.get(room_id, 0),
+            'mode': room.mode, 'capacity': room.capacity}
+
+
+# ---------- 学習時間の書き込み（write-behind） ----------
+# 退室・ログアウト・切断のたびに commit せず、バッファに溜めてバックグラウンドでまとめて書き込む
+STUDY_FLUSH_INTERVAL = float(os.environ.get('STUDY_FLUSH_INTERVAL', 5))  # 秒
+STUDY_FLUSH_BATCH = int(os.environ.get('STUDY_FLUSH_BATCH', 500))        # 件
+# 日別の集計・連続学習日数の日付の区切り（既定は日本時間の0時）
+STATS_TZ = timezone(timedelta(hours=float(os.environ.get('STATS_UTC_OFFSET_HOURS', 9))))
+STREAK_MIN_MINUTES = int(os.environ.get('STREAK_MIN_MINUTES', 1))  # この分数以上学習した日を連続日数に数える
+# 書き込みに失敗した記録は次回以降に1件ずつ再試行し、STUDY_FLUSH_MAX_ATTEMPTS 回失敗したら捨てる
+# （1件だけ書けない行があっても、ほかの記録を巻き込んで再試行し続けないように）。
+# DB が止まっている間もバッファは STUDY_PENDING_MAX 件までにし、超えたら古い記録から捨てる
+STUDY_FLUSH_MAX_ATTEMPTS = int(os.environ.get('STUDY_FLUSH_MAX_ATTEMPTS', 5))
+STUDY_PENDING_MAX = int(os.environ.get('STUDY_PENDING_MAX', 20000))
+STUDY_SESSION_FIELDS = ('user_id', 'room_id', 'started_at', 'ended_at', 'seconds')  # study_sessions に書く列
+_pending_study_sessions = []  # [ { user_id, room_id, started_at, ended_at, seconds, attempts }, ... ]
+_study_writer_started = False
+study_sessions_dropped = 0  # 書き込めずに捨てた学習記録の数（/metrics に出す）
+
+
+def flush_study_sessions(run=None):
+    """バッファ中の学習記録を書き込む。run は DB 呼び出しの実行方法（既定は db_executor.run）。
+
+    初めての記録はまとめて1回で、前に失敗した記録は1件ずつ書く。失敗した記録はバッファに戻す。
+    """
+    if not _pending_study_sessions:
+        return
+    run = run or db_executor.run
+    batch = _pending_study_sessions[:]
+    del _pending_study_sessions[:]
+    retry = [rec for rec in batch if rec['attempts']]
+    failed = []
+    for i, rec in enumerate(retry):
+        if not _write_study_batch(run, [rec]):
+            # DB が止まっているときに1件ずつ全部試さないよう、この回の再試行はここまでにする
+            failed.append(rec)
+            _pending_study_sessions[:0] = retry[i + 1:]
+            break
+    fresh = [rec for rec in batch if not rec['attempts']]
+    if fresh and not _write_study_batch(run, fresh):
+        failed += fresh
+    requeue = []
+    for rec in failed:
+        rec['attempts'] += 1
+        if rec['attempts'] < STUDY_FLUSH_MAX_ATTEMPTS:
+            requeue.append(rec)
+        else:
+            _drop_study_sessions([rec], 'write failed %d times' % rec['attempts'])
+    _pending_study_sessions[:0] = requeue
+    _trim_pending_study_sessions()
+
+
+def _write_study_batch(run, batch):
+    """学習記録を study_sessions へ一括 INSERT し、users.total_study_time と日別の集計を加算する。成功したら True。"""
+    minutes_by_user = {}
+    daily = {}  # (user_id, 日付) -> 秒
+    for rec in batch:
+        minutes = rec['seconds'] // 60
+        if minutes > 0:
+            minutes_by_user[rec['user_id']] = minutes_by_user.get(rec['user_id'], 0) + minutes
+        for day, seconds in split_by_day(rec['started_at'], rec['ended_at'], STATS_TZ).items():
+            key = (rec['user_id'], day)
+            daily[key] = daily.get(key, 0) + seconds
+    rows = [{k: rec[k] for k in STUDY_SESSION_FIELDS} for rec in batch]
+    try:
+        run(_write_study_sessions, rows, minutes_by_user, daily)
+    except Exception as e:
+        app.logger.warning('study session write failed (%d records): %r', len(batch), e)
+        return False
+    for uid in set(minutes_by_user) | {uid for uid, _ in daily}:
+        invalidate_user_profile(uid)
+    return True
+
+
+def _drop_study_sessions(records, reason):
+    global study_sessions_dropped
+    study_sessions_dropped += len(records)
+    app.logger.error('dropped %d study sessions (%s): %s', len(records), reason,
+                     [{k: rec[k] for k in STUDY_SESSION_FIELDS} for rec in records[:10]])
+
+
+def _trim_pending_study_sessions():
+    """バッファが STUDY_PENDING_MAX 件を超えていたら古い記録から捨てる。"""
+    overflow = len(_pending_study_sessions) - STUDY_PENDING_MAX
+    if overflow > 0:
+        _drop_study_sessions(_pending_study_sessions[:overflow], 'buffer full')
+        del _pending_study_sessions[:overflow]
+
+
+def _write_study_sessions(batch, minutes_by_user, daily):
+    try:
+        db.session.execute(db.insert(StudySession), batch)
+        # 加算は UPDATE 1文で行う（同一ユーザーの同時セッションでも更新が消えない）
+        moves = []  # (加算前, 加算後) の総学習時間
+        for uid, minutes in minutes_by_user.items():
+            total = _add_total_study_time(uid, minutes)
+            if total is not None:
+                moves.append((total - minutes, total))
+        if moves:
+            _move_rank_buckets(moves)
+        if daily:
+            _add_daily_seconds(daily)
+            _advance_streaks(daily)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _add_total_study_time(uid, minutes):
+    """users.total_study_time に加算し、加算後の値を返す（ユーザーがいなければ None）。"""
+    stmt = (db.update(User)
+            .where(User.id == uid)
+            .values(total_study_time=db.func.coalesce(User.total_study_time, 0) + minutes))
+    if db.engine.dialect.update_returning:
+        # 加算と読み出しを1文で行う（別のワーカーの加算が間に入っても、自分の加算の前後の値が分かる）
+        return db.session.execute(stmt.returning(User.total_study_time)).scalar()
+    db.session.execute(stmt)
+    return db.session.scalar(db.select(User.total_study_time).where(User.id == uid))
+
+
+def _upsert_add(model, keys, column, rows):
+    """rows（dict のリスト）の column を model の行に加算する（keys の行がなければ作る）。"""
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(model).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: getattr(model, column) + getattr(stmt.excluded, column)},
+        ))
+        return
+    for row in rows:
+        result = db.session.execute(
+            db.update(model)
+            .where(*(getattr(model, key) == row[key] for key in keys))
+            .values({column: getattr(model, column) + row[column]})
+        )
+        if result.rowcount == 0:
+            db.session.add(model(**row))
+
+
+def _add_daily_seconds(daily):
+    """study_daily に (user_id, day) ごとの秒数を加算する（行がなければ作る）。"""
+    rows = [{'user_id': uid, 'day': day, 'seconds': seconds} for (uid, day), seconds in daily.items()]
+    _upsert_add(StudyDaily, ['user_id', 'day'], 'seconds', rows)
+
+
+def _move_rank_buckets(moves):
+    """総学習時間が変わったユーザーを study_rank_buckets の加算前の分数から加算後の分数へ移す。"""
+    delta = {}
+    for old, new in moves:
+        if old > 0:
+            delta[old] = delta.get(old, 0) - 1
+        delta[new] = delta.get(new, 0) + 1
+    rows = [{'minutes': minutes, 'users': n} for minutes, n in sorted(delta.items()) if n]
+    if not rows:
+        return
+    _upsert_add(StudyRankBucket, ['minutes'], 'users', rows)
+    emptied = [row['minutes'] for row in rows if row['users'] < 0]
+    if emptied:
+        db.session.execute(db.delete(StudyRankBucket).where(
+            StudyRankBucket.minutes.in_(emptied), StudyRankBucket.users <= 0))
+
+
+def _advance_streaks(daily):
+    """その日の合計が STREAK_MIN_MINUTES に達した日を、ユーザーごとに古い順に連続日数へ反映する。"""
+    totals = db.session.execute(
+        db.select(StudyDaily.user_id, StudyDaily.day, StudyDaily.seconds)
+        .where(db.tuple_(StudyDaily.user_id, StudyDaily.day).in_(list(daily)))
+    ).all()
+    days_by_user = {}
+    for uid, day, seconds in totals:
+        if seconds >= STREAK_MIN_MINUTES * 60:
+            days_by_user.setdefault(uid, []).append(day)
+    if not days_by_user:
+        return
+    stats = {st.user_id: st for st in UserStats.query.filter(UserStats.user_id.in_(list(days_by_user))).all()}
+    for uid, days in days_by_user.items():
+        st = stats.get(uid)
+        if st is None:
+            st = UserStats(user_id=uid, current_streak=0, longest_streak=0)
+            db.session.add(st)
+        for day in sorted(days):
+            st.current_streak, st.longest_streak, st.last_study_day = advance_streak(
+                st.current_streak, st.longest_streak, st.last_study_day, day)
+
+
+def _study_writer_loop():
+    last_flush = time.time()
+    while True:
+        socketio.sleep(min(1.0, STUDY_FLUSH_INTERVAL))
+        now = time.time()
+        if len(_pending_study_sessions) >= STUDY_FLUSH_BATCH or now - last_flush >= STUDY_FLUSH_INTERVAL:
+            flush_study_sessions()
+            last_flush = now
+
+
+def enqueue_study_session(user_id, room_id, started_at, ended_at):
+    global _study_writer_started
+    seconds = int(max(0, ended_at - started_at))
+    if seconds <= 0:
+        return
+    _pending_study_sessions.append({
+        'user_id': user_id,
+        'room_id': room_id,
+        'started_at': started_at,
+        'ended_at': ended_at,
+        'seconds': seconds,
+        'attempts': 0,
+    })
+    _trim_pending_study_sessions()
+    if not _study_writer_started:
+        _study_writer_started = True
+        socketio.start_background_task(_study_writer_loop)
+
+
+def _run_in_fresh_session(fn, *args):
+    """fn をこのスレッドで、新しいアプリケーションコンテキスト（新しい db.session）の中で実行する。"""
+    with app.app_context():
+        try:
+            return fn(*args)
+        finally:
+            db.session.remove()
+
+
+@atexit.register
+def _flush_study_sessions_at_exit():
+    # 終了処理中は tpool のスレッドやハブが止まっていることがあるので、同期的に書く
+    flush_study_sessions(run=_run_in_fresh_session)
 
 
 def record_study_time_if_entered():
-    """セッションに enter_time とログインユーザーがあれば学習時間を加算してクリアする。"""
+    """セッションに enter_time とログインユーザーがあれば学習記録をキューに積んでクリアする。"""
     enter_time = session.pop('enter_time', None)
     if enter_time is None:
         return
-    user = None
-    if current_user.is_authenticated:
-        user = current_user
-    else:
-        try:
-            uid = session.get('_user_id')
-            if uid:
-                user = User.query.get(int(uid))
-        except (ValueError, TypeError):
-            pass
-    if not user:
-        return
+    # DB を引かずにセッションの user_id だけで記録する
     try:
-        duration_sec = max(0, time.time() - enter_time)
-        duration_min = int(duration_sec / 60)
-        if duration_min > 0:
-            user.total_study_time = (user.total_study_time or 0) + duration_min
-            db.session.commit()
-    except Exception:
-        db.session.rollback()
+        uid = int(session.get('_user_id'))
+    except (ValueError, TypeError):
+        return
+    enqueue_study_session(uid, (session.get('room') or '')[:64] or None, enter_time, time.time())
+
+
+# ---------- 学習統計・ランキング ----------
+LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', 10))
+LEADERBOARD_REFRESH = float(os.environ.get('LEADERBOARD_REFRESH', 300))  # 秒。ランキングを作り直す間隔
+leaderboard = Leaderboard(LEADERBOARD_SIZE)
+# User.id -> (user_versions の版, 日付, 集計)。学習記録の書き込みで版が進むと読み直す
+_stats_cache = OrderedDict()
+
+
+def get_study_stats(uid):
+    """今日・今週・今月の学習分数と連続学習日数。"""
+    today = local_day(time.time(), STATS_TZ)
+    version = user_versions.get(uid, 0)
+    cached = _stats_cache.get(uid)
+    if cached is not None and cached[0] == version and cached[1] == today:
+        _stats_cache.move_to_end(uid)
+        return cached[2]
+    stats = db_executor.run(_fetch_study_stats, uid, today)
+    _stats_cache[uid] = (version, today, stats)
+    _stats_cache.move_to_end(uid)
+    while len(_stats_cache) > USER_CACHE_MAX:
+        _stats_cache.popitem(last=False)
+    return stats
+
+
+def _fetch_study_stats(uid, today):
+    week_start, month_start = period_starts(today)
+    rows = db.session.execute(
+        db.select(StudyDaily.day, StudyDaily.seconds)
+        .where(StudyDaily.user_id == uid, StudyDaily.day >= min(week_start, month_start))
+    ).all()
+    st = db.session.get(UserStats, uid)
+    return {
+        'today_minutes': sum(sec for day, sec in rows if day == today) // 60,
+        'week_minutes': sum(sec for day, sec in rows if day >= week_start) // 60,
+        'month_minutes': sum(sec for day, sec in rows if day >= month_start) // 60,
+        'streak_days': current_streak(st.current_streak, st.last_study_day, today) if st else 0,
+        'longest_streak_days': st.longest_streak if st else 0,
+    }
+
+
+def refresh_leaderboard():
+    week_start, _ = period_starts(local_day(time.time(), STATS_TZ))
+    top, buckets = db_executor.run(_fetch_leaderboard, LEADERBOARD_SIZE, week_start)
+    leaderboard.replace(top, buckets)
+
+
+def _fetch_leaderboard(size, week_start):
+    """上位 size 人（今週・累計）と、順位計算用の (総学習時間, 人数) の昇順を返す。"""
+    all_time = db.session.execute(
+        db.select(User.name, User.profile_image, User.total_study_time)
+        .where(User.total_study_time > 0)
+        .order_by(User.total_study_time.desc())
+        .limit(size)
+    ).all()
+    week_seconds = db.func.sum(StudyDaily.seconds).label('seconds')
+    week = db.session.execute(
+        db.select(User.name, User.profile_image, week_seconds)
+        .join(User, User.id == StudyDaily.user_id)
+        .where(StudyDaily.day >= week_start)
+        .group_by(StudyDaily.user_id, User.name, User.profile_image)
+        .order_by(week_seconds.desc())
+        .limit(size)
+    ).all()
+    # 行数はユーザー数ではなく総学習時間（分）の種類の数
+    buckets = db.session.execute(
+        db.select(StudyRankBucket.minutes, StudyRankBucket.users)
+        .where(StudyRankBucket.users > 0)
+        .order_by(StudyRankBucket.minutes)
+    ).all()
+    top = {
+        'all': [{'name': name or 'ユーザー', 'profile_image': image or '', 'minutes': minutes}
+                for name, image, minutes in all_time],
+        'week': [{'name': name or 'ユーザー', 'profile_image': image or '', 'minutes': seconds // 60}
+                 for name, image, seconds in week if seconds >= 60],
+    }
+    return top, [tuple(row) for row in buckets]
+
+
+def _leaderboard_loop():
+    while True:
+        try:
+            refresh_leaderboard()
+        except Exception:
+            pass  # 次の周期で再試行する（それまでは前回のランキングを表示）
+        socketio.sleep(LEADERBOARD_REFRESH)
+
+
+def format_minutes(total_min):
+    hours, mins = divmod(total_min, 60)
+    return f'{hours}時間 {mins}分'
+
+
+app.jinja_env.filters['minutes'] = format_minutes
 
 
 # ---------- Routes ----------
@@ -189,23 +931,38 @@ def index():
 @app.route('/login/google')
 def login_google():
     redirect_uri = url_for('google_authorized', _external=True)
-    return oauth.google.authorize_redirect(redirect_uri)
+    return google_oauth().authorize_redirect(redirect_uri)
 
 
 @app.route('/login/google/authorized')
 def google_authorized():
     try:
-        token = oauth.google.authorize_access_token()
+        token = google_oauth().authorize_access_token()
     except Exception:
         return redirect(url_for('index'))
+    if not _google_metadata_cached:
+        _save_oauth_metadata(_google_client.server_metadata)
     userinfo = token.get('userinfo')
     if not userinfo:
         return redirect(url_for('index'))
     google_id = userinfo.get('sub')
     if not google_id:
         return redirect(url_for('index'))
+    user, created = db_executor.run(_upsert_google_user, google_id, userinfo)
+    if not created:
+        invalidate_user_profile(user.id)
+    session.permanent = True
+    login_user(user, remember=True)
+    session['role'] = 'student'
+    session['user_name'] = user.name or user.email or 'ユーザー'
+    return redirect(url_for('dashboard'))
+
+
+def _upsert_google_user(google_id, userinfo):
+    """Google のユーザー情報で User を作成・更新し、(UserSnapshot, 新規作成か) を返す。"""
     user = User.query.filter_by(google_id=google_id).first()
-    if not user:
+    created = user is None
+    if created:
         user = User(
             google_id=google_id,
             name=userinfo.get('name') or '',
@@ -213,17 +970,13 @@ def google_authorized():
             profile_image=userinfo.get('picture') or '',
         )
         db.session.add(user)
-        db.session.commit()
     else:
         user.name = userinfo.get('name') or user.name
         user.email = userinfo.get('email') or user.email
         user.profile_image = userinfo.get('picture') or user.profile_image
-        db.session.commit()
-    session.permanent = True
-    login_user(user, remember=True)
-    session['role'] = 'student'
-    session['user_name'] = user.name or user.email or 'ユーザー'
-    return redirect(url_for('dashboard'))
+    db.session.commit()
+    # このリクエストの current_user 用（_user_cache には入れず、次のリクエストで load_user が読み直す）
+    return UserSnapshot(user, None), created
 
 
 @app.route('/dashboard')
@@ -231,12 +984,15 @@ def google_authorized():
 def dashboard():
     user = current_user
     total_min = user.total_study_time or 0
-    hours, mins = divmod(total_min, 60)
-    total_display = f'{hours}時間 {mins}分'
+    rank = leaderboard.rank(total_min)
     return render_template(
         'dashboard.html',
         user=user,
-        total_study_time_display=total_display,
+        total_study_time_display=format_minutes(total_min),
+        stats=get_study_stats(user.id),
+        leaderboard=leaderboard.top,
+        rank=rank,
+        ranked_users=max(leaderboard.population, rank or 0),  # 作り直した後に学習を始めた人も数に入れる
     )
 
 
@@ -271,8 +1027,8 @@ def settings():
     if request.method == 'POST':
         display_name = (request.form.get('display_name') or '').strip()
         if display_name:
-            current_user.name = display_name
-            db.session.commit()
+            db_executor.run(_rename_user, current_user.id, display_name)
+            invalidate_user_profile(current_user.id)
             session['user_name'] = display_name
         return redirect(url_for('dashboard'))
     return render_template(
@@ -282,6 +1038,12 @@ def settings():
     )
 
 
+def _rename_user(uid, display_name):
+    # current_user はキャッシュされたスナップショットなので UPDATE 文で書き込む
+    db.session.execute(db.update(User).where(User.id == uid).values(name=display_name))
+    db.session.commit()
+
+
 @app.route('/room')
 @login_required
 def room():
@@ -291,8 +1053,7 @@ def room():
         session['room'] = room_arg
     room_id = session.get('room', '')
     total_min = current_user.total_study_time or 0
-    hours, mins = divmod(total_min, 60)
-    total_study_time_display = f'{hours}時間 {mins}分'
+    total_study_time_display = format_minutes(total_min)
     return render_template(
         'room.html',
         role=session.get('role', 'student'),
@@ -301,6 +1062,7 @@ def room():
         profile_image=current_user.profile_image or '',
         total_study_time_display=total_study_time_display,
         total_study_time_minutes=total_min,
+        media_stats_interval=MEDIA_STATS_INTERVAL,
     )
 
 
@@ -327,11 +1089,231 @@ def logout():
     return redirect(url_for('index'))
 
 
+# ---------- 静的ファイル（縮小・ハッシュ付きの名前・圧縮済み） ----------
+# テンプレートは asset_url('css/style.css') で /assets/css/style.<内容のハッシュ>.css を参照する。名前が内容で変わるので
+# 1年間・immutable でキャッシュさせ、gzip / brotli の圧縮版はビルド時に作ったものをメモリから返す（assets.py）。
+# ビルドは `flask --app app build-assets`（デプロイ時）。済んでいなければ最初に使われたときにこのプロセスで作る。
+ASSET_DIR = os.environ.get('ASSET_DIR') or os.path.join(app.instance_path, 'assets')
+ASSETS_AUTO_REBUILD = os.environ.get('ASSETS_AUTO_REBUILD', '0') == '1'  # 開発用: static/ の変更を毎回確認して作り直す
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+asset_pipeline = AssetPipeline(app.static_folder, ASSET_DIR, auto_rebuild=ASSETS_AUTO_REBUILD)
+ASSET_URL_PREFIX = '/assets/'
+
+
+class _AssetAwareSessionInterface(SecureCookieSessionInterface):
+    """/assets/ ではセッションを開かない（NullSession）。
+
+    Flask-Login の after_request がセッションを読むだけでも Vary: Cookie が付き、共有キャッシュや CDN が
+    Cookie ごとに別々に持つことになる。ハッシュ付きの静的ファイルはだれに返しても同じなので、セッションごと使わない。
+    """
+
+    def open_session(self, app, request):
+        if request.path.startswith(ASSET_URL_PREFIX):
+            return self.make_null_session(app)
+        return super().open_session(app, request)
+
+
+app.session_interface = _AssetAwareSessionInterface()
+
+
+def asset_url(name):
+    """static/ からの相対パスに対応するハッシュ付きの URL（ビルド対象外のファイルは従来の /static/ の URL）。"""
+    hashed = asset_pipeline.hashed_name(name)
+    if hashed is None:
+        return url_for('static', filename=name)
+    return url_for('get_asset', filename=hashed)
+
+
+@app.context_processor
+def _asset_url():
+    return {'asset_url': asset_url}
+
+
+@app.route(ASSET_URL_PREFIX + '<path:filename>')
+def get_asset(filename):
+    asset = asset_pipeline.get(filename)
+    if asset is None:
+        abort(404)
+    encoding, data = asset.choose(request.accept_encodings)
+    response = app.response_class(data, content_type=f'{asset.mimetype}; charset=utf-8')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = ASSET_MAX_AGE
+    response.cache_control.immutable = True
+    response.set_etag(f'{asset.etag}-{encoding}')
+    return response.make_conditional(request)
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """static/ の CSS・JS を縮小・ハッシュ付け・圧縮して ASSET_DIR に書き出す。"""
+    count = asset_pipeline.build()
+    print(f'built {count} assets into {ASSET_DIR}')
+
+
+# ---------- 添付画像（個別指導チャット） ----------
+# 画像は base64 で Socket.IO に載せず、HTTP でバイナリのままアップロードして ID だけをやり取りする。
+# ID は内容の SHA-256（同じ画像は1回だけ保存される）。
+ATTACHMENT_DIR = os.environ.get('ATTACHMENT_DIR') or os.path.join(app.instance_path, 'attachments')
+ATTACHMENT_MAX_BYTES = int(os.environ.get('ATTACHMENT_MAX_BYTES', 2 * 1024 * 1024))
+ATTACHMENT_TTL = int(os.environ.get('ATTACHMENT_TTL', 24 * 60 * 60))  # 秒。これより古いファイルは削除
+ATTACHMENT_ID_RE = re.compile(r'^[0-9a-f]{64}\.(jpg|png|gif|webp)$')
+_attachment_last_prune = 0.0
+
+
+def _sniff_image_ext(data):
+    """先頭バイトから画像形式を判定して拡張子を返す（画像でなければ None）。"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _prune_attachments():
+    """ATTACHMENT_TTL より古い添付を削除する（1時間に1回まで）。"""
+    global _attachment_last_prune
+    now = time.time()
+    if now - _attachment_last_prune < 3600:
+        return
+    _attachment_last_prune = now
+    try:
+        with os.scandir(ATTACHMENT_DIR) as it:
+            for entry in it:
+                if entry.is_file() and now - entry.stat().st_mtime > ATTACHMENT_TTL:
+                    os.remove(entry.path)
+    except OSError:
+        pass
+
+
+def attachment_exists(attachment_id):
+    return bool(attachment_id and ATTACHMENT_ID_RE.match(attachment_id)
+                and os.path.isfile(os.path.join(ATTACHMENT_DIR, attachment_id)))
+
+
+@app.route('/attachments', methods=['POST'])
+@login_required
+def upload_attachment():
+    """画像をバイナリのまま受け取り { id, url } を返す（multipart の file でも可）。"""
+    if request.content_length and request.content_length > ATTACHMENT_MAX_BYTES + 1024:
+        return jsonify({'error': 'too_large'}), 413
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    data = stream.read(ATTACHMENT_MAX_BYTES + 1)
+    if len(data) > ATTACHMENT_MAX_BYTES:
+        return jsonify({'error': 'too_large'}), 413
+    ext = _sniff_image_ext(data)
+    if not ext:
+        return jsonify({'error': 'unsupported_type'}), 415
+    attachment_id = hashlib.sha256(data).hexdigest() + '.' + ext
+    path = os.path.join(ATTACHMENT_DIR, attachment_id)
+    if not os.path.exists(path):
+        os.makedirs(ATTACHMENT_DIR, exist_ok=True)
+        tmp_path = path + '.' + secrets.token_hex(4) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    else:
+        os.utime(path)  # 再利用された添付は期限を延ばす
+    _prune_attachments()
+    return jsonify({'id': attachment_id, 'url': url_for('get_attachment', attachment_id=attachment_id)})
+
+
+@app.route('/attachments/<attachment_id>')
+@login_required
+def get_attachment(attachment_id):
+    if not ATTACHMENT_ID_RE.match(attachment_id):
+        abort(404)
+    # 内容アドレスなので中身は変わらない → 長期キャッシュ可
+    return send_from_directory(ATTACHMENT_DIR, attachment_id, max_age=ATTACHMENT_TTL)
+
+
+# ---------- メトリクス ----------
+
+@metrics.gauge_callback
+def _room_gauges():
+    """スクレイプ時だけ呼ばれる。ルーム・セッションの状態から現在値を算出する。"""
+    # mesh の定員までは人数ごと、それより多い（大部屋）は1つの上限なしのバケットにまとめる
+    large = f'{MAX_ROOM_SIZE + 1}+'
+    sizes = {str(n): 0 for n in range(1, MAX_ROOM_SIZE + 1)}
+    sizes[large] = 0
+    connected = held = seats = 0
+    for room in main_rooms.values():
+        if not room.participants:
+            continue
+        n = len(room.participants)
+        sizes[str(n) if n <= MAX_ROOM_SIZE else large] += 1
+        seats += room.capacity
+        n = room.connected_count()
+        connected += n
+        held += len(room.participants) - n
+    rooms = sum(sizes.values())
+    occupancy = round((connected + held) / seats, 4) if seats else 0
+    return [
+        ('main_rooms', 'Main rooms with at least one participant.', [({}, rooms)]),
+        ('main_room_size', 'Main rooms by number of participants.', [({'size': n}, c) for n, c in sizes.items()]),
+        ('main_room_participants', 'Main-room seats by state (held = disconnected within the reconnect grace period).',
+         [({'state': 'connected'}, connected), ({'state': 'held'}, held)]),
+        ('main_room_occupancy_ratio', 'Occupied seats divided by total seats across open main rooms.', [({}, occupancy)]),
+        ('private_sessions', 'Active private tutoring sessions.', [({}, len(private_rooms))]),
+        ('hall_configs', 'Admin-created hall configs kept for invite URLs (in use or idle within HALL_IDLE_TTL).',
+         [({}, len(room_configs))]),
+        ('private_chat_history_messages', 'Private-chat messages kept for replay across all sessions.',
+         [({}, sum(len(h.messages) for h in private_chat_history.values()))]),
+        *_media_gauges(),
+        ('private_session_index_entries', 'Sids in the private-session reverse index.', [({}, len(private_session_by_sid))]),
+        ('state_audit_removed_entries', 'Orphaned state entries removed by the periodic audit since start.',
+         [({}, state_audit_removed)]),
+        ('sockets_in_rooms', 'Sockets assigned to a main or private room.', [({}, len(sid_to_room))]),
+        ('connected_sockets', 'Engine.IO connections open on this worker.', [({}, len(socketio.server.eio.sockets))]),
+        ('study_sessions_pending', 'Study sessions buffered for the next batched write.', [({}, len(_pending_study_sessions))]),
+        ('study_sessions_dropped', 'Study sessions dropped after repeated write failures or a full buffer since start.',
+         [({}, study_sessions_dropped)]),
+        ('profile_cache_entries', 'User profiles held in the in-process cache.', [({}, len(_profile_cache))]),
+        ('user_cache_entries', 'Login user snapshots held in the in-process cache.', [({}, len(_user_cache))]),
+        ('db_calls_in_flight', 'Database calls running or waiting for a DB executor thread.', [({}, db_executor.in_flight)]),
+        ('outbound_queue_max_depth', 'Largest number of packets waiting in a single socket send queue.', [({}, outbound.max_depth())]),
+        ('admin_overview_watchers', 'Admin room-overview pages connected to this worker.', [({}, len(_overview_watchers))]),
+        ('server_draining', '1 while this worker is draining connections before a restart.', [({}, int(draining))]),
+        ('room_snapshot_bytes', 'Size of the last room-state snapshot written to disk.', [({}, room_snapshot_bytes)]),
+        ('trace_dropped_events', 'Trace events dropped because the queue was full or the write failed.', [({}, tracer.dropped)]),
+    ]
+
+
+@metrics.counter_callback
+def _flow_control_counters():
+    return [
+        ('socket_events_dropped_total', 'Inbound Socket.IO events dropped by the rate limiter or size cap.',
+         [({'event': event, 'reason': reason}, n) for (event, reason), n in sorted(rate_limiter.dropped.items())]),
+        ('relays_dropped_total', 'Relays skipped because the receiving socket had a long send queue.',
+         [({'event': event}, n) for event, n in sorted(outbound.dropped.items())]),
+        ('socket_flow_disconnects_total', 'Sockets disconnected by flow control.',
+         [({'reason': 'rate_limited'}, rate_limiter.disconnects), ({'reason': 'slow_consumer'}, outbound.disconnects)]),
+    ]
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not METRICS_ENABLED or not METRICS_TOKEN:
+        abort(404)
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + METRICS_TOKEN):
+        abort(401)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 # ---------- SocketIO ----------
 
 @socketio.on('connect')
 def on_connect():
-    pass
+    if draining:
+        raise ConnectionRefusedError('server_draining')  # 再起動中。クライアントは少し待って別のプロセスへつなぎ直す
+    start_room_snapshots()
 
 
 @socketio.on('join_room')
@@ -346,110 +1328,111 @@ def on_join_room(data):
 
     # 個別ルーム（private_）の場合は従来どおり
     if req_room and req_room.startswith('private_'):
-        if not req_room or req_room not in private_rooms:
+        if req_room not in private_rooms:
             return
-        old_room = sid_to_room.get(sid)
-        if old_room and old_room != req_room:
-            leave_room(old_room)
-            if old_room in room_users and sid in room_users[old_room]:
-                del room_users[old_room][sid]
+        leave_current_room(sid, keep=req_room)
         join_room(req_room)
-        sid_to_room[sid] = req_room
-        if req_room not in room_users:
-            room_users[req_room] = {}
-        room_users[req_room][sid] = {"user_name": user_name, "role": role}
-        hand_raise_states.setdefault(req_room, {})[sid] = False
-        emit('hand_states', {"states": get_hand_states(req_room)}, room=sid)
+        with state_store.lock('rooms'):
+            private = private_rooms.get(req_room)
+            if private is None:
+                return
+            private.put(Participant(sid, user_name, role))
+            private_rooms[req_room] = private
+            update_room_summary(req_room, private)
+            sid_to_room[sid] = req_room
+        tracer.trace('app.py:on_join_room', 'private_room_join', session_id=req_room, sid=sid)
+        emit('hand_states', {"states": get_hand_states(private)}, room=sid)
         emit('user_joined', {"sid": sid, "user_name": user_name, "role": role}, room=req_room, include_self=False)
         return
 
-    # ----- メインルーム: 4人制限・サーバーが唯一の正解（Source of Truth） -----
-    room = None
+    # ----- 再接続: キープ中の席があれば同じ位置に戻す（ほかの参加者には sid の付け替えだけ通知） -----
+    reclaimed = reclaim_held_slot(user_id, sid, user_name, role, req_room if is_main_room(req_room) else None)
+    if reclaimed:
+        room, idx, old_sid = reclaimed
+        join_room(room)
+        state = build_room_state(room)
+        entry = find_wire_participant(state, sid)
+        emit_room_delta(room, 'participant_reconnected', {
+            'old_sid': old_sid, 'sid': sid, 'user_name': entry.get('n', user_name), 'role': entry.get('r', role),
+            'total_study_time_minutes': entry.get('t', 0),
+        }, skip_sid=sid)
+        emit_room_assigned(room, sid, idx == 0, state)
+        tracer.trace('app.py:on_join_room', 'main_room_slot_reclaimed', room_id=room, sid=sid, old_sid=old_sid)
+        return
 
-    # 1) 招待URL/セッションで指定されたルームIDがあれば、それを最優先で使用する
-    #    （最初の1人目の場合でも、そのIDで room_participants を初期化する）
-    if req_room and is_main_room(req_room):
-        if req_room in room_participants:
-            # 既存ルームが満室なら、新しいルームへ（5人目以降）
-            if len(room_participants[req_room]) >= 4:
-                req_room = None  # 5人目は別室へ
-            else:
-                room = req_room
-        else:
-            # まだ誰もいない指定ルーム → そのIDでルームを作成
-            room = req_room
-            room_participants[room] = []
+    # すでにこのルームに着席済み（個別指導が始まる前に取り消されて戻された等）なら、状態を送り直すだけ
+    if req_room and sid_to_room.get(sid) == req_room and is_main_room(req_room) and \
+            (main_rooms.get(req_room) or Room(req_room)).get(sid):
+        state = build_room_state(req_room)
+        emit_room_assigned(req_room, sid, state['host_sid'] == sid, state)
+        return
 
-    # 2) 空きがある既存ルームを探す（4未満のみ）
-    if not room:
-        for rid, plist in list(room_participants.items()):
-            if is_main_room(rid) and len(plist) < 4:
-                room = rid
-                break
+    # ----- メインルーム: 定員制（mesh は4人）・サーバーが唯一の正解（Source of Truth） -----
+    with state_store.lock('rooms'):
+        target = None
 
-    # 3) 見つからなければ新規ルーム（この人がホスト）
-    if not room:
-        room = secrets.token_hex(4)
-        room_participants[room] = []
+        # 1) 招待URL/セッションで指定されたルームIDがあれば、それを最優先で使用する
+        #    （最初の1人目の場合でも、そのIDでルームを作成する）
+        if req_room and is_main_room(req_room):
+            target = main_rooms.get(req_room) or new_main_room(req_room)
+            if target.is_full:
+                target = None  # 既存ルームが満室なら、新しいルームへ（定員+1人目以降）
 
-    plist = room_participants[room]
-    if len(plist) >= 4:
-        room = secrets.token_hex(4)
-        room_participants[room] = []
-        plist = room_participants[room]
+        # 2) 空きがある既存ルームを空席インデックスから取得（人数の多いルーム優先）
+        if target is None:
+            free_id = find_room_with_free_seat()
+            target = main_rooms.get(free_id) if free_id else None
 
-    old_room = sid_to_room.get(sid)
-    if old_room and old_room != room:
-        leave_room(old_room)
-    join_room(room)
-    sid_to_room[sid] = room
-
-    plist.append({
-        'sid': sid,
-        'user_name': user_name,
-        'role': role,
-        'user_id': user_id or None,
-        'user_db_id': user_db_id,
-        'connected': True,
-    })
-    room_users.setdefault(room, {})[sid] = {"user_name": user_name, "role": role}
-    hand_raise_states.setdefault(room, {})[sid] = False
+        # 3) 見つからなければ新規ルーム（この人がホスト）
+        if target is None or target.is_full:
+            target = Room(secrets.token_hex(4))
+
+        room = target.room_id
+        old_room = sid_to_room.get(sid)
+        if old_room and old_room != room:
+            leave_room(old_room)
+        join_room(room)
+        sid_to_room[sid] = room
+        target.participants.append(Participant(sid, user_name, role, user_id or None, user_db_id))
+        save_main_room(target)
 
-    is_host = (len(plist) == 1)
+    is_host = (len(target.participants) == 1)
     state = build_room_state(room)
-    # #region agent log
-    try:
-        _log_path = os.path.join(os.path.dirname(__file__), '.cursor', 'debug.log')
-        _plist_sids = [p.get('sid') for p in plist]
-        with open(_log_path, 'a', encoding='utf-8') as _f:
-            import json
-            _f.write(json.dumps({'location': 'app.py:on_join_room', 'message': 'main_room_join_emit_user_joined', 'data': {'room_id': room, 'joiner_sid': sid, 'plist_sids': _plist_sids, 'emit_to_room': room}, 'timestamp': __import__('time').time() * 1000, 'sessionId': 'debug-session', 'hypothesisId': 'H4'}) + '\n')
-    except Exception:
-        pass
-    # #endregion
-    join_total_min = _participant_total_study_minutes(user_db_id)
-    emit('room_assigned', {'room_id': room, 'is_host': is_host, 'participants': state['participants']}, room=sid)
-    emit('user_joined', {'sid': sid, 'user_name': user_name, 'role': role, 'total_study_time_minutes': join_total_min}, room=room, include_self=False)
-    emit('hand_states', {"states": get_hand_states(room)}, room=room)
+    tracer.trace('app.py:on_join_room', 'main_room_join', room_id=room, joiner_sid=sid,
+                 plist_sids=[p.sid for p in target.participants], is_host=is_host)
+    join_total_min = find_wire_participant(state, sid).get('t', 0)
+    # ほかの参加者には差分（user_joined）だけを送る。本人には rev つきの全体状態を送る
+    emit_room_delta(room, 'user_joined', {'sid': sid, 'user_name': user_name, 'role': role, 'total_study_time_minutes': join_total_min}, skip_sid=sid)
+    emit_room_assigned(room, sid, is_host, state)
 
 
 @socketio.on('request_room_state')
 def on_request_room_state(data):
-    """クライアントが現在の参加者リストを再取得（同期・古い情報リセット用）"""
+    """クライアントが現在の参加者リストを再取得（同期・古い情報リセット用）
+
+    data.rev（クライアントが適用済みの rev）があれば、それ以降の差分だけを順に送り直す。
+    差分ログから追いつけない場合と rev なしの場合はスナップショット（room_state）を返す。
+    """
     from flask import request as req
     sid = req.sid
     room_id = data.get('room_id') or sid_to_room.get(sid)
     if not room_id or not is_main_room(room_id):
         return
-    if room_id not in room_participants:
-        emit('room_state', {'participants': [], 'host_sid': None}, room=sid)
+    room = main_rooms.get(room_id)
+    if room is None:
+        emit('room_state', {'participants': [], 'host_sid': None, 'rev': 0}, room=sid)
         return
-    # 自分がこのルームにいるか確認（sid_to_room と plist の sid のいずれかで参加中）
-    plist = room_participants[room_id]
-    if not any(p.get('sid') == sid for p in plist):
+    # 自分がこのルームにいるか確認
+    if room.get(sid) is None:
         return
+    client_rev = data.get('rev')
+    if isinstance(client_rev, int):
+        deltas = get_room_deltas_since(room_id, client_rev)
+        if deltas is not None:
+            for event, payload in deltas:
+                emit(event, payload, room=sid)
+            return
     emit('room_state', build_room_state(room_id), room=sid)
-    emit('hand_states', {'states': get_hand_states(room_id)}, room=sid)
 
 
 @socketio.on('hand_raise')
@@ -458,11 +1441,22 @@ def on_hand_raise(data):
     raised = data.get('raised', False)
     sid = req.sid
     room = sid_to_room.get(sid)
-    if not room or room not in room_users:
+    if not room:
         return
-    hand_raise_states[room][sid] = raised
-    user_name = room_users[room][sid].get("user_name", "")
-    emit('hand_raise_update', {"sid": sid, "user_name": user_name, "raised": raised}, room=room)
+    ns = main_rooms if is_main_room(room) else private_rooms
+    with state_store.lock('rooms'):
+        members = ns.get(room)
+        participant = members.get(sid) if members else None
+        if participant is None:
+            return
+        participant.raised = raised
+        ns[room] = members
+        update_room_summary(room, members)
+    payload = {"sid": sid, "user_name": participant.user_name, "raised": raised}
+    if is_main_room(room):
+        emit_room_delta(room, 'hand_raise_update', payload)
+    else:
+        emit('hand_raise_update', payload, room=room)
 
 
 def _same_room(sid, target_sid):
@@ -474,12 +1468,15 @@ def _same_room(sid, target_sid):
     return r1 and r2 and r1 == r2
 
 
+# offer / answer / ice_candidate は受け取った dict をそのまま中継せず、必要なフィールドだけを詰め直す。
+# sender はクライアントの申告ではなくサーバーが知っている送信元 sid を入れる（なりすまし防止。target も送り返さない）
+
 @socketio.on('offer')
 def on_offer(data):
     from flask import request as req
     target = data.get('target')
     if target and _same_room(req.sid, target):
-        emit('offer', data, room=target)
+        emit('offer', {'sender': req.sid, 'description': data.get('description')}, room=target)
 
 
 @socketio.on('answer')
@@ -487,56 +1484,185 @@ def on_answer(data):
     from flask import request as req
     target = data.get('target')
     if target and _same_room(req.sid, target):
-        emit('answer', data, room=target)
+        emit('answer', {'sender': req.sid, 'description': data.get('description')}, room=target)
 
 
 @socketio.on('ice_candidate')
 def on_ice_candidate(data):
     from flask import request as req
     target = data.get('target')
-    if target and _same_room(req.sid, target):
-        emit('ice_candidate', data, room=target)
+    if target and _same_room(req.sid, target) and not outbound.should_drop(target, 'ice_candidate'):
+        emit('ice_candidate', {'sender': req.sid, 'candidate': data.get('candidate')}, room=target)
+
+
+# 1フレームで中継する ICE candidate の上限（超えた分は捨てる）
+MAX_ICE_BATCH = 64
+
+
+@socketio.on('ice_candidates')
+def on_ice_candidates(data):
+    """宛先ごとにクライアント側でまとめた ICE candidate を1回の emit で中継する。
+
+    入室直後は1ペアあたり数十件の candidate が出るため、ルーム確認と emit を1件ずつではなくまとめて行う。
+    """
+    from flask import request as req
+    target = data.get('target')
+    candidates = data.get('candidates')
+    if not target or not isinstance(candidates, list) or not candidates:
+        return
+    if _same_room(req.sid, target) and not outbound.should_drop(target, 'ice_candidates'):
+        emit('ice_candidates', {'sender': req.sid, 'candidates': candidates[:MAX_ICE_BATCH]}, room=target)
 
 
 @socketio.on('disconnect')
-def on_disconnect():
+def on_disconnect(reason=None):
     from flask import request as req
     record_study_time_if_entered()
     sid = req.sid
+    _overview_watchers.discard(sid)
+    media_reports.pop(sid, None)
     room = sid_to_room.pop(sid, None)
+    # 個別指導の当事者なら（個別ルーム入室前でも）セッションを終了し、相手をメインルームへ戻す
+    session_id = private_session_by_sid.get(sid)
+    if session_id:
+        private = close_private_session(session_id)
+        if private is not None:
+            emit('redirect_to_main_room', {'main_room': private.main_room}, room=private.other_sid(sid))
+            tracer.trace('app.py:on_disconnect', 'private_session_ended', session_id=session_id, sid=sid)
     if room:
         leave_room(room)
         if room.startswith('private_'):
-            for session_id, info in list(private_rooms.items()):
-                if info.get('admin_sid') == sid or info.get('student_sid') == sid:
-                    other_sid = info['student_sid'] if sid == info['admin_sid'] else info['admin_sid']
-                    emit('redirect_to_main_room', {'main_room': info['main_room']}, room=other_sid)
-                    del private_rooms[session_id]
-                    break
+            remove_private_participant(room, sid)
         else:
-            # メインルーム: 即座にルームから削除し、退出通知＋参加者リストを全員に再配布
-            left_name = (room_users.get(room, {}).get(sid) or {}).get('user_name', '') or '参加者'
-            if room in room_users and sid in room_users[room]:
-                del room_users[room][sid]
-            if room in hand_raise_states and sid in hand_raise_states[room]:
-                del hand_raise_states[room][sid]
-            emit('user_left', {'sid': sid, 'user_name': left_name}, room=room)
-
-            if room in room_participants:
-                plist = room_participants[room]
-                for idx, p in enumerate(plist):
-                    if p.get('sid') == sid:
-                        plist.pop(idx)
-                        if not plist:
-                            del room_participants[room]
-                        else:
-                            if idx == 0:
-                                new_host = plist[0]
-                                emit('host_changed', {
-                                    'new_host_sid': new_host['sid'],
-                                    'new_host_name': new_host.get('user_name', ''),
-                                }, room=room)
-                        break
+            # メインルーム: 再接続猶予があれば席をキープ（connected=False）し、なければ即座に退出させる
+            if hold_main_room_slot(room, sid):
+                emit_room_delta(room, 'participant_disconnected', {'sid': sid})
+                tracer.trace('app.py:on_disconnect', 'main_room_slot_held', room_id=room, sid=sid)
+            else:
+                finish_main_room_leave(room, sid)
+
+
+# ----- 再接続猶予（切断後も席・ホスト位置を一定時間キープ） -----
+RECONNECT_GRACE_SECONDS = int(os.environ.get('RECONNECT_GRACE_SECONDS', 30))
+# user_id -> { room_id, sid, expire_at }（切断中で席をキープしている参加者。expire_at は期限の UNIX 秒）
+held_slots = state_store.namespace('held_slots')
+# 期限切れ処理のタイマーホイール: 期限（UNIX 秒）-> [(room_id, sid), ...]
+# 参加者ごとにタイマーを立てず、1つのバックグラウンドタスクが毎秒その秒のバケットだけを処理する。
+# ホイールはキープしたワーカーのプロセス内にしかないので、そのワーカーが落ちた・再起動した場合は
+# audit_room_state（どのワーカーでも動く）が held_slots の expire_at を見て期限切れにする
+_slot_expiry_wheel = {}
+_slot_expiry_started = False
+
+
+def finish_main_room_leave(room, sid):
+    """メインルームから sid を外し、退出とホスト交代を全員に通知する（即時退出・猶予切れの両方で使う）。"""
+    with state_store.lock('rooms'):
+        target = main_rooms.get(room)
+        if target is None:
+            return
+        idx, left = target.remove(sid)
+        if left is None:
+            return
+        save_main_room(target)
+    remaining = len(target.participants)
+    if remaining:
+        emit_room_delta(room, 'user_left', {'sid': sid, 'user_name': left.user_name or '参加者'})
+    tracer.trace('app.py:finish_main_room_leave', 'main_room_leave', room_id=room, sid=sid, remaining=remaining)
+
+    if idx == 0 and remaining:
+        new_host = target.host
+        tracer.trace('app.py:finish_main_room_leave', 'host_changed', room_id=room, new_host_sid=new_host.sid)
+        emit_room_delta(room, 'host_changed', {
+            'new_host_sid': new_host.sid,
+            'new_host_name': new_host.user_name,
+        })
+
+
+def leave_current_room(sid, keep=None):
+    """sid を今いるルームから出す（メインルームなら退出・ホスト交代の通知まで行う）。keep と同じなら何もしない。"""
+    old_room = sid_to_room.get(sid)
+    if not old_room or old_room == keep:
+        return
+    leave_room(old_room)
+    if old_room.startswith('private_'):
+        remove_private_participant(old_room, sid)
+    else:
+        finish_main_room_leave(old_room, sid)
+
+
+def hold_main_room_slot(room, sid):
+    """切断した参加者の席を connected=False のまま残す。user_id がない・猶予 0 秒なら False。"""
+    if RECONNECT_GRACE_SECONDS <= 0:
+        return False
+    with state_store.lock('rooms'):
+        target = main_rooms.get(room)
+        entry = target.get(sid) if target else None
+        if entry is None or not entry.user_id:
+            return False
+        entry.connected = False
+        main_rooms[room] = target
+        update_room_summary(room, target)
+        expire_at = int(time.time()) + RECONNECT_GRACE_SECONDS
+        held_slots[entry.user_id] = {'room_id': room, 'sid': sid, 'expire_at': expire_at}
+    schedule_slot_expiry(room, sid, expire_at)
+    return True
+
+
+def schedule_slot_expiry(room, sid, expire_at):
+    """キープ中の席を expire_at（UNIX 秒）に期限切れにする。"""
+    global _slot_expiry_started
+    _slot_expiry_wheel.setdefault(expire_at, []).append((room, sid))
+    if not _slot_expiry_started:
+        _slot_expiry_started = True
+        socketio.start_background_task(_slot_expiry_loop)
+
+
+def _expire_held_slot(room, sid, user_id=None):
+    """キープ中の席を退出させる。user_id はルームに sid がもういないときに held_slots を消すため（監査用）。"""
+    target = main_rooms.get(room)
+    entry = target.get(sid) if target else None
+    user_id = entry.user_id if entry else user_id
+    held = held_slots.get(user_id) if user_id else None
+    if held and held.get('sid') == sid:
+        held_slots.pop(user_id, None)
+    if entry is None or entry.connected:
+        return  # すでに再接続済み・退出済み
+    finish_main_room_leave(room, sid)
+
+
+def _slot_expiry_loop():
+    while True:
+        socketio.sleep(1)
+        now = int(time.time())
+        for second in [t for t in _slot_expiry_wheel if t <= now]:
+            for room, sid in _slot_expiry_wheel.pop(second):
+                _expire_held_slot(room, sid)
+
+
+def reclaim_held_slot(user_id, sid, user_name, role, req_room=None):
+    """同じ user_id の再入室なら、キープ中の席（位置・ホスト・挙手状態）を新しい sid で引き継ぐ。
+
+    引き継いだ場合は (room_id, 席の位置, 旧sid) を返す。なければ None。
+    """
+    held = held_slots.get(user_id) if user_id else None
+    if not held or (req_room and req_room != held['room_id']):
+        return None
+    room, old_sid = held['room_id'], held['sid']
+    with state_store.lock('rooms'):
+        held_slots.pop(user_id, None)
+        target = main_rooms.get(room)
+        idx = target.index(old_sid) if target else None
+        if idx is None or target.participants[idx].connected:
+            return None
+        entry = target.participants[idx]
+        entry.sid = sid
+        entry.connected = True
+        entry.user_name = user_name or entry.user_name
+        entry.role = role
+        main_rooms[room] = target
+        update_room_summary(room, target)
+        sid_to_room[sid] = room
+    return room, idx, old_sid
 
 
 # ---------- Private Session ----------
@@ -549,12 +1675,19 @@ def on_start_private_session(data):
     room = sid_to_room.get(sid)
     if not room or not student_sid or room.startswith('private_'):
         return
-    if room_users.get(room, {}).get(sid, {}).get('role') != 'admin':
-        return
-    if student_sid not in room_users.get(room, {}):
+    main = main_rooms.get(room)
+    admin = main.get(sid) if main else None
+    if admin is None or admin.role != 'admin' or main.get(student_sid) is None:
         return
+    if sid in private_session_by_sid or student_sid in private_session_by_sid:
+        return  # どちらかが別のセッション中
     session_id = 'private_' + secrets.token_hex(8)
-    private_rooms[session_id] = {'main_room': room, 'admin_sid': sid, 'student_sid': student_sid}
+    private = private_rooms[session_id] = PrivateSession(session_id, room, sid, student_sid)
+    update_room_summary(session_id, private)
+    private_session_by_sid[sid] = session_id
+    private_session_by_sid[student_sid] = session_id
+    tracer.trace('app.py:on_start_private_session', 'private_session_started', session_id=session_id,
+                 main_room=room, admin_sid=sid, student_sid=student_sid)
     emit('redirect_to_private', {'session_id': session_id, 'main_room': room}, room=sid)
     emit('redirect_to_private', {'session_id': session_id, 'main_room': room}, room=student_sid)
 
@@ -568,29 +1701,18 @@ def on_join_private_room(data):
     role = data.get('role', 'student')
     if not session_id or session_id not in private_rooms:
         return
-    old_room = sid_to_room.get(sid)
-    if old_room:
-        leave_room(old_room)
-        if not old_room.startswith('private_'):
-            if old_room in room_users and sid in room_users[old_room]:
-                del room_users[old_room][sid]
-            if old_room in hand_raise_states and sid in hand_raise_states[old_room]:
-                del hand_raise_states[old_room][sid]
-            if is_main_room(old_room) and old_room in room_participants:
-                plist = room_participants[old_room]
-                for idx, p in enumerate(plist):
-                    if p.get('sid') == sid:
-                        plist.pop(idx)
-                        if not plist:
-                            del room_participants[old_room]
-                        break
-            emit('user_left', {'sid': sid}, room=old_room)
+    leave_current_room(sid, keep=session_id)
     join_room(session_id)
-    sid_to_room[sid] = session_id
-    if session_id not in room_users:
-        room_users[session_id] = {}
-    room_users[session_id][sid] = {'user_name': user_name, 'role': role}
-    participants = [{'sid': s, 'user_name': room_users[session_id][s].get('user_name', ''), 'role': room_users[session_id][s].get('role', '')} for s in room_users[session_id]]
+    with state_store.lock('rooms'):
+        private = private_rooms.get(session_id)
+        if private is None:
+            return
+        private.put(Participant(sid, user_name, role))
+        private_rooms[session_id] = private
+        update_room_summary(session_id, private)
+        sid_to_room[sid] = session_id
+    tracer.trace('app.py:on_join_private_room', 'private_room_join', session_id=session_id, sid=sid)
+    participants = [{'sid': p.sid, 'user_name': p.user_name, 'role': p.role} for p in private.participants]
     emit('private_participants', {'participants': participants}, room=session_id)
     emit('private_audio_sync', {}, room=session_id)
 
@@ -611,12 +1733,152 @@ def on_end_private_session(data):
     session_id = sid_to_room.get(sid)
     if not session_id or not session_id.startswith('private_') or session_id not in private_rooms:
         return
-    info = private_rooms[session_id]
-    main_room = info['main_room']
+    main_room = private_rooms[session_id].main_room
     emit('redirect_to_main_room', {'main_room': main_room}, room=session_id)
-    if session_id in room_users:
-        del room_users[session_id]
-    del private_rooms[session_id]
+    close_private_session(session_id)
+    tracer.trace('app.py:on_end_private_session', 'private_session_ended', session_id=session_id, sid=sid)
+
+
+def close_private_session(session_id):
+    """個別指導セッションに関する状態をすべて消す（終了・切断の両方で使う）。
+
+    private_rooms と逆引きに加え、まだ個別ルームにいる sid の sid_to_room と Socket.IO のルーム所属も外す。
+    消した PrivateSession を返す（なければ None）。
+    """
+    private = private_rooms.pop(session_id, None)
+    remove_room_summary(session_id)
+    private_chat_history.pop(session_id, None)
+    if private is None:
+        return None
+    sids = {private.admin_sid, private.student_sid} | {p.sid for p in private.participants}
+    for s in sids:
+        if private_session_by_sid.get(s) == session_id:
+            del private_session_by_sid[s]
+        if sid_to_room.get(s) == session_id:
+            del sid_to_room[s]
+    socketio.close_room(session_id)
+    return private
+
+
+def remove_private_participant(session_id, sid):
+    """個別ルームから sid を外す（セッション自体は残す）。"""
+    with state_store.lock('rooms'):
+        private = private_rooms.get(session_id)
+        if private is not None and private.remove(sid)[1] is not None:
+            private_rooms[session_id] = private
+            update_room_summary(session_id, private)
+
+
+# ----- 状態の定期監査（取りこぼしで残ったエントリを掃除し、長期稼働でもメモリを一定に保つ） -----
+STATE_AUDIT_INTERVAL = int(os.environ.get('STATE_AUDIT_INTERVAL', 600))  # 秒。0 で無効
+state_audit_removed = 0  # 起動以降に監査で消したエントリ数（/metrics に出す）
+
+
+def audit_room_state():
+    """どこからも参照されなくなった状態を消し、消した件数を返す。
+
+    - 当事者が2人とも切断済み（sid_to_room にいない）の個別指導セッション
+    - 存在しないセッションを指す逆引き、存在しないルームを指す sid_to_room
+    - 参加者のいないメインルーム、存在しないルームを指す空席インデックス・一覧の要約
+    - 存在しないセッションのチャット履歴、ルームにいない sid の映像品質の報告
+    - 空のまま HALL_IDLE_TTL 秒たった大部屋の設定
+    - 期限（expire_at）を過ぎたキープ中の席（キープしたワーカーのタイマーが失われた場合。退出として全員に通知する）
+    """
+    global state_audit_removed
+    removed = 0
+    now = time.time()
+    with state_store.lock('rooms'):
+        for session_id, private in list(private_rooms.items()):
+            if private.admin_sid not in sid_to_room and private.student_sid not in sid_to_room:
+                close_private_session(session_id)
+                removed += 1
+        for sid, session_id in list(private_session_by_sid.items()):
+            if session_id not in private_rooms:
+                private_session_by_sid.pop(sid, None)
+                removed += 1
+        for sid, room in list(sid_to_room.items()):
+            if room not in private_rooms and room not in main_rooms:
+                sid_to_room.pop(sid, None)
+                removed += 1
+        for room_id, room in list(main_rooms.items()):
+            if not room.participants:
+                remove_main_room(room_id)
+                removed += 1
+        for room_id in list(_free_room_bucket):
+            if room_id not in main_rooms:
+                update_free_room_index(room_id)
+                removed += 1
+        for room_id in list(room_summaries):
+            if room_id not in main_rooms and room_id not in private_rooms:
+                remove_room_summary(room_id)
+                removed += 1
+        for session_id in list(private_chat_history):
+            if session_id not in private_rooms:
+                private_chat_history.pop(session_id, None)
+                removed += 1
+        for sid in list(media_reports):
+            if sid not in sid_to_room:
+                media_reports.pop(sid, None)
+                removed += 1
+        if HALL_IDLE_TTL > 0:
+            expire_before = time.time() - HALL_IDLE_TTL
+            for room_id, config in list(room_configs.items()):
+                if room_id not in main_rooms and config.get('idle_since', 0) < expire_before:
+                    room_configs.pop(room_id, None)
+                    removed += 1
+        # expire_at のない記録（期限を持たせる前の形式）も期限切れとして扱う
+        expired = [(user_id, held['room_id'], held['sid']) for user_id, held in held_slots.items()
+                   if held.get('expire_at', 0) <= now]
+    # 退出の処理は 'rooms' のロックを取り直すので、ロックの外で行う
+    for user_id, room_id, sid in expired:
+        _expire_held_slot(room_id, sid, user_id)
+        removed += 1
+    state_audit_removed += removed
+    return removed
+
+
+def _state_audit_loop():
+    while True:
+        socketio.sleep(STATE_AUDIT_INTERVAL)
+        removed = audit_room_state()
+        if removed:
+            tracer.trace('app.py:_state_audit_loop', 'state_audit_removed', removed=removed)
+
+
+def private_user_name(session_id, sid):
+    private = private_rooms.get(session_id)
+    participant = private.get(sid) if private else None
+    return participant.user_name if participant else ''
+
+
+# ----- 個別指導チャットの履歴（遅れて入室した・入り直した人が見逃した発言を取り直せるように） -----
+# セッションごとに直近の発言だけを持つ（件数・バイト数の上限を超えたら古いものから捨てる）。画像は添付IDだけを持ち、
+# 取り直すときは /attachments の URL を返す。セッションが終わったら close_private_session で消す。
+PRIVATE_CHAT_HISTORY_MESSAGES = int(os.environ.get('PRIVATE_CHAT_HISTORY_MESSAGES', 200))
+PRIVATE_CHAT_HISTORY_BYTES = int(os.environ.get('PRIVATE_CHAT_HISTORY_BYTES', 64 * 1024))  # 名前と本文の UTF-8 バイト数
+# private session_id -> ChatHistory
+private_chat_history = state_store.namespace('private_chat_history', model=ChatHistory)
+
+
+def chat_message_payload(message):
+    """ChatHistory の1件を private_chat / private_chat_image と同じ形の dict にする。"""
+    message_id, sender_sid, user_name, kind, body, sent_at = message
+    payload = {'id': message_id, 'sender_sid': sender_sid, 'user_name': user_name, 'sent_at': sent_at}
+    if kind == 'image':
+        payload.update(attachment_id=body, url=url_for('get_attachment', attachment_id=body))
+    else:
+        payload['text'] = body
+    return payload
+
+
+def record_private_chat(session_id, sid, user_name, kind, body):
+    """発言を履歴に足し、id つきの配信用 dict を返す。"""
+    with state_store.lock('private_chat'):
+        history = private_chat_history.get(session_id) or ChatHistory()
+        message = history.append(sid, user_name, kind, body,
+                                 PRIVATE_CHAT_HISTORY_MESSAGES, PRIVATE_CHAT_HISTORY_BYTES)
+        private_chat_history[session_id] = history
+    return chat_message_payload(message)
 
 
 @socketio.on('private_chat')
@@ -624,31 +1886,433 @@ def on_private_chat(data):
     from flask import request as req
     sid = req.sid
     session_id = sid_to_room.get(sid)
-    if not session_id or not session_id.startswith('private_'):
+    if not session_id or not session_id.startswith('private_') or session_id not in private_rooms:
+        return
+    text = data.get('text')
+    if not isinstance(text, str) or not text:
         return
-    user_name = room_users.get(session_id, {}).get(sid, {}).get('user_name', '')
-    # 他者には room で配信。送信者本人には room=sid で返す（クライアントで sender_sid 一致時は表示しない＝二重表示防止）
-    emit('private_chat', {'sender_sid': sid, 'user_name': user_name, 'text': data.get('text', '')}, room=session_id, include_self=False)
-    emit('private_chat', {'sender_sid': sid, 'user_name': user_name, 'text': data.get('text', '')}, room=sid)
+    payload = record_private_chat(session_id, sid, private_user_name(session_id, sid), 'text', text)
+    # 他者には room で配信。送信者本人には room=sid で返す（クライアントは id だけ控えて表示しない＝二重表示防止）
+    emit('private_chat', payload, room=session_id, include_self=False)
+    emit('private_chat', payload, room=sid)
 
 
 @socketio.on('private_chat_image')
 def on_private_chat_image(data):
+    """画像は /attachments へアップロード済みの ID だけを受け取り、相手にはその URL を配信する。
+
+    送信者には画像を送り返さず、ack（コールバックの戻り値）だけを返す。履歴には添付IDだけを残す。
+    """
     from flask import request as req
     sid = req.sid
     session_id = sid_to_room.get(sid)
-    if not session_id or not session_id.startswith('private_'):
+    if not session_id or not session_id.startswith('private_') or session_id not in private_rooms:
+        return {'ok': False}
+    user_name = private_user_name(session_id, sid)
+    attachment_id = data.get('attachment_id')
+    if attachment_id:
+        if not attachment_exists(attachment_id):
+            return {'ok': False, 'error': 'not_found'}
+        payload = record_private_chat(session_id, sid, user_name, 'image', attachment_id)
+    else:
+        # 旧クライアント（data_url 直送）との互換。サイズ上限を超えるものは破棄し、履歴にも残さない
+        data_url = data.get('data_url', '')
+        if not data_url or len(data_url) > SOCKET_MAX_IMAGE_BYTES:
+            return {'ok': False, 'error': 'too_large'}
+        payload = {'sender_sid': sid, 'user_name': user_name, 'data_url': data_url}
+    emit('private_chat_image', payload, room=session_id, include_self=False)
+    return {'ok': True, 'attachment_id': attachment_id, 'id': payload.get('id')}
+
+
+@socketio.on('private_chat_history')
+def on_private_chat_history(data=None):
+    """履歴のうち after（クライアントが最後に受け取った id）より新しい発言を ack で返す。
+
+    truncated は、after の次の発言がすでに上限で捨てられていて、見逃した分を全部は返せなかったとき True。
+    """
+    from flask import request as req
+    session_id = sid_to_room.get(req.sid)
+    if not session_id or not session_id.startswith('private_') or session_id not in private_rooms:
+        return {'ok': False}
+    try:
+        after = max(0, int((data or {}).get('after') or 0))
+    except (TypeError, ValueError):
+        after = 0
+    history = private_chat_history.get(session_id)
+    if history is None:
+        return {'ok': True, 'messages': [], 'last_id': after, 'truncated': False}
+    messages = [chat_message_payload(m) for m in history.after(after)]
+    return {'ok': True, 'messages': messages, 'last_id': history.next_id - 1,
+            'truncated': history.first_id > after + 1}
+
+
+# ---------- 映像の送信品質（getStats の要約 → 送信ごとのエンコード上限） ----------
+# クライアントが MEDIA_STATS_INTERVAL 秒ごとに送る要約（media_stats）を sid ごとに持ち、送信ごとの上限を決めて
+# （media_quality.py。相手の受信の報告も見る）、変わったときだけ encoding_hints でそのクライアントへ送る。
+# 集めた値はルームごとにまとめて /admin/media-stats と /metrics で見られる。
+MEDIA_STATS_INTERVAL = int(os.environ.get('MEDIA_STATS_INTERVAL', 5))  # 秒。0 で無効（クライアントは送らない）
+MEDIA_STATS_MAX_AGE = 3 * MEDIA_STATS_INTERVAL  # 秒。これより古い報告は集計・判断に使わない
+MEDIA_HALL_RECEIVERS = 16  # 大部屋の送信の判断に読む受信側の報告の数（入室順に先頭から）
+# sid -> MediaReport（直近の報告と送信ごとの段）
+media_reports = state_store.namespace('media_reports', model=MediaReport)
+
+
+def fresh_media_reports(now=None):
+    """MEDIA_STATS_MAX_AGE 秒以内の報告をルームごとに返す: room_id -> { sid: MediaReport }。"""
+    now = time.time() if now is None else now
+    by_room = {}
+    for sid, report in media_reports.items():
+        if now - report.at <= MEDIA_STATS_MAX_AGE:
+            by_room.setdefault(report.room_id, {})[sid] = report
+    return by_room
+
+
+def _media_gauges():
+    reports = [r for room in fresh_media_reports().values() for r in room.values()]
+    limited = {reason: 0 for reason in ('cpu', 'bandwidth', 'other')}
+    levels = {}
+    for report in reports:
+        for sent in report.outbound.values():
+            if sent[3] in limited:
+                limited[sent[3]] += 1
+        for level, _ in report.levels.values():
+            levels[level] = levels.get(level, 0) + 1
+    return [
+        ('media_reporting_clients', 'Clients that sent media stats recently.', [({}, len(reports))]),
+        ('media_quality_limited_senders', 'Outgoing video streams limited by the encoder (qualityLimitationReason).',
+         [({'reason': reason}, n) for reason, n in limited.items()]),
+        ('media_sender_quality_level', 'Outgoing video streams by assigned quality level (0 = best).',
+         [({'level': level}, n) for level, n in sorted(levels.items())]),
+    ]
+
+
+@socketio.on('media_stats')
+def on_media_stats(data):
+    from flask import request as req
+    sid = req.sid
+    room_id = sid_to_room.get(sid)
+    if not MEDIA_STATS_INTERVAL or not room_id:
+        return
+    report = MediaReport.parse(room_id, data)
+    if report is None or not (report.outbound or report.inbound):
         return
-    user_name = room_users.get(session_id, {}).get(sid, {}).get('user_name', '')
-    emit('private_chat_image', {'sender_sid': sid, 'user_name': user_name, 'data_url': data.get('data_url', '')}, room=session_id, include_self=False)
-    emit('private_chat_image', {'sender_sid': sid, 'user_name': user_name, 'data_url': data.get('data_url', '')}, room=sid)
+    with state_store.lock('media'):
+        previous = media_reports.get(sid)
+        if previous is not None and previous.room_id != room_id:
+            previous = None  # ルームを移った（個別指導との行き来）なら段は基準からやり直す
+        receivers = {}
+        for peer in report.outbound:
+            if peer == 'sfu':
+                # 大部屋: 中継サーバーの先で受け取っているのは同じルームのほかの参加者
+                room = main_rooms.get(room_id)
+                sids = [p.sid for p in room.participants if p.sid != sid][:MEDIA_HALL_RECEIVERS] if room else []
+            else:
+                sids = [peer]
+            others = (media_reports.get(other_sid) for other_sid in sids)
+            receivers[peer] = [other for other in others if other is not None and other.room_id == room_id
+                               and report.at - other.at <= MEDIA_STATS_MAX_AGE]
+        hints = report.update_levels(sid, previous, receivers)
+        media_reports[sid] = report
+    if hints != (previous.hints if previous else {}):
+        emit('encoding_hints', {'h': hints}, room=sid)
+
+
+@app.route('/admin/media-stats')
+@login_required
+def admin_media_stats():
+    """ルームごとの映像の送受信の状況（直近 MEDIA_STATS_MAX_AGE 秒の報告の集計）。"""
+    if session.get('role') != 'admin':
+        abort(403)
+    rooms = {room_id: summarize_media_reports(reports) for room_id, reports in fresh_media_reports().items()}
+    return jsonify({'interval': MEDIA_STATS_INTERVAL, 'rooms': rooms})
+
+
+# ---------- 管理者向けのルーム一覧（/admin/rooms） ----------
+# 一覧はルームを書き戻すたびに差し替えている要約（room_summaries）だけから作り、ルーム・参加者の dict は走査しない。
+# 変更があったときだけ ADMIN_OVERVIEW_INTERVAL 秒に1回作り直し、見ている管理者全員に1回の emit でまとめて配る
+# （開いている画面がいくつあっても作り直す回数は同じ）。
+ADMIN_OVERVIEW_INTERVAL = float(os.environ.get('ADMIN_OVERVIEW_INTERVAL', 2))  # 秒
+ADMIN_OVERVIEW_ROOM = 'admin_room_overview'  # 一覧を見ている管理者の Socket.IO ルーム
+_overview_watchers = set()  # このワーカーに接続して一覧を見ている sid
+_overview_cache = None      # (rev, payload)。rev が進むまで作り直さない
+_overview_started = False
+
+
+@app.route('/admin/rooms')
+@login_required
+def admin_rooms():
+    if session.get('role') != 'admin':
+        abort(403)
+    halls = [{'id': room_id, 'capacity': config['capacity'], 'in_use': room_id in main_rooms}
+             for room_id, config in sorted(room_configs.items(), key=lambda item: item[1].get('idle_since', 0))]
+    return render_template('admin_rooms.html', sfu_enabled=bool(SFU_URL), halls=halls,
+                           sfu_room_capacity=SFU_ROOM_CAPACITY, sfu_max_capacity=SFU_MAX_CAPACITY)
+
+
+@app.route('/admin/rooms', methods=['POST'])
+@login_required
+def admin_create_room():
+    """大部屋（SFU）を作って管理者をそこへ入室させる。招待URL（/room/<room_id>）で参加者を呼ぶ。"""
+    if session.get('role') != 'admin' or not SFU_URL:
+        abort(403)
+    try:
+        capacity = int(request.form.get('capacity') or SFU_ROOM_CAPACITY)
+    except ValueError:
+        capacity = SFU_ROOM_CAPACITY
+    room_id = 'hall_' + secrets.token_hex(4)
+    room_configs[room_id] = {'mode': 'sfu', 'capacity': max(2, min(capacity, SFU_MAX_CAPACITY)), 'idle_since': time.time()}
+    return redirect(url_for('room_by_id', room_id=room_id))
 
 
-with app.app_context():
+@app.route('/admin/rooms/<room_id>/delete', methods=['POST'])
+@login_required
+def admin_delete_room(room_id):
+    """大部屋の設定を消す。入室中の人がいればそのルームは空になるまで続き、その後の招待URLは通常のルームになる。"""
+    if session.get('role') != 'admin':
+        abort(403)
+    room_configs.pop(room_id, None)
+    return redirect(url_for('admin_rooms'))
+
+
+def build_room_overview():
+    """全メインルーム・個別指導セッションの一覧（人数・接続・挙手・開始時刻）。同じ rev の間はキャッシュを返す。"""
+    global _overview_cache
+    rev = overview_revisions.get('all', 0)
+    if _overview_cache is not None and _overview_cache[0] == rev:
+        return _overview_cache[1]
+    rooms, sessions = [], []
+    participants = connected = raised = 0
+    for room_id, (kind, created_at, members, *extra) in room_summaries.items():
+        entry = {'id': room_id, 'created_at': created_at, 'participants': [
+            {'user_name': name, 'role': role, 'connected': is_connected, 'raised': is_raised}
+            for name, role, is_connected, is_raised in members]}
+        if kind == 'private':
+            entry['main_room'] = extra[0]
+            sessions.append(entry)
+            continue
+        entry['capacity'], entry['mode'] = extra or (MAX_ROOM_SIZE, 'mesh')  # 定員・mode を持たない古い行は mesh
+        rooms.append(entry)
+        participants += len(members)
+        connected += sum(1 for m in members if m[2])
+        raised += sum(1 for m in members if m[3])
+    rooms.sort(key=lambda e: e['created_at'])
+    sessions.sort(key=lambda e: e['created_at'])
+    payload = {
+        'rev': rev,
+        'capacity': MAX_ROOM_SIZE,
+        'rooms': rooms,
+        'private_sessions': sessions,
+        'totals': {'rooms': len(rooms), 'participants': participants, 'connected': connected,
+                   'raised': raised, 'private_sessions': len(sessions)},
+    }
+    _overview_cache = (rev, payload)
+    return payload
+
+
+@socketio.on('watch_room_overview')
+def on_watch_room_overview(data=None):
+    """管理者の一覧画面が接続したら呼ぶ。現在の一覧をすぐ返し、以降は変更があるたびに（間引いて）配信する。"""
+    global _overview_started
+    from flask import request as req
+    if session.get('role') != 'admin':
+        return {'ok': False, 'error': 'forbidden'}
+    join_room(ADMIN_OVERVIEW_ROOM)
+    _overview_watchers.add(req.sid)
+    if not _overview_started:
+        _overview_started = True
+        socketio.start_background_task(_room_overview_loop)
+    emit('room_overview', dict(build_room_overview(), generated_at=time.time()), room=req.sid)
+    return {'ok': True}
+
+
+def _room_overview_loop():
+    while True:
+        socketio.sleep(ADMIN_OVERVIEW_INTERVAL)
+        if not _overview_watchers:
+            continue
+        rev = overview_revisions.get('all', 0)
+        # 複数ワーカー時は同じ rev を配信するのは1ワーカーだけ（emit はメッセージキュー経由で全ワーカーの管理者に届く）
+        with state_store.lock('overview'):
+            if overview_revisions.get('pushed', 0) >= rev:
+                continue
+            overview_revisions['pushed'] = rev
+        socketio.emit('room_overview', dict(build_room_overview(), generated_at=time.time()), to=ADMIN_OVERVIEW_ROOM)
+
+
+# ---------- 再起動（ルーム状態のスナップショットと接続のドレイン） ----------
+# STATE_STORE_URL なし（プロセス内 dict）のときだけ、メインルームの状態を SNAPSHOT_INTERVAL 秒ごとと停止時にファイルへ書く。
+# 起動後の最初の接続で、SNAPSHOT_MAX_AGE 秒以内のスナップショットがあれば user_id のある参加者の席を切断中として戻し、
+# RESTORE_GRACE_SECONDS 秒のあいだ同じ user_id の再入室を待つ（再接続猶予と同じ held_slots を使う）。
+SNAPSHOT_ENABLED = not STATE_STORE_URL and os.environ.get('SNAPSHOT_ENABLED', '1') == '1'
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH') or os.path.join(app.instance_path, 'room-snapshot.json')
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 30))  # 秒。0 で停止時だけ
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', 300))  # 秒。これより古いスナップショットは読まない
+RESTORE_GRACE_SECONDS = int(os.environ.get('RESTORE_GRACE_SECONDS', 60))
+# SIGTERM を受けたら新しい接続を断り、既存の接続を DRAIN_SECONDS 秒に散らして切る
+# （クライアントは自動で再接続する。一斉に切ると新しいプロセスへの再接続・入室が同時に集中する）
+DRAIN_SECONDS = float(os.environ.get('DRAIN_SECONDS', 10))
+draining = False
+room_snapshot_bytes = 0  # 最後に書いたスナップショットの大きさ（/metrics に出す）
+_snapshot_started = False  # 接続を受けたプロセス（サーバー）でだけ True になる
+
+
+def save_room_snapshot():
+    """メインルーム・rev・参加者のプロフィール（キャッシュにある分）をスナップショットに書く。"""
+    global room_snapshot_bytes
+    rooms = [room for room in main_rooms.values() if room.participants]
+    uids = {_to_user_db_id(p.user_db_id) for room in rooms for p in room.participants}
+    profiles = {uid: _profile_cache[uid][1] for uid in uids if uid in _profile_cache}
+    try:
+        room_snapshot_bytes = write_snapshot(
+            SNAPSHOT_PATH, [room.to_json() for room in rooms],
+            {room.room_id: room_revisions.get(room.room_id, 0) for room in rooms}, profiles)
+    except OSError as e:
+        tracer.trace('app.py:save_room_snapshot', 'room_snapshot_failed', error=str(e))
+
+
+def restore_room_snapshot():
+    """スナップショットのメインルームを戻し、戻した席の数を返す。席はすべて切断中（キープ）として扱う。"""
+    data = read_snapshot(SNAPSHOT_PATH, SNAPSHOT_MAX_AGE)
+    if data is None or RESTORE_GRACE_SECONDS <= 0:
+        return 0
+    # 再入室のたびに DB を引かないよう、プロフィールのキャッシュも温めておく
+    for uid, profile in (data.get('profiles') or {}).items():
+        _cache_user_profile(int(uid), profile)
+    revs = data.get('revs') or {}
+    held = []
+    expire_at = int(time.time()) + RESTORE_GRACE_SECONDS
+    with state_store.lock('rooms'):
+        for raw in data.get('rooms') or []:
+            room = Room.from_json(raw)
+            room.participants = [p for p in room.participants if p.user_id]
+            if not room.participants or room.room_id in main_rooms:
+                continue
+            for p in room.participants:
+                p.connected = False
+                held_slots[p.user_id] = {'room_id': room.room_id, 'sid': p.sid, 'expire_at': expire_at}
+                held.append((room.room_id, p.sid))
+            save_main_room(room)
+            room_revisions[room.room_id] = int(revs.get(room.room_id, 0))
+    for room_id, sid in held:
+        schedule_slot_expiry(room_id, sid, expire_at)
+    return len(held)
+
+
+def _snapshot_loop():
+    while True:
+        socketio.sleep(SNAPSHOT_INTERVAL)
+        if not draining:
+            save_room_snapshot()
+
+
+def _snapshot_at_exit():
+    if not draining:  # ドレインした場合は、切断を始める前の状態を書き済み
+        save_room_snapshot()
+
+
+def start_room_snapshots():
+    """スナップショットから席を戻し、定期・停止時の書き込みを始める（最初の接続で1回だけ）。
+
+    import 時には行わない（flask --app app init-db / build-assets やベンチのスクリプトが、
+    席を戻してキープのタイマーを始めたり、スナップショットを書き換えたりしないように）。
+    """
+    global _snapshot_started
+    if _snapshot_started or not SNAPSHOT_ENABLED:
+        return
+    _snapshot_started = True
+    restored = restore_room_snapshot()
+    if restored:
+        tracer.trace('app.py:start_room_snapshots', 'room_snapshot_restored', seats=restored)
+    atexit.register(_snapshot_at_exit)
+    if SNAPSHOT_INTERVAL > 0:
+        socketio.start_background_task(_snapshot_loop)
+
+
+def start_draining():
+    """新しい接続を断り、既存の接続をバックグラウンドで順に切る（2回目以降は何もしない）。"""
+    global draining
+    if draining:
+        return
+    draining = True
+    socketio.start_background_task(_drain_connections)
+
+
+def _drain_connections():
+    if _snapshot_started:
+        save_room_snapshot()
+    sockets = list(socketio.server.eio.sockets.values())
+    random.shuffle(sockets)
+    tracer.trace('app.py:_drain_connections', 'drain_started', sockets=len(sockets))
+    interval = DRAIN_SECONDS / len(sockets) if sockets else 0
+    for sock in sockets:
+        if not sock.closed:
+            sock.close(wait=False, abort=True)
+        if interval > 0:
+            socketio.sleep(interval)
+    flush_study_sessions()
+    tracer.flush()
+    if _previous_sigterm == signal.SIG_DFL:
+        # gunicorn なしで起動している場合は、ドレインが終わってから本来の SIGTERM（終了）に戻す
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def _on_sigterm(signum, frame):
+    start_draining()
+    if callable(_previous_sigterm):
+        _previous_sigterm(signum, frame)  # gunicorn のワーカーは graceful_timeout まで既存の接続を待って終了する
+
+
+try:
+    _previous_sigterm = signal.signal(signal.SIGTERM, _on_sigterm)
+except ValueError:  # メインスレッド以外で import された（シグナルを受けられない）
+    _previous_sigterm = None
+
+
+# すべての @socketio.on の定義より後で計測を差し込み、その外側で流量制限をかける（捨てたイベントは処理時間に含めない）
+if METRICS_ENABLED:
+    metrics.instrument_socketio(socketio)
+rate_limiter.instrument_socketio(socketio)
+if outbound.disconnect_depth > 0:
+    socketio.start_background_task(outbound.run, float(os.environ.get('OUTBOUND_SWEEP_INTERVAL', 2)))
+if STATE_AUDIT_INTERVAL > 0:
+    socketio.start_background_task(_state_audit_loop)
+if LEADERBOARD_REFRESH > 0:
+    socketio.start_background_task(_leaderboard_loop)
+
+# ---------- スキーマ作成（flask --app app init-db） ----------
+# テーブル・インデックスの確認はデプロイ時に1回だけ行い、ワーカーの起動（スケールアウト）ごとには行わない。
+# SQLite（ローカル開発）では従来どおり起動時に作る。DB_INIT_ON_START=1 / 0 で明示的に切り替えられる
+DB_INIT_ON_START = os.environ.get('DB_INIT_ON_START', '1' if db_url.startswith('sqlite') else '0') == '1'
+
+
+def init_db():
     db.create_all()
+    users_total_study_time_index.create(db.engine, checkfirst=True)
+    # study_rank_buckets を作る前からいるユーザーの分を1回だけ数えて入れる（以降は学習記録の書き込みで移し替える）
+    if db.session.scalar(db.select(db.func.count()).select_from(StudyRankBucket)) == 0:
+        db.session.execute(db.insert(StudyRankBucket).from_select(
+            ['minutes', 'users'],
+            db.select(User.total_study_time, db.func.count())
+            .where(User.total_study_time > 0)
+            .group_by(User.total_study_time)))
+        db.session.commit()
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """テーブルとインデックスを作成する（既にあれば何もしない）。"""
+    init_db()
+    print('database schema is up to date')
+
+
+if DB_INIT_ON_START:
+    with app.app_context():
+        init_db()
 
 if __name__ == '__main__':
     # ローカル開発時のみ（Render では gunicorn で起動する）
     port = int(os.environ.get("PORT", 10000))
+    asset_pipeline.auto_rebuild = True  # 開発中は static/ を編集したらそのまま反映する
     print("--- 他端末でカメラを使う場合: README.md の「他端末からアクセスする場合（HTTPS）」を参照 ---")
     socketio.run(app, debug=True, port=port, host='0.0.0.0', allow_unsafe_werkzeug=True)
@@ -0,0 +1,295 @@
+"""
+静的ファイル（CSS / JS）の配信用ビルド（ビルドツールなし）
+
+static/ の CSS・JS を縮小し、いくつかはまとめて1ファイルにし（BUNDLES）、内容のハッシュを入れた名前
+（css/style.3f2a9c01de.css）を付ける。名前が内容で変わるので、ブラウザには1年間・immutable でキャッシュさせられる
+（中身を変えれば URL が変わる）。gzip と brotli（brotli パッケージがあるとき）の圧縮版も先に作っておき、
+配信時は Accept-Encoding に合うものをメモリからそのまま返す。
+
+ビルド結果は ASSET_DIR に書き出す（ハッシュ付きのファイル・.gz・.br と manifest.json）。
+manifest.json には元ファイルの SHA-256 を入れておき、元ファイルと合っていれば次の起動では作り直さずに読むだけにする。
+デプロイ時に `flask --app app build-assets` で作っておけば、ワーカーは起動後に縮小・圧縮をしない。
+
+縮小は安全側に倒した簡易なもの: CSS はコメントと余分な空白、JS はコメントと行頭・行末の空白・空行だけを消す
+（JS の改行は残すので、自動セミコロン挿入の結果は変わらない）。
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+MANIFEST_VERSION = 1
+# 配信名 -> 元ファイル（static/ からの相対パス、この順につなげる）。room.bundle.js は templates/room.html が読む。
+# ここにない CSS・JS は1ファイルずつ同じ名前で配信する
+BUNDLES = {
+    'js/room.bundle.js': ['js/sfu.js', 'js/room.js'],
+}
+EXTENSIONS = ('.css', '.js')
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+HASH_LENGTH = 10
+
+
+def minify_css(text):
+    """コメントと余分な空白を消す（文字列の中は触らない）。"""
+    # 文字列とその間のコード片に分ける（コメントは空白にしてから前後のコード片とつなげる）
+    chunks = ['']
+    for token in re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/)', text, flags=re.S):
+        if token[:1] in ('"', "'"):
+            chunks += [token, '']
+        else:
+            chunks[-1] += ' ' if token.startswith('/*') else token
+    out = []
+    for i, chunk in enumerate(chunks):
+        if i % 2:
+            out.append(chunk)
+            continue
+        chunk = re.sub(r'\s+', ' ', chunk)
+        chunk = re.sub(r' ?([{};,>]) ?', r'\1', chunk)
+        out.append(chunk.replace(';}', '}'))
+    return ''.join(out).strip() + '\n'
+
+
+# 直前の文字がこれらなら、次の / は割り算ではなく正規表現リテラルの始まり
+_REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^\n')
+_REGEX_KEYWORDS = ('return', 'typeof', 'case', 'in', 'of', 'void', 'delete', 'throw', 'new')
+
+
+def minify_js(text):
+    """コメントを消し、行頭・行末の空白と空行を詰める（改行・文字列・正規表現リテラルはそのまま）。"""
+    out = []
+    literals = set()  # out のうち文字列・正規表現リテラルの位置（空白を詰めない）
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if c in '"\'`':
+            j = i + 1
+            while j < n and text[j] != c:
+                j += 2 if text[j] == '\\' else 1
+            literals.add(len(out))
+            out.append(text[i:j + 1])
+            i = j + 1
+        elif text.startswith('//', i):
+            j = text.find('\n', i)
+            i = n if j < 0 else j
+        elif text.startswith('/*', i):
+            j = text.find('*/', i + 2)
+            i = n if j < 0 else j + 2
+            out.append(' ')
+        elif c == '/' and _starts_regex(''.join(out[-8:])):
+            j, in_class = i + 1, False
+            while j < n and text[j] != '\n' and (in_class or text[j] != '/'):
+                if text[j] == '\\':
+                    j += 1
+                elif text[j] == '[':
+                    in_class = True
+                elif text[j] == ']':
+                    in_class = False
+                j += 1
+            literals.add(len(out))
+            out.append(text[i:j + 1])
+            i = j + 1
+        else:
+            out.append(c)
+            i += 1
+    pieces, code = [], []
+    for k, piece in enumerate(out):
+        if k in literals:
+            pieces += [_squash_js(''.join(code)), piece]
+            code = []
+        else:
+            code.append(piece)
+    pieces.append(_squash_js(''.join(code)))
+    return ''.join(pieces).strip(' \n') + '\n'
+
+
+def _squash_js(code):
+    """リテラルの間のコード片の空白を1つに、行頭・行末の空白と空行を消す。"""
+    code = re.sub(r'[ \t]+', ' ', code)
+    return re.sub(r' ?\n[ \n]*', '\n', code)
+
+
+def _starts_regex(before):
+    stripped = before.rstrip(' \t')
+    if not stripped:
+        return True
+    if stripped[-1] in _REGEX_PRECEDERS:
+        return True
+    word = re.search(r'[A-Za-z_$]+$', stripped)
+    return bool(word) and word.group(0) in _REGEX_KEYWORDS
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hashed_name(name, data):
+    root, ext = os.path.splitext(name)
+    return f'{root}.{_digest(data)[:HASH_LENGTH]}{ext}'
+
+
+def _brotli():
+    try:
+        import brotli  # 任意。なければ gzip だけ作る
+    except ImportError:
+        return None
+    return brotli
+
+
+class Asset:
+    """配信するファイル1つ分（元の名前・ハッシュ付きの名前・エンコーディングごとの中身）。"""
+    __slots__ = ('name', 'hashed', 'mimetype', 'etag', 'variants')
+
+    def __init__(self, name, hashed, variants):
+        self.name = name
+        self.hashed = hashed
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.etag = hashed.rsplit('.', 2)[-2]
+        self.variants = variants  # 'identity' / 'gzip' / 'br' -> bytes
+
+    def choose(self, accept_encodings):
+        """Accept-Encoding（werkzeug の MIMEAccept 相当）に合う (encoding, 中身) を返す。br > gzip > 無圧縮。"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding, self.variants[encoding]
+        return 'identity', self.variants['identity']
+
+
+class AssetPipeline:
+    """static_dir の CSS・JS を縮小・ハッシュ付け・圧縮して持つ。初めて使われたときに読み込む（またはビルドする）。"""
+
+    def __init__(self, static_dir, out_dir, auto_rebuild=False):
+        self.static_dir = static_dir
+        self.out_dir = out_dir
+        self.auto_rebuild = auto_rebuild  # True なら元ファイルの更新時刻を毎回見て、変わっていれば作り直す（開発用）
+        self._by_name = None    # 元の名前 -> Asset
+        self._by_hashed = None  # ハッシュ付きの名前 -> Asset
+        self._mtimes = None
+
+    def _sources(self):
+        """配信名 -> 元ファイルのリスト（BUNDLES に入っている元ファイルも単体で配信する）。"""
+        sources = {}
+        for root, _, files in os.walk(self.static_dir):
+            for filename in sorted(files):
+                if filename.endswith(EXTENSIONS):
+                    rel = os.path.relpath(os.path.join(root, filename), self.static_dir).replace(os.sep, '/')
+                    sources[rel] = [rel]
+        sources.update(BUNDLES)
+        return sources
+
+    def _read_sources(self, sources):
+        data = {}
+        for parts in sources.values():
+            for rel in parts:
+                if rel not in data:
+                    with open(os.path.join(self.static_dir, rel), 'rb') as f:
+                        data[rel] = f.read()
+        return data
+
+    def _source_mtimes(self):
+        mtimes = {}
+        for root, _, files in os.walk(self.static_dir):
+            for filename in files:
+                if filename.endswith(EXTENSIONS):
+                    path = os.path.join(root, filename)
+                    mtimes[path] = os.stat(path).st_mtime_ns
+        return mtimes
+
+    def build(self, write=True):
+        """元ファイルから作り直してファイル数を返す。write なら out_dir にも書き出す（書く前にメモリには入れる）。"""
+        sources = self._sources()
+        raw = self._read_sources(sources)
+        brotli = _brotli()
+        assets = []
+        for name, parts in sorted(sources.items()):
+            minify = minify_css if name.endswith('.css') else minify_js
+            data = '\n;\n'.join(minify(raw[rel].decode('utf-8')) for rel in parts).encode('utf-8')
+            variants = {'identity': data, 'gzip': gzip.compress(data, GZIP_LEVEL, mtime=0)}
+            if brotli is not None:
+                variants['br'] = brotli.compress(data, quality=BROTLI_QUALITY)
+            assets.append(Asset(name, _hashed_name(name, data), variants))
+        manifest = {
+            'v': MANIFEST_VERSION,
+            'sources': {rel: _digest(data) for rel, data in raw.items()},
+            'files': {a.name: a.hashed for a in assets},
+            'encodings': sorted({e for a in assets for e in a.variants if e != 'identity'}),
+        }
+        self._install(assets)
+        if write:
+            self._write(assets, manifest)
+        return len(assets)
+
+    def _write(self, assets, manifest):
+        suffixes = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+        for asset in assets:
+            for encoding, data in asset.variants.items():
+                path = os.path.join(self.out_dir, asset.hashed + suffixes[encoding])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+        tmp = os.path.join(self.out_dir, f'manifest.json.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, os.path.join(self.out_dir, 'manifest.json'))
+
+    def load(self):
+        """out_dir のビルド結果を読む。元ファイルと合わない・足りないなら False（作り直しが必要）。"""
+        try:
+            with open(os.path.join(self.out_dir, 'manifest.json'), encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(manifest, dict) or manifest.get('v') != MANIFEST_VERSION:
+            return False
+        sources = self._sources()
+        if set(manifest.get('files') or {}) != set(sources):
+            return False
+        try:
+            raw = self._read_sources(sources)
+        except OSError:
+            return False
+        if manifest.get('sources') != {rel: _digest(data) for rel, data in raw.items()}:
+            return False
+        suffixes = {'gzip': '.gz', 'br': '.br'}
+        assets = []
+        try:
+            for name, hashed in manifest['files'].items():
+                variants = {}
+                with open(os.path.join(self.out_dir, hashed), 'rb') as f:
+                    variants['identity'] = f.read()
+                for encoding in manifest.get('encodings') or ():
+                    with open(os.path.join(self.out_dir, hashed + suffixes[encoding]), 'rb') as f:
+                        variants[encoding] = f.read()
+                assets.append(Asset(name, hashed, variants))
+        except (OSError, KeyError):
+            return False
+        self._install(assets)
+        return True
+
+    def _install(self, assets):
+        self._by_name = {a.name: a for a in assets}
+        self._by_hashed = {a.hashed: a for a in assets}
+        if self.auto_rebuild:
+            self._mtimes = self._source_mtimes()
+
+    def _ensure(self):
+        if self._by_name is not None and not (self.auto_rebuild and self._source_mtimes() != self._mtimes):
+            return
+        if self.auto_rebuild or not self.load():
+            try:
+                self.build()
+            except OSError:
+                pass  # 書き出せなくても（読み取り専用のディスクなど）メモリから配信できる
+
+    def hashed_name(self, name):
+        """元の名前（'css/style.css'）に対応するハッシュ付きの名前。知らない名前なら None。"""
+        self._ensure()
+        asset = self._by_name.get(name)
+        return asset.hashed if asset else None
+
+    def get(self, hashed):
+        """ハッシュ付きの名前から Asset を引く（なければ None）。"""
+        self._ensure()
+        return self._by_hashed.get(hashed)
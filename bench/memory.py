@@ -0,0 +1,150 @@
+"""
+ルーム状態のメモリ使用量ベンチマーク
+
+N 人（既定 10,000 人・4人ルーム）分のメインルーム状態を、次の2つの持ち方で作って比べる:
+
+  legacy  以前の持ち方。room_participants（参加者 dict のリスト）・room_users・hand_raise_states
+          （ルームごとの sid -> dict / bool）・sid_to_room を別々の dict of dict で持つ
+  model   room_model.Room / Participant（__slots__）。挙手・接続状態は Participant のフィールド
+
+それぞれ tracemalloc で確保量を測り、挙手（sid -> ルーム -> 参加者を引いてフラグを立てる）の
+1回あたりの時間と、Redis に保存する1ルームあたりの JSON サイズも出力する。
+サーバーは起動せず、このプロセス内でデータ構造だけを作る。
+
+    python bench/memory.py
+    python bench/memory.py --participants 50000 --out memory-result.json
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from room_model import Participant, Room  # noqa: E402
+
+
+def make_people(n):
+    """実際の値に近い sid / 名前 / UUID を作る（文字列自体は両方式で共有し、差が構造だけに出るようにする）。"""
+    return [(uuid.uuid4().hex[:20], f'user{i:05d}', 'student', str(uuid.uuid4()), i + 1) for i in range(n)]
+
+
+def build_legacy(people, room_size):
+    room_participants, room_users, hand_raise_states, sid_to_room = {}, {}, {}, {}
+    for i, (sid, name, role, user_id, user_db_id) in enumerate(people):
+        room_id = f'room{i // room_size:06d}'
+        room_participants.setdefault(room_id, []).append({
+            'sid': sid,
+            'user_name': name,
+            'role': role,
+            'user_id': user_id,
+            'user_db_id': user_db_id,
+            'connected': True,
+        })
+        room_users.setdefault(room_id, {})[sid] = {'user_name': name, 'role': role}
+        hand_raise_states.setdefault(room_id, {})[sid] = False
+        sid_to_room[sid] = room_id
+    return {'room_participants': room_participants, 'room_users': room_users,
+            'hand_raise_states': hand_raise_states, 'sid_to_room': sid_to_room}
+
+
+def build_model(people, room_size):
+    main_rooms, sid_to_room = {}, {}
+    for i, (sid, name, role, user_id, user_db_id) in enumerate(people):
+        room_id = f'room{i // room_size:06d}'
+        room = main_rooms.get(room_id)
+        if room is None:
+            room = main_rooms[room_id] = Room(room_id)
+        room.participants.append(Participant(sid, name, role, user_id, user_db_id))
+        sid_to_room[sid] = room_id
+    return {'main_rooms': main_rooms, 'sid_to_room': sid_to_room}
+
+
+def measure(build, people, room_size):
+    """build() が確保したバイト数（作成後に残っている分）を返す。"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = build(people, room_size)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return state, after - before
+
+
+def raise_legacy(state, sid):
+    room_id = state['sid_to_room'].get(sid)
+    if room_id and sid in state['room_users'].get(room_id, {}):
+        hands = state['hand_raise_states'][room_id]
+        hands[sid] = not hands.get(sid, False)
+
+
+def raise_model(state, sid):
+    room_id = state['sid_to_room'].get(sid)
+    room = state['main_rooms'].get(room_id) if room_id else None
+    participant = room.get(sid) if room is not None else None
+    if participant is not None:
+        participant.raised = not participant.raised
+
+
+def time_per_call(fn, state, sids, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for sid in sids:
+            fn(state, sid)
+    return (time.perf_counter() - start) / (repeat * len(sids))
+
+
+def json_bytes_per_room(state, kind):
+    """Redis バックエンドで1ルーム分を保存したときの値の合計バイト数（平均）。"""
+    if kind == 'legacy':
+        keys = ('room_participants', 'room_users', 'hand_raise_states')
+        rooms = state['room_participants']
+        total = sum(len(json.dumps(state[k][room_id])) for room_id in rooms for k in keys)
+    else:
+        rooms = state['main_rooms']
+        total = sum(len(json.dumps(room.to_json())) for room in rooms.values())
+    return total / len(rooms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ルーム状態のメモリ使用量を以前の持ち方と比べる')
+    parser.add_argument('--participants', type=int, default=10000)
+    parser.add_argument('--room-size', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=20, help='挙手の計測で全員分を何周するか')
+    parser.add_argument('--out', help='結果を書き出す JSON ファイル')
+    args = parser.parse_args()
+
+    people = make_people(args.participants)
+    sids = [p[0] for p in people]
+    results = {'participants': args.participants, 'room_size': args.room_size}
+    for kind, build, toggle in (('legacy', build_legacy, raise_legacy), ('model', build_model, raise_model)):
+        state, size = measure(build, people, args.room_size)
+        results[kind] = {
+            'bytes_total': size,
+            'bytes_per_participant': round(size / args.participants, 1),
+            'hand_raise_ns': round(time_per_call(toggle, state, sids, args.repeat) * 1e9, 1),
+            'json_bytes_per_room': round(json_bytes_per_room(state, kind), 1),
+        }
+        del state
+
+    legacy, model = results['legacy'], results['model']
+    print(f"{'':8} {'total MiB':>10} {'B/participant':>14} {'hand_raise ns':>14} {'JSON B/room':>12}")
+    for kind in ('legacy', 'model'):
+        r = results[kind]
+        print(f"{kind:8} {r['bytes_total'] / 2**20:10.2f} {r['bytes_per_participant']:14.1f} "
+              f"{r['hand_raise_ns']:14.1f} {r['json_bytes_per_room']:12.1f}")
+    print(f"memory  {model['bytes_total'] / legacy['bytes_total']:.0%} of legacy, "
+          f"JSON {model['json_bytes_per_room'] / legacy['json_bytes_per_room']:.0%} of legacy")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+ベンチマーク用にアプリを起動する（bench/signaling.py から子プロセスとして起動される）
+
+本番と同じ eventlet で動かし、DB は一時ディレクトリの SQLite を使う。
+Google ログインの代わりに /bench/login/<name> でベンチ用ユーザーとしてログインできる
+（このルートはこのスクリプトで起動したときだけ存在する）。
+"""
+import eventlet
+eventlet.monkey_patch()  # gunicorn の eventlet ワーカーと同じ条件にする
+
+import argparse
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Video Desk をベンチマーク用に起動する')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10100)
+    parser.add_argument('--db-delay', type=float, default=0.0,
+                        help='SQL 文ごとに入れる遅延（秒）。遅い DB を再現する（スレッドごと止まる本物の sleep を使う）')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='videodesk-bench-')
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite3'))
+    os.environ.setdefault('ATTACHMENT_DIR', os.path.join(workdir, 'attachments'))
+    os.environ.setdefault('TRACE_ENABLED', '0')
+    os.environ.setdefault('SNAPSHOT_PATH', os.path.join(workdir, 'room-snapshot.json'))
+    os.environ.setdefault('DRAIN_SECONDS', '0')  # terminate() ですぐ終わるように
+    sys.path.insert(0, ROOT)
+
+    import app as videodesk
+    from flask import jsonify
+    from flask_login import login_user
+
+    @videodesk.app.route('/bench/login/<name>')
+    def bench_login(name):
+        user = videodesk.User.query.filter_by(google_id='bench-' + name).first()
+        if user is None:
+            user = videodesk.User(google_id='bench-' + name, name=name, email=name + '@bench.local')
+            videodesk.db.session.add(user)
+            videodesk.db.session.commit()
+        login_user(user, remember=True)
+        return jsonify({'id': user.id})
+
+    @videodesk.app.route('/bench/ping')
+    def bench_ping():
+        return 'ok'
+
+    if args.db_delay > 0:
+        from eventlet import patcher
+        from sqlalchemy import event
+
+        blocking_sleep = patcher.original('time').sleep  # C ドライバと同じく、呼んだスレッド（ハブ）ごと止める
+
+        def _slow_statement(*_args):
+            blocking_sleep(args.db_delay)
+
+        with videodesk.app.app_context():
+            event.listen(videodesk.db.engine, 'before_cursor_execute', _slow_statement)
+
+    videodesk.socketio.run(videodesk.app, host=args.host, port=args.port, log_output=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+大部屋（SFU）の中継サーバー（media_relay.py）をカメラなしで試すベンチマーク
+
+中継サーバーを同じプロセスで起動し、N 人の模擬参加者が合成映像（aiortc の VideoStreamTrack を元にした
+単色フレーム）を publish して、全員がほかの全員を subscribe する。p0 をホストとみなして full、それ以外は
+thumb で受け取り、途中で p0 が p1 の受信を full に切り替える（再ネゴシエーションなしで解像度が変わるか）。
+
+受信ごとの fps と受け取ったフレームサイズ、プロセスの CPU 時間を JSON に出力する。
+クライアントも同じプロセスでエンコード・デコードするので、CPU 時間は中継サーバー単体より多めに出る。
+
+    pip install -r requirements-sfu.txt
+    python bench/sfu.py --participants 4 --seconds 10 --out sfu-result.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from av import VideoFrame
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import media_relay  # noqa: E402
+
+ROOM = 'bench_hall'
+
+
+class SyntheticTrack(VideoStreamTrack):
+    """width x height の単色フレームを 30fps で出す（参加者ごとに色を変える）。"""
+
+    def __init__(self, width, height, shade):
+        super().__init__()
+        self.width = width
+        self.height = height
+        self.shade = shade
+
+    async def recv(self):
+        pts, time_base = await self.next_timestamp()
+        frame = VideoFrame(width=self.width, height=self.height)
+        for plane in frame.planes:
+            plane.update(bytes([self.shade]) * plane.buffer_size)
+        frame.pts, frame.time_base = pts, time_base
+        return frame
+
+
+class Receiver:
+    """1本の受信（subscriber -> publisher）のフレーム数とサイズを記録する。"""
+
+    def __init__(self, subscriber, publisher, quality):
+        self.subscriber = subscriber
+        self.publisher = publisher
+        self.quality = quality
+        self.frames = 0
+        self.sizes = []  # 受け取ったフレームサイズ（変わったときだけ追加）
+        self.pc = None
+
+    async def consume(self, track):
+        while True:
+            try:
+                frame = await track.recv()
+            except Exception:
+                return
+            self.frames += 1
+            size = f'{frame.width}x{frame.height}'
+            if not self.sizes or self.sizes[-1] != size:
+                self.sizes.append(size)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _token(sid):
+    return media_relay.signer.dumps({'room': ROOM, 'sid': sid})
+
+
+async def _negotiate(http, url, pc, body):
+    await pc.setLocalDescription(await pc.createOffer())
+    body.update(sdp=pc.localDescription.sdp, type=pc.localDescription.type)
+    async with http.post(url, data=json.dumps(body)) as resp:
+        resp.raise_for_status()
+        answer = await resp.json()
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+
+
+async def publish(http, base, sid, args, shade):
+    pc = RTCPeerConnection()
+    pc.addTrack(SyntheticTrack(args.width, args.height, shade))
+    await _negotiate(http, base + '/publish', pc, {'token': _token(sid)})
+    return pc
+
+
+async def subscribe(http, base, receiver):
+    pc = RTCPeerConnection()
+    pc.addTransceiver('video', direction='recvonly')
+    tasks = []
+
+    @pc.on('track')
+    def on_track(track):
+        tasks.append(asyncio.ensure_future(receiver.consume(track)))
+
+    receiver.pc = pc
+    await _negotiate(http, base + '/subscribe', pc, {'token': _token(receiver.subscriber),
+                                                      'publisher': receiver.publisher,
+                                                      'quality': receiver.quality})
+    return tasks
+
+
+async def run(args):
+    port = _free_port()
+    base = f'http://127.0.0.1:{port}'
+    runner = web.AppRunner(media_relay.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    sids = [f'p{i}' for i in range(args.participants)]
+    receivers = [Receiver(sub, pub, 'full' if pub == sids[0] else 'thumb')
+                 for sub in sids for pub in sids if sub != pub]
+    tasks = []
+    publishers = []
+    async with aiohttp.ClientSession() as http:
+        for i, sid in enumerate(sids):
+            publishers.append(await publish(http, base, sid, args, (40 + i * 30) % 200))
+        for receiver in receivers:
+            tasks += await subscribe(http, base, receiver)
+
+        await asyncio.sleep(args.warmup)
+        for receiver in receivers:
+            receiver.frames = 0
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        await asyncio.sleep(args.seconds / 2)
+        switched = None
+        if len(sids) > 2:
+            switched = next(r for r in receivers if r.subscriber == sids[0] and r.publisher == sids[1])
+            async with http.post(base + '/quality', data=json.dumps({'token': _token(sids[0]), 'publisher': sids[1],
+                                                                      'quality': 'full'})) as resp:
+                resp.raise_for_status()
+        await asyncio.sleep(args.seconds / 2)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        async with http.get(base + '/healthz') as resp:
+            health = await resp.json()
+
+    for receiver in receivers:
+        await receiver.pc.close()
+    for pc in publishers:
+        await pc.close()
+    for task in tasks:
+        task.cancel()
+    await runner.cleanup()
+
+    fps = sorted(r.frames / wall for r in receivers)
+    return {
+        'meta': {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'participants': args.participants,
+            'source_size': f'{args.width}x{args.height}',
+            'thumb_width': media_relay.SFU_THUMB_WIDTH,
+            'seconds': args.seconds,
+        },
+        'relay': health,
+        'cpu_seconds_per_second': round(cpu / wall, 3),
+        'fps': {'min': round(fps[0], 1), 'p50': round(fps[len(fps) // 2], 1), 'max': round(fps[-1], 1)},
+        'quality_switch': switched and {'subscriber': switched.subscriber, 'publisher': switched.publisher,
+                                        'sizes': switched.sizes},
+        'subscriptions': [{'subscriber': r.subscriber, 'publisher': r.publisher, 'quality': r.quality,
+                           'fps': round(r.frames / wall, 1), 'sizes': r.sizes} for r in receivers],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='合成映像で大部屋（SFU）の中継サーバーを試す')
+    parser.add_argument('--participants', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10.0, help='測定時間（半分経ったところで画質を切り替える）')
+    parser.add_argument('--warmup', type=float, default=3.0, help='接続が安定するまで待つ秒数（測定に含めない）')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--out', default='sfu-result.json', help='結果 JSON の出力先')
+    args = parser.parse_args()
+    if args.participants < 2:
+        parser.error('--participants は 2 以上')
+
+    result = asyncio.run(run(args))
+    print(f"[sfu] {len(result['subscriptions'])} subscriptions: fps min={result['fps']['min']} "
+          f"p50={result['fps']['p50']} max={result['fps']['max']} cpu={result['cpu_seconds_per_second']}s/s")
+    for sub in result['subscriptions']:
+        print(f"  {sub['subscriber']} <- {sub['publisher']} {sub['quality']:5s} {sub['fps']:5.1f}fps "
+              f"{' -> '.join(sub['sizes'])}")
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'[sfu] wrote {args.out}')
+
+
+if __name__ == '__main__':
+    main()
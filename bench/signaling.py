@@ -0,0 +1,663 @@
+"""
+Socket.IO シグナリングサーバーの負荷テスト・ベンチマーク
+
+bench/server.py でアプリをローカル起動し（SQLite・ログインはスタブ）、模擬クライアントで次のシナリオを流す:
+
+  join_storm        N 人が同時に接続して join_room（空席インデックス経由でルーム割り当て）
+  mesh              4人ルームで全ペアが offer / answer と ICE trickle を交換
+  disconnect_storm  入室済みの半数が同時に切断し、残りの参加者に通知が届くまで
+  private_churn     管理者と生徒が個別指導の開始 → 入室 → 終了 → メインルーム復帰を繰り返す
+  image_chat        個別指導中に画像を /attachments へアップロードし、private_chat_image を送る
+  slow_db           DB を使う HTTP リクエストを流し続けながら、ペア間の中継（ice_candidate）の遅延を測る
+                    （--db-delay で遅い DB を再現する。既定のシナリオには含まない）
+
+イベント種別ごとの件数・p50 / p99 / 最大レイテンシ（ミリ秒）・スループット（件/秒）を JSON に出力する。
+--baseline に以前の結果を渡すと、p99 が --tolerance を超えて悪化したイベントを表示して終了コード 1 で終わる。
+
+    pip install -r bench/requirements.txt
+    python bench/signaling.py --out bench-result.json
+    python bench/signaling.py --baseline bench-result.json   # デプロイ前の回帰チェック
+    python bench/signaling.py --serializer msgpack --out bench-msgpack.json
+
+レイテンシは送信側が載せた時刻（同一プロセス内の time.perf_counter）から受信までを測る。
+クライアントも1プロセスで動くため、大きな N ではクライアント側が先に詰まる点に注意。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+
+import aiohttp
+import socketio
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 実際のブラウザが送るサイズに近づけたダミーの SDP / ICE candidate
+FAKE_SDP = 'v=0\r\n' + 'a=candidate:0 1 UDP 2122252543 192.0.2.1 50000 typ host\r\n' * 40
+FAKE_CANDIDATE = {'candidate': 'candidate:842163049 1 udp 1677729535 198.51.100.7 61665 typ srflx '
+                               'raddr 0.0.0.0 rport 0 generation 0 ufrag abcd network-cost 999',
+                  'sdpMid': '0', 'sdpMLineIndex': 0}
+JPEG_MAGIC = b'\xff\xd8\xff\xe0'
+
+
+class Stats:
+    """イベント種別ごとのレイテンシ（秒）を集める。"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, event, seconds):
+        self.samples[event].append(seconds)
+
+    def error(self, kind):
+        self.errors[kind] += 1
+
+    def summary(self, wall_seconds):
+        events = {}
+        for event, values in sorted(self.samples.items()):
+            values.sort()
+            events[event] = {
+                'count': len(values),
+                'p50_ms': round(_percentile(values, 50) * 1000, 3),
+                'p99_ms': round(_percentile(values, 99) * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3),
+                'throughput_per_s': round(len(values) / wall_seconds, 1) if wall_seconds else None,
+            }
+        return {'wall_s': round(wall_seconds, 3), 'events': events, 'errors': dict(self.errors)}
+
+
+def _percentile(sorted_values, pct):
+    """最近順位法のパーセンタイル（sorted_values は昇順ソート済み）。"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class BenchClient:
+    """1人分の模擬ブラウザ。受信イベントを待つための expect() と、種別ごとのハンドラを持つ。"""
+
+    serializer = 'json'  # サーバーの SOCKETIO_SERIALIZER に合わせる（--serializer）
+
+    def __init__(self, url, name, role='student'):
+        self.url = url
+        self.name = name
+        self.role = role
+        self.user_id = uuid.uuid4().hex
+        self.room_id = None
+        self.handlers = {}
+        self._waiters = []
+        self.sio = socketio.AsyncClient(reconnection=False,
+                                        serializer='msgpack' if self.serializer == 'msgpack' else 'default')
+        self.sio.on('*', self._on_any)
+
+    @property
+    def sid(self):
+        return self.sio.get_sid()
+
+    async def connect(self):
+        await self.sio.connect(self.url, transports=['websocket'])
+
+    async def disconnect(self):
+        if self.sio.connected:
+            await self.sio.disconnect()
+
+    async def emit(self, event, data=None):
+        await self.sio.emit(event, data or {})
+
+    async def call(self, event, data, timeout):
+        return await self.sio.call(event, data, timeout=timeout)
+
+    def expect(self, event, predicate=None):
+        """event を受信したら (受信時刻, data) になる Future を返す。emit の前に呼ぶこと。"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((event, predicate, future))
+        return future
+
+    async def _on_any(self, event, *args):
+        data = args[0] if args else None
+        now = time.perf_counter()
+        for waiter in self._waiters:
+            name, predicate, future = waiter
+            if name == event and not future.done() and (predicate is None or predicate(data)):
+                future.set_result((now, data))
+                self._waiters.remove(waiter)
+                break
+        handler = self.handlers.get(event)
+        if handler:
+            await handler(now, data)
+
+
+async def _wait(future, timeout, stats, kind):
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        stats.error(kind + '_timeout')
+        return None
+
+
+async def connect_clients(url, count, prefix, stats, role='student'):
+    clients = [BenchClient(url, f'{prefix}{i}', role) for i in range(count)]
+
+    async def _connect(client):
+        t0 = time.perf_counter()
+        try:
+            await client.connect()
+        except socketio.exceptions.ConnectionError:
+            stats.error('connect_failed')
+            return
+        stats.add('connect', time.perf_counter() - t0)
+
+    await asyncio.gather(*(_connect(c) for c in clients))
+    return [c for c in clients if c.sio.connected]
+
+
+async def join_main_room(client, stats, timeout, room=None):
+    future = client.expect('room_assigned')
+    t0 = time.perf_counter()
+    await client.emit('join_room', {'room': room, 'user_name': client.name, 'role': client.role,
+                                    'user_id': client.user_id})
+    result = await _wait(future, timeout, stats, 'join_room')
+    if result:
+        stats.add('join_room', result[0] - t0)
+        client.room_id = result[1]['room_id']
+    return result
+
+
+async def disconnect_all(clients):
+    await asyncio.gather(*(c.disconnect() for c in clients))
+
+
+# ---------- シナリオ ----------
+
+async def scenario_join_storm(url, args):
+    stats = Stats()
+    started = time.perf_counter()
+    clients = await connect_clients(url, args.clients, 'storm', stats)
+    await asyncio.gather(*(join_main_room(c, stats, args.timeout) for c in clients))
+    wall = time.perf_counter() - started
+    await disconnect_all(clients)
+    return stats.summary(wall)
+
+
+async def scenario_mesh(url, args):
+    stats = Stats()
+    clients = await connect_clients(url, args.rooms * 4, 'mesh', stats)
+    run_id = uuid.uuid4().hex[:6]
+    # 1ルームずつ順に埋める（招待 URL と同じく room を指定して入室）
+    for i in range(0, len(clients), 4):
+        await asyncio.gather(*(join_main_room(c, stats, args.timeout, room=f'bench-mesh-{run_id}-{i // 4}')
+                               for c in clients[i:i + 4]))
+
+    expected = 0
+    done = asyncio.Event()
+    received = 0
+
+    def _tick():
+        nonlocal received
+        received += 1
+        if received >= expected:
+            done.set()
+
+    def _install(client):
+        async def on_offer(now, data):
+            offer_t0 = data['description']['t0']
+            stats.add('offer', now - offer_t0)
+            _tick()
+            await client.emit('answer', {'target': data['sender'],
+                                         'description': {'type': 'answer', 'sdp': FAKE_SDP,
+                                                         't0': time.perf_counter(), 'offer_t0': offer_t0}})
+            await _trickle(client, data['sender'])
+
+        async def on_answer(now, data):
+            stats.add('answer', now - data['description']['t0'])
+            stats.add('offer_answer_roundtrip', now - data['description']['offer_t0'])
+            _tick()
+
+        async def on_ice(now, data):
+            stats.add('ice_candidate', now - data['candidate']['t0'])
+            _tick()
+
+        async def on_ice_batch(now, data):
+            for candidate in data['candidates']:
+                stats.add('ice_candidate', now - candidate['t0'])
+                _tick()
+
+        client.handlers.update({'offer': on_offer, 'answer': on_answer,
+                                'ice_candidate': on_ice, 'ice_candidates': on_ice_batch})
+
+    async def _trickle(client, target):
+        if args.ice_mode == 'batch':
+            # room.js と同じく宛先ごとにまとめて1フレームで送る
+            t0 = time.perf_counter()
+            await client.emit('ice_candidates', {'target': target,
+                                                 'candidates': [dict(FAKE_CANDIDATE, t0=t0) for _ in range(args.ice)]})
+            return
+        for _ in range(args.ice):
+            await client.emit('ice_candidate', {'target': target,
+                                                'candidate': dict(FAKE_CANDIDATE, t0=time.perf_counter())})
+
+    async def _negotiate(offerer, answerer):
+        await offerer.emit('offer', {'target': answerer.sid,
+                                     'description': {'type': 'offer', 'sdp': FAKE_SDP, 't0': time.perf_counter()}})
+        await _trickle(offerer, answerer.sid)
+
+    stats.samples.clear()  # 接続・入室は準備段階なので集計しない
+    for c in clients:
+        _install(c)
+    # 後から入った人が先にいる全員へ offer する（room.js と同じ向き）
+    pairs = []
+    for i in range(0, len(clients), 4):
+        group = [c for c in clients[i:i + 4] if c.room_id]
+        pairs += [(group[b], group[a]) for a in range(len(group)) for b in range(a + 1, len(group))]
+    # 1ペアあたり offer 1 + answer 1 + 双方向の ICE
+    expected = len(pairs) * (2 + 2 * args.ice)
+    started = time.perf_counter()
+    await asyncio.gather(*(_negotiate(o, a) for o, a in pairs))
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        stats.error('relay_missing')
+    wall = time.perf_counter() - started
+    await disconnect_all(clients)
+    summary = stats.summary(wall)
+    summary['relays_expected'] = expected
+    summary['relays_received'] = received
+    return summary
+
+
+async def scenario_disconnect_storm(url, args):
+    stats = Stats()
+    clients = await connect_clients(url, args.clients, 'drop', stats)
+    await asyncio.gather(*(join_main_room(c, stats, args.timeout) for c in clients))
+    stats.samples.clear()
+    leaving = clients[::2]
+    staying = clients[1::2]
+    leaving_sids = {c.sid for c in leaving}
+    leaving_by_room = defaultdict(int)
+    for c in leaving:
+        leaving_by_room[c.room_id] += 1
+
+    # 猶予あり（participant_disconnected）・なし（user_left）のどちらでも、同室の切断者の数だけ通知が届くのを待つ
+    started = time.perf_counter()
+    waits = []
+    for c in staying:
+        remaining = leaving_by_room.get(c.room_id, 0)
+        if not remaining:
+            continue
+        done = asyncio.Event()
+
+        def _make_handler(done, remaining):
+            count = [remaining]
+
+            async def handler(now, data):
+                if data.get('sid') not in leaving_sids:
+                    return
+                stats.add('peer_notified', now - started)
+                count[0] -= 1
+                if count[0] <= 0:
+                    done.set()
+            return handler
+
+        handler = _make_handler(done, remaining)
+        c.handlers['participant_disconnected'] = handler
+        c.handlers['user_left'] = handler
+        waits.append(done.wait())
+
+    await disconnect_all(leaving)
+    try:
+        await asyncio.wait_for(asyncio.gather(*waits), args.timeout)
+    except asyncio.TimeoutError:
+        stats.error('peer_notified_timeout')
+    wall = time.perf_counter() - started
+    await disconnect_all(staying)
+    summary = stats.summary(wall)
+    summary['disconnected'] = len(leaving)
+    return summary
+
+
+async def _start_private_session(admin, student, stats, timeout):
+    """管理者が生徒との個別指導を開始し、2人とも個別ルームに入るまで。session_id を返す。"""
+    admin_redirect = admin.expect('redirect_to_private')
+    student_redirect = student.expect('redirect_to_private')
+    t0 = time.perf_counter()
+    await admin.emit('start_private_session', {'student_sid': student.sid})
+    result = await _wait(admin_redirect, timeout, stats, 'start_private_session')
+    if not result or not await _wait(student_redirect, timeout, stats, 'start_private_session'):
+        return None
+    stats.add('start_private_session', result[0] - t0)
+    session_id = result[1]['session_id']
+
+    both_present = lambda d: len(d.get('participants', [])) == 2  # noqa: E731
+    admin_ready = admin.expect('private_participants', both_present)
+    student_ready = student.expect('private_participants', both_present)
+    t0 = time.perf_counter()
+    await asyncio.gather(
+        admin.emit('join_private_room', {'session_id': session_id, 'user_name': admin.name, 'role': 'admin'}),
+        student.emit('join_private_room', {'session_id': session_id, 'user_name': student.name, 'role': 'student'}),
+    )
+    results = [await _wait(f, timeout, stats, 'join_private_room') for f in (admin_ready, student_ready)]
+    if not all(results):
+        return None
+    stats.add('join_private_room', max(r[0] for r in results) - t0)
+    return session_id
+
+
+async def _private_pairs(url, args, stats, prefix):
+    admins = await connect_clients(url, args.pairs, prefix + 'admin', stats, role='admin')
+    students = await connect_clients(url, args.pairs, prefix + 'student', stats)
+    pairs = list(zip(admins, students))
+    run_id = uuid.uuid4().hex[:6]
+    for i, (admin, student) in enumerate(pairs):
+        room = f'bench-{prefix}{run_id}-{i}'
+        await join_main_room(admin, stats, args.timeout, room=room)
+        await join_main_room(student, stats, args.timeout, room=room)
+    return pairs
+
+
+async def scenario_private_churn(url, args):
+    stats = Stats()
+    pairs = await _private_pairs(url, args, stats, 'churn')
+
+    async def _cycle(admin, student):
+        main_room = admin.room_id
+        for _ in range(args.cycles):
+            if not await _start_private_session(admin, student, stats, args.timeout):
+                return
+            back = [c.expect('redirect_to_main_room') for c in (admin, student)]
+            t0 = time.perf_counter()
+            await admin.emit('end_private_session', {})
+            results = [await _wait(f, args.timeout, stats, 'end_private_session') for f in back]
+            if not all(results):
+                return
+            stats.add('end_private_session', max(r[0] for r in results) - t0)
+            await join_main_room(admin, stats, args.timeout, room=main_room)
+            await join_main_room(student, stats, args.timeout, room=main_room)
+
+    stats.samples.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(_cycle(a, s) for a, s in pairs))
+    wall = time.perf_counter() - started
+    await disconnect_all([c for pair in pairs for c in pair])
+    return stats.summary(wall)
+
+
+async def scenario_image_chat(url, args):
+    stats = Stats()
+    pairs = await _private_pairs(url, args, stats, 'image')
+    sent_at = {}
+    received = 0
+    expected = 0
+    done = asyncio.Event()
+
+    async def on_image(now, data):
+        nonlocal received
+        t0 = sent_at.get((data.get('sender_sid'), data.get('attachment_id')))
+        if t0 is not None:
+            stats.add('private_chat_image_delivered', now - t0)
+        received += 1
+        if received >= expected:
+            done.set()
+
+    async def _login(http, client):
+        async with http.get(f'{url}/bench/login/{client.name}') as resp:
+            resp.raise_for_status()
+
+    async def _send_images(http, client):
+        for _ in range(args.images):
+            body = JPEG_MAGIC + os.urandom(args.image_bytes)  # 毎回別の内容（重複排除で書き込みが省かれないように）
+            t0 = time.perf_counter()
+            async with http.post(f'{url}/attachments', data=body, headers={'Content-Type': 'image/jpeg'}) as resp:
+                if resp.status != 200:
+                    stats.error(f'upload_{resp.status}')
+                    continue
+                attachment_id = (await resp.json())['id']
+            t1 = time.perf_counter()
+            stats.add('upload_attachment', t1 - t0)
+            sent_at[(client.sid, attachment_id)] = t1
+            try:
+                ack = await client.call('private_chat_image', {'attachment_id': attachment_id}, args.timeout)
+            except socketio.exceptions.TimeoutError:
+                stats.error('private_chat_image_timeout')
+                continue
+            if not ack or not ack.get('ok'):
+                stats.error('private_chat_image_rejected')
+                continue
+            stats.add('private_chat_image_ack', time.perf_counter() - t1)
+
+    sessions = await asyncio.gather(*(_start_private_session(a, s, stats, args.timeout) for a, s in pairs))
+    senders = [c for (a, s), ok in zip(pairs, sessions) if ok for c in (a, s)]
+    for c in senders:
+        c.handlers['private_chat_image'] = on_image
+    expected = len(senders) * args.images
+
+    stats.samples.clear()
+    # ログイン Cookie はクライアントごとに分ける（127.0.0.1 の Cookie を受け付けるよう unsafe=True）
+    sessions = {c: aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) for c in senders}
+    try:
+        await asyncio.gather(*(_login(sessions[c], c) for c in senders))
+        started = time.perf_counter()
+        await asyncio.gather(*(_send_images(sessions[c], c) for c in senders))
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            stats.error('private_chat_image_missing')
+    finally:
+        await asyncio.gather(*(s.close() for s in sessions.values()))
+    wall = time.perf_counter() - started
+    await disconnect_all([c for pair in pairs for c in pair])
+    summary = stats.summary(wall)
+    summary['images_expected'] = expected
+    summary['images_received'] = received
+    return summary
+
+
+async def scenario_slow_db(url, args):
+    stats = Stats()
+    clients = await connect_clients(url, args.pairs * 2, 'slowdb', stats)
+    pairs = list(zip(clients[::2], clients[1::2]))
+    run_id = uuid.uuid4().hex[:6]
+    for i, (a, b) in enumerate(pairs):
+        room = f'bench-slowdb-{run_id}-{i}'
+        await join_main_room(a, stats, args.timeout, room=room)
+        await join_main_room(b, stats, args.timeout, room=room)
+    pairs = [(a, b) for a, b in pairs if a.room_id and a.room_id == b.room_id]
+
+    received = 0
+    expected = len(pairs) * args.pings
+    done = asyncio.Event()
+
+    async def on_ice(now, data):
+        nonlocal received
+        stats.add('relay', now - data['candidate']['t0'])
+        received += 1
+        if received >= expected:
+            done.set()
+
+    for c in clients:
+        c.handlers['ice_candidate'] = on_ice
+
+    async def _ping(a, b):
+        for _ in range(args.pings):
+            await a.emit('ice_candidate', {'target': b.sid,
+                                           'candidate': dict(FAKE_CANDIDATE, t0=time.perf_counter())})
+            await asyncio.sleep(args.ping_interval)
+
+    stop = asyncio.Event()
+
+    async def _db_load(http, n):
+        # 名前の変更（User の SELECT + UPDATE）を繰り返して DB を使い続ける
+        i = 0
+        while not stop.is_set():
+            i += 1
+            t0 = time.perf_counter()
+            async with http.post(f'{url}/settings', data={'display_name': f'writer{n}-{i}'},
+                                 allow_redirects=False) as resp:
+                if resp.status != 302:
+                    stats.error(f'settings_{resp.status}')
+                    continue
+            stats.add('settings_post', time.perf_counter() - t0)
+
+    sessions = [aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) for _ in range(args.db_writers)]
+    try:
+        for n, http in enumerate(sessions):
+            async with http.get(f'{url}/bench/login/slowdb-writer{n}') as resp:
+                resp.raise_for_status()
+        stats.samples.clear()
+        started = time.perf_counter()
+        writers = [asyncio.ensure_future(_db_load(http, n)) for n, http in enumerate(sessions)]
+        await asyncio.gather(*(_ping(a, b) for a, b in pairs))
+        try:
+            await asyncio.wait_for(done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            stats.error('relay_missing')
+        wall = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*writers)
+    finally:
+        await asyncio.gather(*(s.close() for s in sessions))
+    await disconnect_all(clients)
+    summary = stats.summary(wall)
+    summary['relays_expected'] = expected
+    summary['relays_received'] = received
+    return summary
+
+
+SCENARIOS = {
+    'join_storm': scenario_join_storm,
+    'mesh': scenario_mesh,
+    'disconnect_storm': scenario_disconnect_storm,
+    'private_churn': scenario_private_churn,
+    'image_chat': scenario_image_chat,
+    'slow_db': scenario_slow_db,
+}
+# slow_db は --db-delay と組み合わせて使うので、既定では流さない
+DEFAULT_SCENARIOS = [name for name in SCENARIOS if name != 'slow_db']
+
+
+# ---------- サーバー起動・結果比較 ----------
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def _wait_for_server(url, proc, timeout=30):
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.time() < deadline:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError('bench server exited with code %s' % proc.returncode)
+            try:
+                async with http.get(url + '/bench/ping') as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('bench server did not start within %ss' % timeout)
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """p99 が baseline より tolerance（割合）を超えて悪化したイベントを列挙する。"""
+    regressions = []
+    for name, scenario in result['scenarios'].items():
+        base_events = baseline.get('scenarios', {}).get(name, {}).get('events', {})
+        for event, stat in scenario['events'].items():
+            base = base_events.get(event)
+            if base and base['p99_ms'] > 0 and stat['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+                regressions.append(f"{name}.{event}: p99 {base['p99_ms']}ms -> {stat['p99_ms']}ms")
+    return regressions
+
+
+async def run(args):
+    proc = None
+    url = args.url
+    BenchClient.serializer = args.serializer
+    if not url:
+        port = _free_port()
+        url = f'http://127.0.0.1:{port}'
+        log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+        proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'server.py'), '--port', str(port),
+                                 '--db-delay', str(args.db_delay)],
+                                env=dict(os.environ, SOCKETIO_SERIALIZER=args.serializer),
+                                stdout=log, stderr=subprocess.STDOUT)
+    try:
+        await _wait_for_server(url, proc)
+        result = {
+            'meta': {
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'url': url,
+                'args': {k: v for k, v in vars(args).items() if k not in ('baseline',)},
+            },
+            'scenarios': {},
+        }
+        for name in args.scenarios:
+            print(f'[bench] {name} ...', flush=True)
+            result['scenarios'][name] = await SCENARIOS[name](url, args)
+            for event, stat in result['scenarios'][name]['events'].items():
+                print(f"  {event:32s} n={stat['count']:<6d} p50={stat['p50_ms']:>9.2f}ms "
+                      f"p99={stat['p99_ms']:>9.2f}ms  {stat['throughput_per_s']}/s")
+            if result['scenarios'][name]['errors']:
+                print('  errors:', result['scenarios'][name]['errors'])
+        return result
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket.IO シグナリングの負荷テスト')
+    parser.add_argument('--url', help='起動済みサーバーの URL（省略時は bench/server.py を起動。image_chat には /bench/login が必要）')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=DEFAULT_SCENARIOS)
+    parser.add_argument('--clients', type=int, default=200, help='join_storm / disconnect_storm の同時接続数')
+    parser.add_argument('--rooms', type=int, default=10, help='mesh の4人ルーム数')
+    parser.add_argument('--ice', type=int, default=8, help='mesh で1ペアの片側が送る ICE candidate 数')
+    parser.add_argument('--ice-mode', choices=['batch', 'single'], default='batch',
+                        help='mesh の ICE 送信方法（batch: ice_candidates でまとめる / single: 旧 ice_candidate を1件ずつ）')
+    parser.add_argument('--pairs', type=int, default=20, help='private_churn / image_chat の管理者・生徒ペア数')
+    parser.add_argument('--cycles', type=int, default=5, help='private_churn の開始〜終了の繰り返し回数')
+    parser.add_argument('--images', type=int, default=5, help='image_chat で1人が送る画像数')
+    parser.add_argument('--image-bytes', type=int, default=200 * 1024)
+    parser.add_argument('--pings', type=int, default=100, help='slow_db で1ペアが送る中継メッセージ数')
+    parser.add_argument('--ping-interval', type=float, default=0.05, help='slow_db の中継メッセージの送信間隔（秒）')
+    parser.add_argument('--db-writers', type=int, default=10, help='slow_db で DB を使い続ける HTTP クライアント数')
+    parser.add_argument('--db-delay', type=float, default=0.0,
+                        help='起動するサーバーで SQL 文ごとに入れる遅延（秒。--url 指定時は無効）')
+    parser.add_argument('--serializer', choices=['json', 'msgpack'], default='json',
+                        help='Socket.IO のパケット形式（起動するサーバーの SOCKETIO_SERIALIZER にも渡す）')
+    parser.add_argument('--timeout', type=float, default=30.0, help='1つの応答を待つ上限秒数')
+    parser.add_argument('--out', default='bench-result.json', help='結果 JSON の出力先')
+    parser.add_argument('--server-log', help='起動したサーバーの出力を保存するファイル')
+    parser.add_argument('--baseline', help='比較対象の結果 JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='p99 の悪化をどこまで許すか（割合）')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'[bench] wrote {args.out}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare_with_baseline(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print('[bench] regression:', line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+起動時間のベンチマーク（Render のコールドスタート・スケールアウトで1ワーカーが使えるようになるまで）
+
+毎回新しいプロセスで次の2つを測る（一時ディレクトリの SQLite。bench/server.py と同じ条件）:
+
+  import_s            python で `import app` が終わるまで
+  first_connection_s  bench/server.py を起動してから、engine.io のハンドシェイク
+                      （GET /socket.io/?EIO=4&transport=polling）が最初に成功するまで
+
+--runs 回の最小 / p50 / 最大（秒）を JSON に出力する。--baseline に以前の結果を渡すと、p50 が --tolerance を
+超えて悪化した項目を表示して終了コード 1 で終わる。--profile は python -X importtime の上位（累計時間順）を表示する。
+
+    python bench/startup.py --out startup-result.json
+    python bench/startup.py --env DB_INIT_ON_START=0 --baseline startup-result.json
+    python bench/startup.py --profile
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+IMPORT_SNIPPET = (
+    'import time; t = time.perf_counter(); import app; '
+    'print(time.perf_counter() - t)'
+)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _env(extra, workdir):
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.sqlite3'))
+    env.setdefault('ATTACHMENT_DIR', os.path.join(workdir, 'attachments'))
+    env.setdefault('SNAPSHOT_PATH', os.path.join(workdir, 'room-snapshot.json'))
+    env.setdefault('TRACE_ENABLED', '0')
+    env.update(extra)
+    return env
+
+
+def measure_import(extra):
+    with tempfile.TemporaryDirectory(prefix='videodesk-startup-') as workdir:
+        out = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT, env=_env(extra, workdir),
+                             capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def measure_first_connection(extra, timeout):
+    port = _free_port()
+    url = f'http://127.0.0.1:{port}/socket.io/?EIO=4&transport=polling'
+    with tempfile.TemporaryDirectory(prefix='videodesk-startup-') as workdir:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'server.py'), '--port', str(port)],
+                                env=_env(extra, workdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while time.perf_counter() - start < timeout:
+                if proc.poll() is not None:
+                    raise RuntimeError('bench server exited with code %s' % proc.returncode)
+                try:
+                    with urllib.request.urlopen(url, timeout=1) as resp:
+                        if resp.status == 200 and resp.read(1) == b'0':  # engine.io の open パケット
+                            return time.perf_counter() - start
+                except (urllib.error.URLError, ConnectionError, socket.timeout):
+                    pass
+                time.sleep(0.01)
+            raise RuntimeError('bench server did not accept a connection within %ss' % timeout)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'min_s': round(ordered[0], 4),
+        'p50_s': round(ordered[len(ordered) // 2], 4),
+        'max_s': round(ordered[-1], 4),
+    }
+
+
+def import_profile(extra, top):
+    """python -X importtime の出力を累計時間の多い順に top 件返す（[(秒, モジュール), ...]）。"""
+    with tempfile.TemporaryDirectory(prefix='videodesk-startup-') as workdir:
+        out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT,
+                             env=_env(extra, workdir), capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative) / 1e6, name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """p50 が baseline より tolerance（割合）を超えて悪化した項目を列挙する。"""
+    regressions = []
+    for name, stat in result['measurements'].items():
+        base = baseline.get('measurements', {}).get(name)
+        if base and stat['p50_s'] > base['p50_s'] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {base['p50_s']}s -> {stat['p50_s']}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='import と最初の接続を受け付けるまでの時間を測る')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='アプリに渡す環境変数（例: DB_INIT_ON_START=0）。複数指定可')
+    parser.add_argument('--timeout', type=float, default=60.0, help='1回の起動を待つ上限秒数')
+    parser.add_argument('--profile', action='store_true', help='import の内訳だけを表示して終わる')
+    parser.add_argument('--top', type=int, default=25, help='--profile で表示するモジュール数')
+    parser.add_argument('--out', default='startup-result.json', help='結果 JSON の出力先')
+    parser.add_argument('--baseline', help='比較対象の結果 JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='p50 の悪化をどこまで許すか（割合）')
+    args = parser.parse_args()
+    extra = dict(item.split('=', 1) for item in args.env)
+
+    if args.profile:
+        for seconds, name in import_profile(extra, args.top):
+            print(f'{seconds * 1000:9.1f}ms  {name}')
+        return
+
+    samples = {'import_s': [], 'first_connection_s': []}
+    for i in range(args.runs):
+        samples['import_s'].append(measure_import(extra))
+        samples['first_connection_s'].append(measure_first_connection(extra, args.timeout))
+        print(f"[startup] run {i + 1}: import={samples['import_s'][-1]:.3f}s "
+              f"first_connection={samples['first_connection_s'][-1]:.3f}s", flush=True)
+    result = {
+        'meta': {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'env': extra,
+        },
+        'measurements': {name: summarize(values) for name, values in samples.items()},
+    }
+    for name, stat in result['measurements'].items():
+        print(f"  {name:20s} min={stat['min_s']:.3f}s p50={stat['p50_s']:.3f}s max={stat['max_s']:.3f}s")
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'[startup] wrote {args.out}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare_with_baseline(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print('[startup] regression:', line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Socket.IO シグナリングのパケットサイズ・エンコード／デコード時間のベンチマーク
+
+主なイベントの1件分を、次の組み合わせで socket.io のパケットにしてバイト数と CPU 時間を比べる:
+
+  形式    json（既定）/ msgpack（SOCKETIO_SERIALIZER=msgpack）
+  スキーマ legacy  以前の形。参加者は長いキー名（total_study_time_minutes 等）と true / false、
+                  offer / answer / ice_candidate はクライアントの dict（target・sender つき）をそのまま中継
+          current 今の形。参加者は Participant.wire_state() の1文字キーと 1 / 0、
+                  中継はサーバーが sender を入れて詰め直した dict
+
+サーバーは起動せず、python-socketio のパケットクラスだけで測る（engine.io の枠は含まない）。
+
+    python bench/wire.py
+    python bench/wire.py --room-size 4 --out wire-result.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from socketio import msgpack_packet, packet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from room_model import Participant  # noqa: E402
+
+PACKETS = {'json': packet.Packet, 'msgpack': msgpack_packet.MsgPackPacket}
+
+# 実際のブラウザが送るサイズに近づけた SDP / ICE candidate（bench/signaling.py と同じ）
+FAKE_SDP = 'v=0\r\n' + 'a=candidate:0 1 UDP 2122252543 192.0.2.1 50000 typ host\r\n' * 40
+FAKE_CANDIDATE = {'candidate': 'candidate:842163049 1 udp 1677729535 198.51.100.7 61665 typ srflx '
+                               'raddr 0.0.0.0 rport 0 generation 0 ufrag abcd network-cost 999',
+                  'sdpMid': '0', 'sdpMLineIndex': 0}
+
+
+def make_participants(n):
+    return [Participant(f'sid{i:017d}', f'生徒{i}', 'admin' if i == 0 else 'student', raised=(i == 1))
+            for i in range(n)]
+
+
+def legacy_state(p, is_host, minutes):
+    return {'sid': p.sid, 'user_name': p.user_name, 'role': p.role, 'connected': p.connected,
+            'is_host': is_host, 'total_study_time_minutes': minutes, 'raised': p.raised}
+
+
+def legacy_hand_state(p):
+    return {'sid': p.sid, 'user_name': p.user_name, 'role': p.role, 'raised': p.raised}
+
+
+def make_events(room_size):
+    """イベント名 -> {'legacy': payload, 'current': payload}"""
+    people = make_participants(room_size)
+    sender, target = people[0].sid, people[1].sid
+    state_meta = {'host_sid': sender, 'rev': 42, 'mode': 'mesh', 'capacity': room_size}
+    assigned = {'room_id': 'a1b2c3d4', 'is_host': False, 'rev': 42, 'mode': 'mesh', 'capacity': room_size}
+    description = {'type': 'offer', 'sdp': FAKE_SDP}
+    return {
+        'room_assigned': {
+            'legacy': dict(assigned, participants=[legacy_state(p, i == 0, 1234) for i, p in enumerate(people)]),
+            'current': dict(assigned, participants=[p.wire_state(i == 0, 1234) for i, p in enumerate(people)]),
+        },
+        'room_state': {
+            'legacy': dict(state_meta, participants=[legacy_state(p, i == 0, 1234) for i, p in enumerate(people)]),
+            'current': dict(state_meta, participants=[p.wire_state(i == 0, 1234) for i, p in enumerate(people)]),
+        },
+        'hand_states': {
+            'legacy': {'states': [legacy_hand_state(p) for p in people]},
+            'current': {'states': [p.wire_hand_state() for p in people]},
+        },
+        'offer': {
+            'legacy': {'target': target, 'description': description, 'sender': sender},
+            'current': {'sender': sender, 'description': description},
+        },
+        'ice_candidate': {
+            'legacy': {'target': target, 'candidate': FAKE_CANDIDATE, 'sender': sender},
+            'current': {'sender': sender, 'candidate': FAKE_CANDIDATE},
+        },
+        'ice_candidates': {
+            'legacy': {'sender': sender, 'candidates': [FAKE_CANDIDATE] * 8},
+            'current': {'sender': sender, 'candidates': [FAKE_CANDIDATE] * 8},
+        },
+    }
+
+
+def encoded_size(encoded):
+    """encode() の結果のバイト数（バイナリ添付つきのパケットはリストで返るので合計する）。"""
+    parts = encoded if isinstance(encoded, list) else [encoded]
+    return sum(len(p.encode('utf-8')) if isinstance(p, str) else len(p) for p in parts)
+
+
+def measure(packet_class, event, payload, repeat):
+    pkt = packet_class(packet.EVENT, data=[event, payload], namespace='/')
+    encoded = pkt.encode()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        packet_class(packet.EVENT, data=[event, payload], namespace='/').encode()
+    encode_us = (time.perf_counter() - start) / repeat * 1e6
+    start = time.perf_counter()
+    for _ in range(repeat):
+        packet_class(encoded_packet=encoded)
+    decode_us = (time.perf_counter() - start) / repeat * 1e6
+    decoded = packet_class(encoded_packet=encoded).data
+    assert decoded == [event, payload], 'round trip mismatch'
+    return {'bytes': encoded_size(encoded), 'encode_us': round(encode_us, 2), 'decode_us': round(decode_us, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='シグナリングのパケットサイズ・エンコード時間を JSON / MessagePack で比べる')
+    parser.add_argument('--room-size', type=int, default=4, help='room_assigned / room_state の参加者数')
+    parser.add_argument('--repeat', type=int, default=20000, help='1通りあたりのエンコード・デコード回数')
+    parser.add_argument('--out', default='wire-result.json', help='結果 JSON の出力先')
+    args = parser.parse_args()
+
+    events = make_events(args.room_size)
+    results = {}
+    for event, schemas in events.items():
+        results[event] = {}
+        for schema, payload in schemas.items():
+            for fmt, packet_class in PACKETS.items():
+                results[event][f'{fmt}/{schema}'] = measure(packet_class, event, payload, args.repeat)
+
+    variants = list(next(iter(results.values())))
+    print(f"{'event':16s}" + ''.join(f'{v:>26s}' for v in variants))
+    for event, by_variant in results.items():
+        print(f'{event:16s}' + ''.join(
+            f"{r['bytes']:>7d}B {r['encode_us']:>7.1f}/{r['decode_us']:<7.1f}us" for r in by_variant.values()))
+    totals = {v: sum(results[e][v]['bytes'] for e in results) for v in variants}
+    print(f'{"total bytes":16s}' + ''.join(f'{totals[v]:>25d}B' for v in variants))
+
+    result = {
+        'meta': {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'room_size': args.room_size,
+            'repeat': args.repeat,
+        },
+        'events': results,
+        'total_bytes': totals,
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f'[wire] wrote {args.out}')
+
+
+if __name__ == '__main__':
+    main()
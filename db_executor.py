@@ -0,0 +1,47 @@
+"""
+DB 呼び出しをネイティブスレッドで実行する（eventlet tpool）
+
+psycopg2 や sqlite3 は C で書かれたドライバなので eventlet のモンキーパッチが効かず、クエリの実行中は
+ハブごと止まる（同じプロセスのソケットの中継もすべて待たされる）。run() に渡した関数は tpool の
+固定数のスレッドで実行し、待つのは呼び出し元のグリーンスレッドだけにする。
+
+- 関数は新しいアプリケーションコンテキストの中で呼ぶ。db.session はそのコンテキスト専用で、終了時に閉じる
+  ので、ORM オブジェクトではなく dict やスナップショットなどの値を返すこと。
+- スレッド内ではリクエストコンテキストがない（current_user・session は使えない）。必要な値は引数で渡す。
+  state_store（Redis）や socketio の emit、プロセス内キャッシュの更新も呼び出し元のグリーンスレッドで行う。
+- スレッド数はコネクションプールの上限（pool_size + max_overflow）以下にする（空き接続待ちで詰まらないように）。
+"""
+import time
+
+from eventlet import tpool
+
+
+class DBExecutor:
+    def __init__(self, app, threads=10, enabled=True, observe=None):
+        self.app = app
+        self.enabled = enabled and threads > 0
+        self.in_flight = 0  # 実行中 + スレッドの空き待ちの呼び出し数
+        self._observe = observe  # observe(関数名, 秒, error) — メトリクス用
+        if self.enabled:
+            tpool.set_num_threads(threads)  # 最初の execute でスレッドが作られるので、それより前に設定する
+
+    def run(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) をアプリケーションコンテキストつきで実行し、結果を返す（例外はそのまま送出）。"""
+        start = time.perf_counter()
+        self.in_flight += 1
+        error = False
+        try:
+            if self.enabled:
+                return tpool.execute(self._call, fn, args, kwargs)
+            return self._call(fn, args, kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.in_flight -= 1
+            if self._observe is not None:
+                self._observe(fn.__name__, time.perf_counter() - start, error)
+
+    def _call(self, fn, args, kwargs):
+        with self.app.app_context():
+            return fn(*args, **kwargs)
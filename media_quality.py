@@ -0,0 +1,159 @@
+"""
+映像の送信品質の調整（クライアントの getStats() の要約 → 送信ごとのエンコード上限）
+
+クライアントは MEDIA_STATS_INTERVAL 秒ごとに、つないでいる相手ごとの送信・受信の要約を media_stats で送る
+（キー名を繰り返さない配列。数値はクライアント側で丸める）:
+
+  o: 送信（映像）   [相手, 送信 kbps, 送信 fps, 送信の高さ px, 制限理由, 相手側の損失 %, RTT ms]
+  i: 受信（映像）   [相手, 受信 kbps, 受信 fps, 捨てたフレーム %]
+  b: 上り回線の推定帯域 kbps（candidate-pair の availableOutgoingBitrate。不明なら 0）
+
+相手は mesh なら相手の sid、大部屋（SFU）の送信は 'sfu'。制限理由は qualityLimitationReason
+（'none' / 'cpu' / 'bandwidth' / 'other'）。
+
+サーバーは送信1本ごとに LADDER の段（0 が最高画質）を決め、[maxBitrate bps, scaleResolutionDownBy, maxFramerate]
+として返す（クライアントが RTCRtpSender.setParameters で当てる）。基準の段は送信本数（mesh では人数-1。
+上りは全員に同じ映像を別々に送るので、本数が増えるほど1本あたりを下げる）で決め、次のときは段を下げる:
+
+  - 送信側のエンコーダーが CPU で制限されている、または帯域で制限されていて実際の送信が上限の
+    BANDWIDTH_SHORTFALL 倍に届かない（qualityLimitationReason）
+  - 相手側で損失が多い（LOSS_STEP_DOWN_PCT 以上）
+  - 受信側（相手の報告）がその映像のフレームを捨てている（DROP_STEP_DOWN_PCT 以上。相手の端末の処理が追いつかない）。
+    大部屋の送信（'sfu'）は中継サーバー経由で全員が受け取るので、受信した人たちの捨てた割合の中央値で判断する
+    （1台だけ遅い端末があっても、全員に届く映像は下げない）
+
+下げるのはすぐ、上げるのは問題のない報告が STEP_UP_AFTER 回続いてから1段ずつ（行ったり来たりしないように）。
+上りの推定帯域が分かるときは、1本あたりのビットレートを 推定帯域 × UPLINK_HEADROOM / 本数 以下にする。
+"""
+import time
+
+# 段: (maxBitrate kbps, scaleResolutionDownBy, maxFramerate)。0 が最高画質
+LADDER = (
+    (1500, 1.0, 30),
+    (800, 1.0, 24),
+    (500, 1.5, 20),
+    (300, 2.0, 15),
+    (150, 3.0, 10),
+)
+LIMIT_REASONS = ('none', 'cpu', 'bandwidth', 'other')
+LOSS_STEP_DOWN_PCT = 8
+DROP_STEP_DOWN_PCT = 20
+STEP_UP_AFTER = 3
+UPLINK_HEADROOM = 0.85
+BANDWIDTH_SHORTFALL = 0.7
+MIN_BITRATE_KBPS = 100
+MAX_LINKS = 64  # 1回の報告で受け付ける相手の数（大部屋の受信は人数ぶんある）
+
+
+def base_level(links):
+    """送信本数ごとの基準の段（1本なら最高画質、3本で LADDER[2]）。"""
+    return min(max(links - 1, 0), len(LADDER) - 1)
+
+
+def _num(value, upper):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return 0
+    return min(max(value, 0), upper) if value == value else 0  # NaN は 0
+
+
+class MediaReport:
+    """1クライアントの直近の報告と、送信ごとに決めた段。
+
+    outbound: 相手 -> [kbps, fps, 高さ, 制限理由, 損失 %, RTT ms]
+    inbound:  相手 -> [kbps, fps, 捨てたフレーム %]
+    levels:   相手 -> [段, 問題のない報告が続いた回数]
+    hints:    相手 -> 最後に決めた [bps, 縮小率, fps]（変わったときだけクライアントへ送るため）
+    """
+    __slots__ = ('room_id', 'at', 'outbound', 'inbound', 'available_kbps', 'levels', 'hints')
+
+    def __init__(self, room_id, at, outbound, inbound, available_kbps, levels=None, hints=None):
+        self.room_id = room_id
+        self.at = at
+        self.outbound = outbound
+        self.inbound = inbound
+        self.available_kbps = available_kbps
+        self.levels = levels if levels is not None else {}
+        self.hints = hints if hints is not None else {}
+
+    @classmethod
+    def parse(cls, room_id, data, now=None):
+        """クライアントの media_stats を検証・丸めして MediaReport にする（形が違えば None）。"""
+        if not isinstance(data, dict):
+            return None
+        outbound, inbound = {}, {}
+        for row in (data.get('o') or [])[:MAX_LINKS]:
+            if isinstance(row, list) and len(row) >= 7 and isinstance(row[0], str):
+                reason = row[4] if row[4] in LIMIT_REASONS else 'other'
+                outbound[row[0]] = [_num(row[1], 1e5), _num(row[2], 120), _num(row[3], 4320), reason,
+                                    _num(row[5], 100), _num(row[6], 1e4)]
+        for row in (data.get('i') or [])[:MAX_LINKS]:
+            if isinstance(row, list) and len(row) >= 4 and isinstance(row[0], str):
+                inbound[row[0]] = [_num(row[1], 1e5), _num(row[2], 120), _num(row[3], 100)]
+        return cls(room_id, time.time() if now is None else now, outbound, inbound, _num(data.get('b'), 1e6))
+
+    def to_json(self):
+        return [self.room_id, self.at, self.outbound, self.inbound, self.available_kbps, self.levels, self.hints]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data)
+
+    def update_levels(self, sid, previous, receiver_reports):
+        """送信ごとの段を決めて self.levels に、クライアントに渡すヒント（相手 -> [bps, 縮小率, fps]）を self.hints に入れる。
+
+        sid はこのクライアント、previous はその前回の報告（段の履歴を引き継ぐ）、
+        receiver_reports は相手 -> その送信を受け取っている人たちの MediaReport のリスト（mesh では相手1人、
+        大部屋の 'sfu' ではほかの参加者。各報告の inbound[sid] が sid からの映像の受け取り方）。
+        """
+        links = len(self.outbound)
+        hints = {}
+        for peer, (sent_kbps, _, _, reason, loss, _) in self.outbound.items():
+            target = base_level(links)
+            level, clean = (previous.levels.get(peer) if previous else None) or [target, 0]
+            # 'bandwidth' はこちらが当てた maxBitrate に当たっているだけでも出るので、上限よりかなり少ないときだけ数える
+            # 送信 kbps が 0 なのはまだ測れていない（つないだ直後）とき
+            pressured = (reason == 'cpu' or loss >= LOSS_STEP_DOWN_PCT
+                         or (reason == 'bandwidth' and 0 < sent_kbps < LADDER[level][0] * BANDWIDTH_SHORTFALL))
+            drops = sorted(r.inbound[sid][2] for r in receiver_reports.get(peer, ()) if sid in r.inbound)
+            if drops and drops[len(drops) // 2] >= DROP_STEP_DOWN_PCT:
+                pressured = True
+            if pressured:
+                level, clean = min(max(level, target) + 1, len(LADDER) - 1), 0
+            elif level > target:
+                clean += 1
+                if clean >= STEP_UP_AFTER:
+                    level, clean = level - 1, 0
+            else:
+                level, clean = target, 0
+            self.levels[peer] = [level, clean]
+            kbps, scale, fps = LADDER[level]
+            if self.available_kbps:
+                kbps = min(kbps, self.available_kbps * UPLINK_HEADROOM / links)
+            hints[peer] = [int(max(kbps, MIN_BITRATE_KBPS) * 1000), scale, fps]
+        self.hints = hints
+        return hints
+
+
+def summarize(reports):
+    """同じルームのクライアントの報告をまとめる（管理者向け）。reports は sid -> MediaReport。"""
+    send = sorted(sum(o[0] for o in r.outbound.values()) for r in reports.values())
+    rtts = [o[5] for r in reports.values() for o in r.outbound.values() if o[5]]
+    losses = [o[4] for r in reports.values() for o in r.outbound.values()]
+    drops = [i[2] for r in reports.values() for i in r.inbound.values()]
+    limited = {}
+    for r in reports.values():
+        for o in r.outbound.values():
+            if o[3] != 'none':
+                limited[o[3]] = limited.get(o[3], 0) + 1
+    levels = [lv[0] for r in reports.values() for lv in r.levels.values()]
+    return {
+        'clients': len(reports),
+        'send_kbps': {'min': round(send[0]), 'p50': round(send[len(send) // 2]), 'max': round(send[-1])} if send else None,
+        'rtt_ms_max': round(max(rtts)) if rtts else None,
+        'loss_pct_max': round(max(losses), 1) if losses else None,
+        'dropped_frames_pct_max': round(max(drops), 1) if drops else None,
+        'quality_limited': limited,
+        'levels': {str(n): levels.count(n) for n in sorted(set(levels))},
+    }
@@ -0,0 +1,285 @@
+"""
+大部屋（SFU）用のメディア中継サーバー
+
+mesh（4人ルーム）は参加者どうしが直接つなぐので、人数が増えると各自の送信本数（人数-1）が足りなくなる。
+大部屋では各自が映像・音声をこのサーバーへ1本だけ送り（publish）、ほかの参加者の分はここから1本ずつ
+受け取る（subscribe）。受信側はホスト・挙手中の人だけ元の解像度（full）、それ以外は縮小版（thumb、
+幅 SFU_THUMB_WIDTH）を受け取り、/quality で再ネゴシエーションなしに切り替える。
+
+aiortc は asyncio で動くので、eventlet で動くアプリ本体とは別プロセスにしている。
+アプリとは SFU_SECRET を共有し、アプリが入室時に渡すトークン（ルーム・sid への署名）で相手を確認する。
+シグナリングは HTTP の offer / answer 1往復（ICE 候補は SDP にまとめて送る）:
+
+  POST /publish    {token, sdp, type}                       自分の映像・音声を送り始める
+  POST /subscribe  {token, publisher, quality, sdp, type}   同じルームの publisher の映像・音声を受け取る
+  POST /quality    {token, publisher, quality}              受信中の映像を full / thumb に切り替える
+  POST /leave      {token}                                  送受信をすべて止める
+  GET  /healthz
+
+ブラウザから preflight なしで送れるよう、本文は Content-Type を問わず JSON として読む。
+
+    pip install -r requirements-sfu.txt
+    SFU_SECRET=... python media_relay.py --port 8090
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamTrack
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+logger = logging.getLogger('media_relay')
+
+SFU_SECRET = os.environ.get('SFU_SECRET') or os.environ.get('SECRET_KEY') or 'fallback_secret_key_for_local'
+SFU_TOKEN_MAX_AGE = int(os.environ.get('SFU_TOKEN_MAX_AGE', 12 * 60 * 60))  # 秒
+SFU_THUMB_WIDTH = int(os.environ.get('SFU_THUMB_WIDTH', 320))               # 縮小版の幅（px）
+SFU_SUBSCRIBE_WAIT = float(os.environ.get('SFU_SUBSCRIBE_WAIT', 10))        # 秒。相手の publish を待つ上限
+SFU_ALLOWED_ORIGIN = os.environ.get('SFU_ALLOWED_ORIGIN', '*')
+QUALITIES = ('full', 'thumb')
+
+signer = URLSafeTimedSerializer(SFU_SECRET, salt='sfu')
+relay = MediaRelay()
+publishers = {}     # (room, sid) -> Publisher
+subscriptions = {}  # (room, 受信側 sid) -> { publisher sid: Subscription }
+
+
+class ScalableTrack(MediaStreamTrack):
+    """元の映像を幅 width 以下に縮小して返す（縦横比は保つ）。1人の publisher につき1つを全受信者で共有する。"""
+
+    kind = 'video'
+
+    def __init__(self, source, width):
+        super().__init__()
+        self.source = source
+        self.width = width
+
+    async def recv(self):
+        frame = await self.source.recv()
+        if frame.width <= self.width:
+            return frame
+        height = max(2, round(frame.height * self.width / frame.width) & ~1)  # エンコーダーは偶数サイズが必要
+        scaled = frame.reformat(width=self.width, height=height)
+        scaled.pts, scaled.time_base = frame.pts, frame.time_base
+        return scaled
+
+    def stop(self):
+        super().stop()
+        self.source.stop()
+
+
+class Publisher:
+    __slots__ = ('room', 'sid', 'pc', 'tracks', 'thumb')
+
+    def __init__(self, room, sid, pc):
+        self.room = room
+        self.sid = sid
+        self.pc = pc
+        self.tracks = {}   # kind -> 受信した元のトラック
+        self.thumb = None  # ScalableTrack（最初に thumb で受信されたときに作る）
+
+    def track_for(self, kind, quality):
+        """受信者1人分のトラックを返す。映像は古いフレームを溜めない（遅れたら捨てて最新を送る）。"""
+        source = self.tracks[kind]
+        if kind != 'video':
+            return relay.subscribe(source)
+        if quality == 'thumb':
+            if self.thumb is None:
+                self.thumb = ScalableTrack(relay.subscribe(source, buffered=False), SFU_THUMB_WIDTH)
+            source = self.thumb
+        return relay.subscribe(source, buffered=False)
+
+
+class Subscription:
+    __slots__ = ('pc', 'senders', 'quality')
+
+    def __init__(self, pc, senders, quality):
+        self.pc = pc
+        self.senders = senders  # kind -> RTCRtpSender
+        self.quality = quality
+
+
+def _identity(data):
+    try:
+        claims = signer.loads(data.get('token') or '', max_age=SFU_TOKEN_MAX_AGE)
+    except BadSignature:
+        raise web.HTTPForbidden()
+    return claims['room'], claims['sid']
+
+
+async def _read(request):
+    try:
+        data = json.loads(await request.text())
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest()
+    return data
+
+
+def _answer(pc):
+    return web.json_response({'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type})
+
+
+async def _close_subscription(sub):
+    for sender in sub.senders.values():
+        if sender.track:
+            sender.track.stop()
+    await sub.pc.close()
+
+
+async def close_publisher(room, sid, pc=None):
+    """publisher を外し、その映像を受信している接続もすべて閉じる（pc を渡すと、その接続のときだけ）。"""
+    pub = publishers.get((room, sid))
+    if pub is None or (pc is not None and pub.pc is not pc):
+        return
+    del publishers[(room, sid)]
+    for (sub_room, _), subs in list(subscriptions.items()):
+        sub = subs.pop(sid, None) if sub_room == room else None
+        if sub:
+            await _close_subscription(sub)
+    if pub.thumb:
+        pub.thumb.stop()
+    await pub.pc.close()
+
+
+async def close_subscriptions(room, sid):
+    for sub in (subscriptions.pop((room, sid), None) or {}).values():
+        await _close_subscription(sub)
+
+
+async def publish(request):
+    data = await _read(request)
+    room, sid = _identity(data)
+    await close_publisher(room, sid)  # 入り直し（カメラの切り替え・再接続）なら前の分を置き換える
+    pc = RTCPeerConnection()
+    pub = Publisher(room, sid, pc)
+
+    @pc.on('track')
+    def on_track(track):
+        pub.tracks[track.kind] = track
+
+    @pc.on('connectionstatechange')
+    async def on_state():
+        if pc.connectionState in ('failed', 'closed'):
+            await close_publisher(room, sid, pc)
+
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=data.get('sdp', ''), type=data.get('type', 'offer')))
+    await pc.setLocalDescription(await pc.createAnswer())
+    publishers[(room, sid)] = pub
+    logger.info('publish room=%s sid=%s tracks=%s', room, sid, sorted(pub.tracks))
+    return _answer(pc)
+
+
+async def _wait_publisher(room, sid):
+    """入室直後は相手の publish がまだ終わっていないことがあるので、SFU_SUBSCRIBE_WAIT 秒まで待つ。"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SFU_SUBSCRIBE_WAIT
+    while (room, sid) not in publishers and loop.time() < deadline:
+        await asyncio.sleep(0.2)
+    return publishers.get((room, sid))
+
+
+async def subscribe(request):
+    data = await _read(request)
+    room, sid = _identity(data)
+    target = data.get('publisher')
+    quality = data.get('quality') if data.get('quality') in QUALITIES else 'thumb'
+    pub = await _wait_publisher(room, target)
+    if pub is None:
+        raise web.HTTPNotFound()
+    pc = RTCPeerConnection()
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=data.get('sdp', ''), type=data.get('type', 'offer')))
+    senders = {kind: pc.addTrack(pub.track_for(kind, quality)) for kind in ('audio', 'video') if kind in pub.tracks}
+    await pc.setLocalDescription(await pc.createAnswer())
+
+    old = subscriptions.setdefault((room, sid), {}).pop(target, None)
+    if old:
+        await _close_subscription(old)
+    sub = subscriptions[(room, sid)][target] = Subscription(pc, senders, quality)
+
+    @pc.on('connectionstatechange')
+    async def on_state():
+        if pc.connectionState in ('failed', 'closed') and subscriptions.get((room, sid), {}).get(target) is sub:
+            del subscriptions[(room, sid)][target]
+            await _close_subscription(sub)
+
+    return _answer(pc)
+
+
+async def set_quality(request):
+    data = await _read(request)
+    room, sid = _identity(data)
+    target = data.get('publisher')
+    quality = data.get('quality')
+    sub = subscriptions.get((room, sid), {}).get(target)
+    pub = publishers.get((room, target))
+    if quality not in QUALITIES or sub is None or pub is None or 'video' not in sub.senders:
+        raise web.HTTPNotFound()
+    if quality != sub.quality:
+        sender = sub.senders['video']
+        old = sender.track
+        sender.replaceTrack(pub.track_for('video', quality))  # 解像度が変わるとエンコーダーは作り直される
+        if old:
+            old.stop()
+        sub.quality = quality
+    return web.json_response({'ok': True, 'quality': quality})
+
+
+async def leave(request):
+    data = await _read(request)
+    room, sid = _identity(data)
+    await close_subscriptions(room, sid)
+    await close_publisher(room, sid)
+    return web.json_response({'ok': True})
+
+
+async def healthz(request):
+    return web.json_response({'publishers': len(publishers),
+                              'subscriptions': sum(len(subs) for subs in subscriptions.values())})
+
+
+@web.middleware
+async def cors(request, handler):
+    try:
+        response = await handler(request)
+    except web.HTTPException as exc:
+        exc.headers['Access-Control-Allow-Origin'] = SFU_ALLOWED_ORIGIN
+        raise
+    response.headers['Access-Control-Allow-Origin'] = SFU_ALLOWED_ORIGIN
+    return response
+
+
+async def _on_shutdown(app):
+    for room, sid in list(subscriptions):
+        await close_subscriptions(room, sid)
+    for room, sid in list(publishers):
+        await close_publisher(room, sid)
+
+
+def create_app():
+    app = web.Application(middlewares=[cors])
+    app.router.add_post('/publish', publish)
+    app.router.add_post('/subscribe', subscribe)
+    app.router.add_post('/quality', set_quality)
+    app.router.add_post('/leave', leave)
+    app.router.add_get('/healthz', healthz)
+    app.on_shutdown.append(_on_shutdown)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='大部屋（SFU）用のメディア中継サーバー')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8090)))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Prometheus 形式のメトリクス（/metrics）
+
+Socket.IO ハンドラと Flask ルートの呼び出し回数・エラー回数・処理時間のヒストグラムを記録する。
+記録はプロセス内の dict とリストへの加算だけ（ロックなし。eventlet の協調スケジューリング下では
+加算の途中で切り替わらない）。ヒストグラムは該当バケット1つだけを加算し、累積値は出力時に計算する。
+
+ルーム数・参加者数などのゲージと、流量制限で捨てた数などほかのモジュールが数えているカウンタは、
+スクレイプされたときに登録済みのコールバックを呼んで算出するので、誰も /metrics を見ていなければ
+計算コストはかからない。値はワーカー（プロセス）ごと。
+"""
+import time
+from bisect import bisect_left
+
+# 秒。シグナリングの中継は数ミリ秒、DB を触るルートは数十ミリ秒を想定
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'total', 'errors')
+
+    def __init__(self, size):
+        self.counts = [0] * size  # 最後の要素は +Inf
+        self.total = 0.0
+        self.errors = 0
+
+
+class Metrics:
+    def __init__(self, prefix='videodesk_', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        # (ファミリー名, ラベル値) -> _Histogram
+        self._histograms = {}
+        self._help = {}
+        self._callbacks = []  # [(fn, 'gauge' | 'counter'), ...]
+
+    def observe(self, family, label, seconds, error=False):
+        key = (family, label)
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = _Histogram(len(self.buckets) + 1)
+        hist.counts[bisect_left(self.buckets, seconds)] += 1
+        hist.total += seconds
+        if error:
+            hist.errors += 1
+
+    def describe(self, family, label_name, help_text):
+        self._help[family] = (label_name, help_text)
+
+    def wrap(self, family, label, fn):
+        """fn の呼び出しを計測するラッパーを返す（例外は数えてから再送出する）。"""
+        observe = self.observe
+        clock = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                observe(family, label, clock() - start, error=True)
+                raise
+            observe(family, label, clock() - start)
+            return result
+
+        wrapper.__wrapped__ = fn
+        return wrapper
+
+    def instrument_socketio(self, socketio, namespace='/'):
+        """登録済みの Socket.IO ハンドラをすべて計測つきに差し替える（ハンドラ定義の後で呼ぶ）。"""
+        self.describe('socketio_handler_seconds', 'event', 'Socket.IO event handler latency in seconds.')
+        handlers = socketio.server.handlers.get(namespace, {})
+        for event, handler in list(handlers.items()):
+            if getattr(handler, '_metrics', False):
+                continue  # 二重に計測しない
+            wrapped = self.wrap('socketio_handler_seconds', event, handler)
+            wrapped._metrics = True
+            handlers[event] = wrapped
+
+    def instrument_flask(self, app):
+        """Flask のリクエストをエンドポイント名ごとに計測する（5xx と未処理の例外をエラーとして数える）。"""
+        from flask import g, request
+
+        self.describe('http_request_seconds', 'endpoint', 'Flask request latency in seconds by endpoint.')
+
+        @app.before_request
+        def _metrics_start():
+            g._metrics_start = time.perf_counter()
+
+        @app.after_request
+        def _metrics_status(response):
+            g._metrics_status = response.status_code
+            return response
+
+        @app.teardown_request
+        def _metrics_finish(exc):
+            start = g.pop('_metrics_start', None)
+            if start is None:
+                return
+            error = exc is not None or g.pop('_metrics_status', 200) >= 500
+            self.observe('http_request_seconds', request.endpoint or 'unmatched', time.perf_counter() - start, error)
+
+    def gauge_callback(self, fn):
+        """スクレイプ時に呼ぶゲージ関数を登録する（デコレータ）。
+
+        fn() は (メトリクス名, 説明, [(ラベル dict, 値), ...]) のリストを返す。
+        """
+        self._callbacks.append((fn, 'gauge'))
+        return fn
+
+    def counter_callback(self, fn):
+        """gauge_callback と同じ形で、ほかのモジュールが数えている累積値をカウンタとして出力する。"""
+        self._callbacks.append((fn, 'counter'))
+        return fn
+
+    def render(self):
+        """Prometheus のテキスト形式（version 0.0.4）で出力する。"""
+        lines = []
+        by_family = {}
+        for (family, label), hist in sorted(self._histograms.items()):
+            by_family.setdefault(family, []).append((label, hist))
+        for family, entries in by_family.items():
+            name = self.prefix + family
+            label_name, help_text = self._help.get(family, ('name', family))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for label, hist in entries:
+                lv = f'{label_name}="{_escape(label)}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{lv},le="{bound}"}} {cumulative}')
+                cumulative += hist.counts[-1]
+                lines.append(f'{name}_bucket{{{lv},le="+Inf"}} {cumulative}')
+                lines.append(f'{name}_sum{{{lv}}} {hist.total:.6f}')
+                lines.append(f'{name}_count{{{lv}}} {cumulative}')
+            errors_name = name.replace('_seconds', '') + '_errors_total'
+            lines.append(f'# HELP {errors_name} Calls that raised or returned a server error.')
+            lines.append(f'# TYPE {errors_name} counter')
+            for label, hist in entries:
+                lines.append(f'{errors_name}{{{label_name}="{_escape(label)}"}} {hist.errors}')
+
+        for fn, kind in self._callbacks:
+            for metric, help_text, samples in fn():
+                name = self.prefix + metric
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    if labels:
+                        lv = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                        lines.append(f'{name}{{{lv}}} {value}')
+                    else:
+                        lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
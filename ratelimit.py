@@ -0,0 +1,169 @@
+"""
+Socket.IO イベントの流量制限と送信キューの監視
+
+RateLimiter: sid × イベント種別ごとのトークンバケットと、イベントごとのペイロードサイズ上限。
+  超えたイベントはハンドラを呼ばずに捨て、ack には {'ok': False, 'error': ...} を返す。
+  捨てられ続ける（再接続ループ中のタブなど）sid は disconnect_after 回連続で切断する。
+OutboundMonitor: engine.io ソケットごとの送信キュー（まだ送れていないパケット数）を見る。
+  drop_depth 以上の相手には間引いてよい中継（ICE candidate）を送らず、disconnect_depth 以上の
+  遅い受信者は切断する（クライアントは再接続し、猶予内なら同じ席に戻る）。
+
+どちらも捨てた数・切断した数をプロセス内のカウンタに持ち、/metrics から読む。値はワーカーごと。
+"""
+import time
+
+
+def payload_size(value, limit):
+    """value のおおよそのバイト数（文字列・バイト列の長さの合計）。limit を超えた時点で数えるのをやめる。"""
+    total = 0
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, (str, bytes)):
+            total += len(v)
+        elif isinstance(v, dict):
+            stack.extend(v.keys())
+            stack.extend(v.values())
+        elif isinstance(v, (list, tuple)):
+            stack.extend(v)
+        else:
+            total += 8
+        if total > limit:
+            break
+    return total
+
+
+def parse_rules(spec):
+    """'offer=5/20,ice_candidate=50/200' を {イベント: (毎秒の補充数, バケットの容量)} にする。"""
+    rules = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        event, _, value = item.partition('=')
+        rate, _, burst = value.partition('/')
+        rules[event.strip()] = (float(rate), float(burst or rate))
+    return rules
+
+
+class RateLimiter:
+    def __init__(self, rules, default=None, max_bytes=None, disconnect_after=0):
+        self.rules = dict(rules)              # イベント -> (毎秒の補充数, 容量)。default はそれ以外のイベント
+        self.default = default
+        self.max_bytes = dict(max_bytes or {})  # イベント -> 上限バイト数（'*' はそれ以外のイベント）
+        self.disconnect_after = disconnect_after  # この回数連続で捨てたら切断（0 で切断しない）
+        self._buckets = {}   # sid -> { イベント: [残りトークン, 最終更新時刻] }
+        self._strikes = {}   # sid -> 連続で捨てた回数
+        self.dropped = {}    # (イベント, 理由) -> 回数
+        self.disconnects = 0
+
+    def check(self, sid, event, data):
+        """受け付けるなら None、捨てるなら理由（'too_large' / 'rate_limited'）を返す。"""
+        limit = self.max_bytes.get(event, self.max_bytes.get('*'))
+        if limit is not None and payload_size(data, limit) > limit:
+            return 'too_large'
+        rule = self.rules.get(event, self.default)
+        if rule is None:
+            return None
+        rate, burst = rule
+        now = time.monotonic()
+        buckets = self._buckets.get(sid)
+        if buckets is None:
+            buckets = self._buckets[sid] = {}
+        bucket = buckets.get(event)
+        if bucket is None:
+            bucket = buckets[event] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return 'rate_limited'
+        bucket[0] -= 1
+        return None
+
+    def forget(self, sid):
+        self._buckets.pop(sid, None)
+        self._strikes.pop(sid, None)
+
+    def instrument_socketio(self, socketio, namespace='/', exempt=('connect', 'disconnect')):
+        """登録済みの Socket.IO ハンドラの前に制限をかける（ハンドラ定義・メトリクスの差し込みより後で呼ぶ）。"""
+        handlers = socketio.server.handlers.get(namespace, {})
+        for event, handler in list(handlers.items()):
+            if getattr(handler, '_ratelimit', False):
+                continue
+            if event == 'disconnect':
+                wrapped = self._wrap_disconnect(handler)
+            elif event in exempt:
+                continue
+            else:
+                wrapped = self._wrap(socketio, namespace, event, handler)
+            wrapped._ratelimit = True
+            handlers[event] = wrapped
+
+    def _wrap(self, socketio, namespace, event, handler):
+        def wrapper(sid, *args):
+            reason = self.check(sid, event, args[0] if args else None)
+            if reason is None:
+                self._strikes.pop(sid, None)
+                return handler(sid, *args)
+            key = (event, reason)
+            self.dropped[key] = self.dropped.get(key, 0) + 1
+            strikes = self._strikes[sid] = self._strikes.get(sid, 0) + 1
+            if self.disconnect_after and strikes >= self.disconnect_after:
+                self.disconnects += 1
+                self.forget(sid)
+                socketio.server.disconnect(sid, namespace=namespace)
+            return {'ok': False, 'error': reason}
+
+        wrapper.__wrapped__ = handler
+        return wrapper
+
+    def _wrap_disconnect(self, handler):
+        def wrapper(sid, *args):
+            try:
+                return handler(sid, *args)
+            finally:
+                self.forget(sid)
+
+        wrapper.__wrapped__ = handler
+        return wrapper
+
+
+class OutboundMonitor:
+    def __init__(self, socketio, drop_depth=256, disconnect_depth=1024, namespace='/'):
+        self.socketio = socketio
+        self.namespace = namespace
+        self.drop_depth = drop_depth
+        self.disconnect_depth = disconnect_depth
+        self.dropped = {}  # イベント -> 遅い受信者宛てに送らなかった回数
+        self.disconnects = 0
+
+    def depth(self, sid):
+        """sid の送信キューに溜まっているパケット数（このワーカーに接続していない sid は 0）。"""
+        server = self.socketio.server
+        eio_sid = server.manager.eio_sid_from_sid(sid, self.namespace)
+        sock = server.eio.sockets.get(eio_sid) if eio_sid else None
+        return sock.queue.qsize() if sock is not None else 0
+
+    def should_drop(self, sid, event):
+        """sid 宛ての event を間引くべきなら数えて True を返す。"""
+        if self.drop_depth <= 0 or self.depth(sid) < self.drop_depth:
+            return False
+        self.dropped[event] = self.dropped.get(event, 0) + 1
+        return True
+
+    def max_depth(self):
+        return max((s.queue.qsize() for s in list(self.socketio.server.eio.sockets.values())), default=0)
+
+    def sweep(self):
+        """送信キューが disconnect_depth を超えたソケットを切断する（溜まった送信は破棄する）。"""
+        if self.disconnect_depth <= 0:
+            return
+        for sock in list(self.socketio.server.eio.sockets.values()):
+            if not sock.closed and sock.queue.qsize() >= self.disconnect_depth:
+                self.disconnects += 1
+                sock.close(wait=False, abort=True)
+
+    def run(self, interval):
+        while True:
+            self.socketio.sleep(interval)
+            self.sweep()
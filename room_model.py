@@ -0,0 +1,188 @@
+"""
+ルーム・参加者のデータモデル（__slots__ つき）
+
+メインルームは Room（入室順の参加者リスト。先頭がホスト）、個別指導は PrivateSession。
+Room.mode は映像の配り方: 'mesh'（全員が互いに直接つなぐ。定員 4）または 'sfu'（各自が中継サーバー
+media_relay.py に1本だけ送り、中継サーバーがほかの参加者へ配る。定員は capacity でルームごとに決める）。
+挙手・接続状態は Participant のフィールドとして持つので、ルームごとの別 dict を引いて整合を取る必要がない。
+
+MemoryStateStore ではオブジェクトをそのまま保持する。RedisStateStore では to_json() / from_json() で
+キー名を繰り返さない JSON 配列に変換して保存する（state_store.namespace(name, model=...)）。
+created_at・mode・capacity は後から足したので配列の末尾に置き、ない（古い形式の）データは既定値にする。
+
+クライアントへ送る参加者リスト（room_assigned / room_state）と挙手一覧（hand_states）は人数ぶんキー名が
+繰り返されるので、Participant.wire_state() / wire_hand_state() の1文字キーで送る（room.js の expandParticipant が
+元の名前に戻す）: s=sid n=user_name r=role c=connected h=is_host t=total_study_time_minutes q=raised（真偽値は 1 / 0）。
+
+ChatHistory は個別指導チャットの直近の発言（セッションごとのリングバッファ）。
+
+summary() は管理者向けのルーム一覧に載せる要約（作成時刻と参加者の名前・役割・接続・挙手、メインルームは定員と mode）。
+"""
+import time
+
+
+class Participant:
+    __slots__ = ('sid', 'user_name', 'role', 'user_id', 'user_db_id', 'connected', 'raised')
+
+    def __init__(self, sid, user_name='', role='student', user_id=None, user_db_id=None,
+                 connected=True, raised=False):
+        self.sid = sid
+        self.user_name = user_name
+        self.role = role
+        self.user_id = user_id          # クライアント側 UUID（再接続で同じ席に戻るため）
+        self.user_db_id = user_db_id    # User.id（総勉強時間の表示用）
+        self.connected = connected      # False = 切断中（再接続猶予で席をキープ）
+        self.raised = raised            # 挙手中か
+
+    def to_json(self):
+        return [self.sid, self.user_name, self.role, self.user_id, self.user_db_id, self.connected, self.raised]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data)
+
+    def wire_state(self, is_host, total_study_time_minutes):
+        return {'s': self.sid, 'n': self.user_name, 'r': self.role, 'c': int(self.connected), 'h': int(is_host),
+                't': total_study_time_minutes, 'q': int(self.raised)}
+
+    def wire_hand_state(self):
+        return {'s': self.sid, 'n': self.user_name, 'r': self.role, 'q': int(self.raised)}
+
+
+class _Members:
+    """参加者リストの共通操作（人数が少ないので線形探索で十分速い）。"""
+    __slots__ = ()
+
+    def index(self, sid):
+        for i, p in enumerate(self.participants):
+            if p.sid == sid:
+                return i
+        return None
+
+    def get(self, sid):
+        for p in self.participants:
+            if p.sid == sid:
+                return p
+        return None
+
+    def remove(self, sid):
+        """sid を外し、(元の位置, 外した Participant) を返す（いなければ (None, None)）。"""
+        i = self.index(sid)
+        if i is None:
+            return None, None
+        return i, self.participants.pop(i)
+
+
+class Room(_Members):
+    """メインルーム。participants は入室順で、先頭がホスト。"""
+    __slots__ = ('room_id', 'participants', 'created_at', 'mode', 'capacity')
+
+    MESH_CAPACITY = 4  # 全員が互いに送り合うので、これより多いと各自の上り回線が足りなくなる
+
+    def __init__(self, room_id, participants=None, created_at=None, mode='mesh', capacity=None):
+        self.room_id = room_id
+        self.participants = participants if participants is not None else []
+        self.created_at = created_at or time.time()
+        self.mode = mode
+        self.capacity = capacity or self.MESH_CAPACITY
+
+    @property
+    def is_full(self):
+        return len(self.participants) >= self.capacity
+
+    @property
+    def host(self):
+        return self.participants[0] if self.participants else None
+
+    def connected_count(self):
+        return sum(1 for p in self.participants if p.connected)
+
+    def summary(self):
+        return ['main', self.created_at, [[p.user_name, p.role, p.connected, p.raised] for p in self.participants],
+                self.capacity, self.mode]
+
+    def to_json(self):
+        return [self.room_id, [p.to_json() for p in self.participants], self.created_at, self.mode, self.capacity]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data[0], [Participant.from_json(p) for p in data[1]], *data[2:5])
+
+
+class PrivateSession(_Members):
+    """個別指導セッション。participants は個別ルームに入室済みの参加者。"""
+    __slots__ = ('session_id', 'main_room', 'admin_sid', 'student_sid', 'participants', 'created_at')
+
+    def __init__(self, session_id, main_room, admin_sid, student_sid, participants=None, created_at=None):
+        self.session_id = session_id
+        self.main_room = main_room
+        self.admin_sid = admin_sid
+        self.student_sid = student_sid
+        self.participants = participants if participants is not None else []
+        self.created_at = created_at or time.time()
+
+    def other_sid(self, sid):
+        return self.student_sid if sid == self.admin_sid else self.admin_sid
+
+    def put(self, participant):
+        """入室（同じ sid がいれば置き換える）。"""
+        i = self.index(participant.sid)
+        if i is None:
+            self.participants.append(participant)
+        else:
+            self.participants[i] = participant
+
+    def summary(self):
+        return ['private', self.created_at, [[p.user_name, p.role, p.connected, p.raised] for p in self.participants],
+                self.main_room]
+
+    def to_json(self):
+        return [self.session_id, self.main_room, self.admin_sid, self.student_sid,
+                [p.to_json() for p in self.participants], self.created_at]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data[:4], [Participant.from_json(p) for p in data[4]], *data[5:6])
+
+
+class ChatHistory:
+    """個別指導チャットの直近の発言。件数・バイト数の上限を超えたら古いものから捨てる。
+
+    messages は古い順の [id, sender_sid, user_name, kind, body, sent_at]。kind は 'text'（body は本文）か
+    'image'（body は添付ID。画像や data URL そのものは持たない）。id はセッション内の通し番号。
+    """
+    __slots__ = ('messages', 'next_id', 'size')
+
+    def __init__(self, messages=None, next_id=1):
+        self.messages = messages if messages is not None else []
+        self.next_id = next_id
+        self.size = sum(self._bytes(m) for m in self.messages)
+
+    @staticmethod
+    def _bytes(message):
+        return len(message[2].encode('utf-8')) + len(message[4].encode('utf-8'))
+
+    @property
+    def first_id(self):
+        return self.messages[0][0] if self.messages else self.next_id
+
+    def append(self, sender_sid, user_name, kind, body, max_messages, max_bytes):
+        """発言を足して返す。上限を超えた分は古いものから捨てる（最新の1件は残す）。"""
+        message = [self.next_id, sender_sid, user_name, kind, body, time.time()]
+        self.next_id += 1
+        self.messages.append(message)
+        self.size += self._bytes(message)
+        while len(self.messages) > 1 and (len(self.messages) > max_messages or self.size > max_bytes):
+            self.size -= self._bytes(self.messages.pop(0))
+        return message
+
+    def after(self, last_id):
+        """last_id より新しい発言（古い順）。"""
+        return [m for m in self.messages if m[0] > last_id]
+
+    def to_json(self):
+        return [self.next_id, self.messages]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data[1], data[0])
@@ -0,0 +1,48 @@
+"""
+ルーム状態のスナップショット（プロセス内 dict で動かすときの再起動対策）
+
+STATE_STORE_URL なし（MemoryStateStore）ではルーム状態がプロセスと一緒に消えるので、定期的に・停止時に
+ローカルファイルへ書き出し、次の起動時に読み戻す。書き込みは一時ファイルに書いてから os.replace で
+置き換えるので、途中で落ちても前回のファイルが残る。
+
+形式はキー名を繰り返さない JSON（Room.to_json() の配列）。
+{ "v": 1, "saved_at": UNIX 秒, "rooms": [...], "revs": { room_id: rev }, "profiles": { User.id: profile } }
+"""
+import json
+import os
+import time
+
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(path, rooms, revs, profiles):
+    """スナップショットを path に書き、書いたバイト数を返す。"""
+    data = json.dumps({
+        'v': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'rooms': rooms,
+        'revs': revs,
+        'profiles': profiles,
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(data)
+
+
+def read_snapshot(path, max_age):
+    """max_age 秒以内に書かれたスナップショットを返す。ない・壊れている・古い・形式が違うなら None。"""
+    try:
+        with open(path, 'rb') as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('v') != SNAPSHOT_VERSION:
+        return None
+    if time.time() - float(data.get('saved_at') or 0) > max_age:
+        return None
+    return data
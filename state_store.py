@@ -0,0 +1,136 @@
+"""
+ルーム・セッション状態の保存先（state store）
+
+既定はプロセス内の dict（MemoryStateStore）で、gunicorn -w 1 の従来構成と同じ動作・同じコスト。
+STATE_STORE_URL に redis:// を指定すると Redis 互換サーバーのハッシュに保存し（RedisStateStore）、
+複数ワーカー・複数ノードで同じルームを扱えるようにする。
+
+namespace() が返すオブジェクトは dict と同じように使えるが、Redis の場合は取り出した値が
+毎回新しいオブジェクトになる。ネストした値（リスト・dict・モデル）を変更したら必ず代入し直すこと。
+値がモデル（to_json / from_json を持つクラス）の場合は namespace(name, model=クラス) を渡す。
+"""
+import json
+import secrets
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+
+class MemoryStateStore:
+    """プロセス内 dict に保存する（ワーカー1つ用の既定実装）。"""
+
+    def __init__(self):
+        self._namespaces = {}
+
+    def namespace(self, name, model=None):
+        # オブジェクトをそのまま保持するので model による変換は不要
+        return self._namespaces.setdefault(name, {})
+
+    def incr(self, name, key, amount=1):
+        ns = self.namespace(name)
+        ns[key] = ns.get(key, 0) + amount
+        return ns[key]
+
+    @contextmanager
+    def lock(self, name):
+        # eventlet の協調スケジューリング下では、1ワーカー内の状態更新は I/O を挟まない限り割り込まれない
+        yield
+
+
+class RedisHash(MutableMapping):
+    """Redis のハッシュ1つを dict のように扱う。値は JSON（model があれば model.to_json() の結果）で保存する。"""
+
+    def __init__(self, client, key, model=None):
+        self._client = client
+        self._key = key
+        self._model = model
+
+    def _load(self, raw):
+        value = json.loads(raw)
+        return self._model.from_json(value) if self._model else value
+
+    def _dump(self, value):
+        return json.dumps(value.to_json() if self._model else value, ensure_ascii=False)
+
+    def __getitem__(self, field):
+        raw = self._client.hget(self._key, field)
+        if raw is None:
+            raise KeyError(field)
+        return self._load(raw)
+
+    def __setitem__(self, field, value):
+        self._client.hset(self._key, field, self._dump(value))
+
+    def __delitem__(self, field):
+        if not self._client.hdel(self._key, field):
+            raise KeyError(field)
+
+    def __contains__(self, field):
+        return bool(self._client.hexists(self._key, field))
+
+    def __iter__(self):
+        return iter([_decode(f) for f in self._client.hkeys(self._key)])
+
+    def __len__(self):
+        return self._client.hlen(self._key)
+
+    def items(self):
+        # 既定の ItemsView はキーごとに HGET するため、HGETALL 1回で取得する
+        return [(_decode(f), self._load(v)) for f, v in self._client.hgetall(self._key).items()]
+
+    def values(self):
+        return [self._load(v) for v in self._client.hvals(self._key)]
+
+    def clear(self):
+        self._client.delete(self._key)
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class RedisStateStore:
+    """Redis 互換サーバー（Redis / KeyDB / fakeredis 等）に保存する。"""
+
+    def __init__(self, client, prefix='videodesk:'):
+        self._client = client
+        self._prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix='videodesk:'):
+        import redis  # 複数ワーカー構成のときだけ必要
+        return cls(redis.Redis.from_url(url), prefix=prefix)
+
+    def namespace(self, name, model=None):
+        return RedisHash(self._client, self._prefix + name, model=model)
+
+    def incr(self, name, key, amount=1):
+        # 整数の JSON 表現は10進文字列そのものなので HINCRBY でアトミックに加算できる
+        return self._client.hincrby(self._prefix + name, key, amount)
+
+    @contextmanager
+    def lock(self, name, timeout_ms=10000, wait=10.0):
+        """ワーカー間で入室・退出の読み書きが交錯しないようにする。
+
+        Lua スクリプト非対応の互換サーバーでも動くよう SET NX PX で実装する（gunicorn eventlet
+        ワーカーでは time.sleep が協調的になるため、待機中も他のソケットは止まらない）。
+        """
+        key = self._prefix + 'lock:' + name
+        token = secrets.token_hex(8)
+        deadline = time.time() + wait
+        while not self._client.set(key, token, nx=True, px=timeout_ms):
+            if time.time() >= deadline:
+                raise TimeoutError('state store lock timeout: ' + name)
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            if _decode(self._client.get(key)) == token:
+                self._client.delete(key)
+
+
+def create_state_store(url=None):
+    """URL が redis:// 等なら RedisStateStore、未指定ならプロセス内の MemoryStateStore を返す。"""
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateStore.from_url(url)
+    return MemoryStateStore()
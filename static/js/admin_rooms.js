@@ -0,0 +1,95 @@
+// 管理者向けのルーム一覧。サーバーは変更があったときだけ（間引いて）room_overview を送ってくる
+const socket = io();
+const totalsEl = document.getElementById('overviewTotals');
+const roomsEl = document.getElementById('overviewRooms');
+const privateEl = document.getElementById('overviewPrivate');
+
+let overview = null;
+let receivedAt = 0;
+
+socket.on('connect', function () {
+    socket.emit('watch_room_overview', {}, function (res) {
+        if (res && !res.ok) totalsEl.textContent = '一覧を表示する権限がありません';
+    });
+});
+
+socket.on('room_overview', function (data) {
+    if (overview && data.rev < overview.rev) return; // 別ワーカーからの古い配信
+    overview = data;
+    receivedAt = Date.now();
+    render();
+});
+
+// 経過時間はサーバーの時計（generated_at）基準で数え、受信後はローカルで進める
+function elapsedText(createdAt) {
+    var sec = Math.max(0, Math.floor(overview.generated_at - createdAt + (Date.now() - receivedAt) / 1000));
+    var h = Math.floor(sec / 3600);
+    var m = Math.floor((sec % 3600) / 60);
+    return h > 0 ? h + '時間' + m + '分' : m + '分' + (sec % 60) + '秒';
+}
+
+function cell(row, text, className) {
+    var td = document.createElement('td');
+    if (className) td.className = className;
+    if (text !== undefined) td.textContent = text;
+    row.appendChild(td);
+    return td;
+}
+
+function participantList(td, participants) {
+    participants.forEach(function (p) {
+        var span = document.createElement('span');
+        span.className = 'admin-overview-participant' + (p.connected ? '' : ' is-disconnected');
+        span.textContent = (p.raised ? '✋ ' : '') + (p.user_name || '参加者') + (p.role === 'admin' ? '（管理者）' : '');
+        td.appendChild(span);
+    });
+    if (!participants.length) td.textContent = '入室待ち';
+}
+
+function emptyRow(tbody, columns, text) {
+    var row = document.createElement('tr');
+    var td = cell(row, text, 'admin-overview-empty');
+    td.colSpan = columns;
+    tbody.appendChild(row);
+}
+
+function render() {
+    if (!overview) return;
+    var t = overview.totals;
+    totalsEl.textContent = 'ルーム ' + t.rooms + ' / 参加者 ' + t.participants + '（接続中 ' + t.connected +
+        '）/ 挙手 ' + t.raised + ' / 個別指導 ' + t.private_sessions;
+
+    roomsEl.textContent = '';
+    overview.rooms.forEach(function (room) {
+        var row = document.createElement('tr');
+        var link = document.createElement('a');
+        link.href = '/room/' + encodeURIComponent(room.id);
+        link.textContent = room.id;
+        cell(row).appendChild(link);
+        cell(row, room.participants.length + ' / ' + (room.capacity || overview.capacity) +
+            (room.mode === 'sfu' ? '（大部屋）' : ''));
+        participantList(cell(row), room.participants);
+        cell(row, elapsedText(room.created_at), 'admin-overview-elapsed').dataset.createdAt = room.created_at;
+        roomsEl.appendChild(row);
+    });
+    if (!overview.rooms.length) emptyRow(roomsEl, 4, '開いているルームはありません');
+
+    privateEl.textContent = '';
+    overview.private_sessions.forEach(function (s) {
+        var row = document.createElement('tr');
+        cell(row, s.id.replace(/^private_/, ''));
+        cell(row, s.main_room);
+        participantList(cell(row), s.participants);
+        cell(row, elapsedText(s.created_at), 'admin-overview-elapsed').dataset.createdAt = s.created_at;
+        privateEl.appendChild(row);
+    });
+    if (!overview.private_sessions.length) emptyRow(privateEl, 4, '進行中の個別指導はありません');
+}
+
+// 経過時間だけを毎秒更新する（一覧は作り直さない）
+setInterval(function () {
+    if (!overview) return;
+    document.querySelectorAll('.admin-overview-elapsed').forEach(function (td) {
+        td.textContent = elapsedText(parseFloat(td.dataset.createdAt));
+    });
+}, 1000);
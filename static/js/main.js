@@ -175,8 +175,7 @@ socket.on('offer', async (data) => {
 
     socket.emit('answer', {
         target: targetId,
-        description: pc.localDescription,
-        sender: socket.id
+        description: pc.localDescription
     });
 });
 
@@ -188,18 +187,50 @@ socket.on('answer', async (data) => {
     }
 });
 
-socket.on('ice_candidate', async (data) => {
-    const targetId = data.sender;
+async function handleRemoteIceCandidate(targetId, candidate) {
     const pc = peers[targetId]?.connection;
-    if (pc && data.candidate) {
+    if (pc && candidate) {
         try {
-            await pc.addIceCandidate(new RTCIceCandidate(data.candidate));
+            await pc.addIceCandidate(new RTCIceCandidate(candidate));
         } catch (e) {
             console.error("ICE Error", e);
         }
     }
+}
+
+socket.on('ice_candidate', (data) => {
+    handleRemoteIceCandidate(data.sender, data.candidate);
 });
 
+socket.on('ice_candidates', (data) => {
+    (data.candidates || []).forEach(candidate => handleRemoteIceCandidate(data.sender, candidate));
+});
+
+// Outgoing ICE candidates are coalesced per target for a short window and sent as one
+// ice_candidates frame; end-of-candidates (null) flushes immediately.
+const ICE_BATCH_WINDOW_MS = 50;
+const iceOutbox = {}; // targetId -> { candidates: [], timer }
+
+function queueIceCandidate(targetId, candidate) {
+    const box = iceOutbox[targetId] || (iceOutbox[targetId] = { candidates: [], timer: null });
+    if (!candidate) {
+        flushIceCandidates(targetId);
+        return;
+    }
+    box.candidates.push(candidate);
+    if (!box.timer) box.timer = setTimeout(() => flushIceCandidates(targetId), ICE_BATCH_WINDOW_MS);
+}
+
+function flushIceCandidates(targetId) {
+    const box = iceOutbox[targetId];
+    if (!box) return;
+    delete iceOutbox[targetId];
+    if (box.timer) clearTimeout(box.timer);
+    if (box.candidates.length) {
+        socket.emit('ice_candidates', { target: targetId, candidates: box.candidates });
+    }
+}
+
 // D. Connection Factory
 function createPeerConnection(targetId, isInitiator) {
     if (peers[targetId]) return peers[targetId].connection;
@@ -222,13 +253,7 @@ function createPeerConnection(targetId, isInitiator) {
 
     // Handle ICE
     pc.onicecandidate = (event) => {
-        if (event.candidate) {
-            socket.emit('ice_candidate', {
-                target: targetId,
-                candidate: event.candidate,
-                sender: socket.id // Ensure sender ID is passed
-            });
-        }
+        queueIceCandidate(targetId, event.candidate);
     };
 
     // Save state
@@ -248,8 +273,7 @@ async function makeOffer(pc, targetId) {
         await pc.setLocalDescription(offer);
         socket.emit('offer', {
             target: targetId,
-            description: pc.localDescription,
-            sender: socket.id
+            description: pc.localDescription
         });
     } catch (err) {
         console.error("Offer Error:", err);
@@ -27,7 +27,11 @@ function getOrCreateUserId() {
 const USER_ID = getOrCreateUserId();
 
 let amHost = false;           // 自分がホストか
-let orderedSlots = [];        // 最大4。各要素は null | { sid, user_name, role, connected, is_host }
+let roomRev = 0;              // 適用済みのメインルーム状態リビジョン（サーバーの rev）
+let orderedSlots = [];        // 定員分。各要素は null | { sid, user_name, role, connected, is_host }
+let roomMode = 'mesh';        // 'mesh'（参加者どうしで直接つなぐ）| 'sfu'（大部屋。中継サーバー経由）
+let roomCapacity = 4;         // メインルームの定員（room_assigned で受け取る）
+let sfu = null;               // 大部屋のときの SfuClient
 
 const FILTER_FPS = 30;
 
@@ -49,6 +53,7 @@ let privatePeers = {};
 let privateLocalStream = null;
 let mainRoomIdForReturn = null;
 var original_room_id = null;
+var mainRoomJoined = false;  // 一度メインルームに入ったら、Socket.IO 再接続時に席へ戻る
 
 // #region agent log
 var DEBUG_LOG_ENDPOINT = 'http://127.0.0.1:7242/ingest/57d916de-fd2e-49ae-86c2-8155e201bf60';
@@ -166,6 +171,7 @@ async function startSystem() {
             user_id: USER_ID || undefined,
             user_db_id: USER_DB_ID || undefined
         });
+        mainRoomJoined = true;
         if (ROLE === 'admin') renderStudentList();
     } catch (err) {
         if (statusDiv) statusDiv.innerText = "エラー: " + (err.name || 'UnknownError');
@@ -388,14 +394,15 @@ function createRemotePlaceholder(slotInfo) {
 }
 
 function renderVideoGrid() {
-    if (!videosContainer || orderedSlots.length < 4) return;
+    if (!videosContainer || orderedSlots.length < roomCapacity) return;
     var localEl = document.getElementById('video-wrapper-local');
     var remoteEls = {};
     orderedSlots.forEach(function (s) {
         if (s && s.sid && s.sid !== socket.id) remoteEls[s.sid] = document.getElementById('video-wrapper-' + s.sid);
     });
     videosContainer.innerHTML = '';
-    for (var i = 0; i < 4; i++) {
+    videosContainer.dataset.mode = roomMode;
+    for (var i = 0; i < roomCapacity; i++) {
         if (!orderedSlots[i]) {
             videosContainer.appendChild(createEmptySlot());
         } else if (orderedSlots[i].sid === socket.id) {
@@ -419,7 +426,7 @@ function renderVideoGrid() {
                         // #region agent log
                         if (!peers[remoteSid]) debugLog('room.js:renderVideoGrid', 'create_pc_delayed', { mySid: socket.id, targetId: remoteSid, isInitiator: socket.id < remoteSid }, 'H2');
                         // #endregion
-                        if (!peers[remoteSid]) createPeerConnection(remoteSid, socket.id < remoteSid);
+                        if (!peers[remoteSid]) connectPeer(remoteSid);
                     }, 80);
                 })(sid);
             }
@@ -458,17 +465,49 @@ function escapeHtml(s) {
     return div.innerHTML;
 }
 
+// メインルームの差分イベント（rev つき）を適用してよいか。
+// 適用済みなら捨て、飛びがあれば request_room_state で不足分（またはスナップショット）を取り寄せる。
+function acceptRoomDelta(data) {
+    if (!data || data.rev == null || currentPrivateSessionId) return true;
+    if (data.rev <= roomRev) return false;
+    if (data.rev > roomRev + 1) {
+        socket.emit('request_room_state', { room_id: myRoomId, rev: roomRev });
+        return false;
+    }
+    roomRev = data.rev;
+    return true;
+}
+
+// room_assigned / room_state / hand_states の参加者は短いキーで届く（room_model.Participant.wire_state）
+function expandParticipant(w) {
+    if (!w) return null;
+    return { sid: w.s, user_name: w.n || '', role: w.r || 'student', connected: !!w.c, is_host: !!w.h, total_study_time_minutes: w.t, raised: !!w.q };
+}
+
+// room_assigned / room_state の参加者リスト（挙手状態つき）でローカル状態を置き換える
+function applyRoomSnapshot(raw) {
+    orderedSlots = raw.slice(0, roomCapacity);
+    while (orderedSlots.length < roomCapacity) orderedSlots.push(null);
+    roomParticipants = {};
+    orderedSlots.forEach(function (s) {
+        if (s && s.sid) {
+            roomParticipants[s.sid] = { user_name: s.user_name || '', role: s.role || 'student', total_study_time_minutes: s.total_study_time_minutes };
+            handRaiseState[s.sid] = { user_name: s.user_name || '', raised: !!s.raised };
+        }
+    });
+}
+
 socket.on('room_assigned', (data) => {
     if (currentPrivateSessionId) return;
     myRoomId = data.room_id || myRoomId;
     amHost = !!data.is_host;
-    var raw = data.participants || [];
-    orderedSlots = raw.slice(0, 4);
-    while (orderedSlots.length < 4) orderedSlots.push(null);
-    roomParticipants = {};
-    orderedSlots.forEach(function (s) {
-        if (s && s.sid) roomParticipants[s.sid] = { user_name: s.user_name || '', role: s.role || 'student', total_study_time_minutes: s.total_study_time_minutes };
-    });
+    roomRev = data.rev || 0;
+    roomMode = data.mode || 'mesh';
+    roomCapacity = data.capacity || 4;
+    if (roomMode === 'sfu' && data.sfu) startSfu(data.sfu);
+    else stopSfu();
+    var raw = (data.participants || []).map(expandParticipant);
+    applyRoomSnapshot(raw);
     // #region agent log
     var participantSids = raw.filter(function (s) { return s && s.sid; }).map(function (s) { return s.sid; });
     var remotes = participantSids.filter(function (sid) { return sid !== socket.id; });
@@ -476,27 +515,94 @@ socket.on('room_assigned', (data) => {
     // #endregion
     if (statusDiv) statusDiv.innerText = "";
     renderVideoGrid();
+    if (ROLE === 'admin') renderStudentList();
 });
 
 socket.on('room_state', (data) => {
     if (currentPrivateSessionId) return;
-    var raw = data.participants || [];
-    orderedSlots = raw.slice(0, 4);
-    while (orderedSlots.length < 4) orderedSlots.push(null);
-    roomParticipants = {};
-    orderedSlots.forEach(function (s) {
-        if (s && s.sid) roomParticipants[s.sid] = { user_name: s.user_name || '', role: s.role || 'student', total_study_time_minutes: s.total_study_time_minutes };
+    roomRev = data.rev || 0;
+    applyRoomSnapshot((data.participants || []).map(expandParticipant));
+    renderVideoGrid();
+    if (ROLE === 'admin') renderStudentList();
+});
+
+// 再接続時: sid が変わるので自分側の接続を作り直し、同じ user_id で入り直す（サーバーがキープ中の席に戻す）
+socket.on('connect', function () {
+    if (!mainRoomJoined || currentPrivateSessionId) return;
+    stopSfu();
+    Object.keys(peers).forEach(function (sid) {
+        if (peers[sid] && peers[sid].connection) peers[sid].connection.close();
+        removeVideoElement(sid);
     });
+    peers = {};
+    socket.emit('join_room', {
+        room: myRoomId || undefined,
+        user_name: USER_NAME,
+        role: ROLE,
+        user_id: USER_ID || undefined,
+        user_db_id: USER_DB_ID || undefined
+    });
+});
+
+// 大部屋の中継サーバーには、タブを閉じたらすぐ送受信をやめてもらう
+window.addEventListener('pagehide', stopSfu);
+
+// サーバーの再起動中は接続を断られる（自動では再接続しない）。タブごとにばらけた時間だけ待ってからつなぎ直す
+socket.on('connect_error', function (err) {
+    if (!err || err.message !== 'server_draining') return;
+    setTimeout(function () { socket.connect(); }, 1000 + Math.random() * 4000);
+});
+
+// 参加者の一時的な切断: 席は残したまま「接続切れ」表示にする
+socket.on('participant_disconnected', function (data) {
+    if (!acceptRoomDelta(data)) return;
+    var sid = data.sid;
+    for (var i = 0; i < orderedSlots.length; i++) {
+        if (orderedSlots[i] && orderedSlots[i].sid === sid) orderedSlots[i].connected = false;
+    }
+    var wrap = document.getElementById('video-wrapper-' + sid);
+    if (wrap) {
+        wrap.classList.add('is-disconnected');
+        var label = wrap.querySelector('h3');
+        if (label) label.textContent = '接続切れ';
+    }
+});
+
+// 同じ参加者が猶予時間内に戻った: 席はそのまま、その人との接続だけ新しい sid で張り直す
+socket.on('participant_reconnected', function (data) {
+    if (!acceptRoomDelta(data)) return;
+    var oldSid = data.old_sid;
+    var newSid = data.sid;
+    if (!oldSid || !newSid || newSid === socket.id) return;
+    if (peers[oldSid]) {
+        peers[oldSid].connection.close();
+        delete peers[oldSid];
+    }
+    var oldEl = document.getElementById('video-wrapper-' + oldSid);
+    if (oldEl) oldEl.remove();
+    var hand = handRaiseState[oldSid];
+    delete handRaiseState[oldSid];
+    if (hand) handRaiseState[newSid] = hand;
+    delete roomParticipants[oldSid];
+    roomParticipants[newSid] = { user_name: data.user_name || '', role: data.role || 'student', total_study_time_minutes: data.total_study_time_minutes };
+    for (var i = 0; i < orderedSlots.length; i++) {
+        if (orderedSlots[i] && orderedSlots[i].sid === oldSid) {
+            orderedSlots[i] = { sid: newSid, user_name: data.user_name || '', role: data.role || 'student', connected: true, is_host: orderedSlots[i].is_host, total_study_time_minutes: data.total_study_time_minutes };
+        }
+    }
     renderVideoGrid();
+    if (ROLE === 'admin') renderStudentList();
 });
 
 socket.on('host_changed', (data) => {
+    if (!acceptRoomDelta(data)) return;
     const name = data.new_host_name || '参加者';
     showToast(name + 'さんが新しいホストになりました');
     amHost = (data.new_host_sid === socket.id);
 });
 
 socket.on('user_joined', (data) => {
+    if (!acceptRoomDelta(data)) return;
     const targetId = data.sid;
     if (targetId === socket.id) return;
     // #region agent log
@@ -509,7 +615,7 @@ socket.on('user_joined', (data) => {
     if (handRaiseState[targetId] === undefined) handRaiseState[targetId] = { user_name: userName, raised: false };
     else handRaiseState[targetId].user_name = userName;
     var slotInfo = { sid: targetId, user_name: userName, role: role, connected: true, is_host: false, total_study_time_minutes: totalMin };
-    for (var i = 0; i < 4; i++) {
+    for (var i = 0; i < roomCapacity; i++) {
         if (!orderedSlots[i]) { orderedSlots[i] = slotInfo; break; }
     }
     var tid = targetId;
@@ -517,7 +623,7 @@ socket.on('user_joined', (data) => {
         // #region agent log
         if (!peers[tid]) debugLog('room.js:user_joined', 'create_pc_80ms_fired', { mySid: socket.id, targetId: tid, isInitiator: socket.id < tid }, 'H2');
         // #endregion
-        if (!peers[tid]) createPeerConnection(tid, socket.id < tid);
+        if (!peers[tid]) connectPeer(tid);
     }, 80);
     renderVideoGrid();
     if (ROLE === 'admin') renderStudentList();
@@ -527,10 +633,11 @@ socket.on('request_offer_to', function (data) {
     var newSid = data.new_sid;
     if (!newSid || newSid === socket.id) return;
     roomParticipants[newSid] = roomParticipants[newSid] || { user_name: '接続中', role: 'student' };
-    createPeerConnection(newSid, socket.id < newSid);
+    connectPeer(newSid);
 });
 
 socket.on('user_left', (data) => {
+    if (!acceptRoomDelta(data)) return;
     const targetId = data.sid;
     const leftName = data.user_name || '参加者';
     if (leftName) showToast(leftName + 'さんが退出しました');
@@ -549,9 +656,11 @@ socket.on('user_left', (data) => {
 });
 
 socket.on('hand_raise_update', (data) => {
+    if (!acceptRoomDelta(data)) return;
     const { sid, user_name, raised } = data;
     handRaiseState[sid] = { user_name: user_name || (handRaiseState[sid] && handRaiseState[sid].user_name) || '', raised: !!raised };
     applyHandStates();
+    if (sfu && peers[sid]) sfu.setQuality(sid, sfuQuality(sid));
 
     if (ROLE === 'admin') {
         renderStudentList();
@@ -563,7 +672,7 @@ socket.on('hand_raise_update', (data) => {
 });
 
 socket.on('hand_states', (data) => {
-    (data.states || []).forEach(s => {
+    (data.states || []).map(expandParticipant).forEach(s => {
         handRaiseState[s.sid] = { user_name: s.user_name, raised: !!s.raised };
         if (s.role) {
             var existing = roomParticipants[s.sid] || {};
@@ -613,7 +722,7 @@ socket.on('offer', async (data) => {
         await flushPendingIceCandidates(privatePeers[targetId]);
         const answer = await pc.createAnswer();
         await pc.setLocalDescription(answer);
-        socket.emit('answer', { target: targetId, description: pc.localDescription, sender: socket.id });
+        socket.emit('answer', { target: targetId, description: pc.localDescription });
     } else {
         const pc = createPeerConnection(targetId, false);
         try {
@@ -627,7 +736,7 @@ socket.on('offer', async (data) => {
         await flushPendingIceCandidates(peers[targetId]);
         const answer = await pc.createAnswer();
         await pc.setLocalDescription(answer);
-        socket.emit('answer', { target: targetId, description: pc.localDescription, sender: socket.id });
+        socket.emit('answer', { target: targetId, description: pc.localDescription });
         // #region agent log
         debugLog('room.js:offer', 'answer_sent_after_offer', { mySid: socket.id, targetId: targetId }, 'H3');
         // #endregion
@@ -661,9 +770,7 @@ function addIceCandidateSafe(pc, candidate, pendingCandidates) {
     return Promise.resolve();
 }
 
-socket.on('ice_candidate', async (data) => {
-    const targetId = data.sender;
-    const candidate = data.candidate;
+function handleRemoteIceCandidate(targetId, candidate) {
     if (!candidate) return;
     if (currentPrivateSessionId) {
         var pr = privatePeers[targetId];
@@ -676,8 +783,43 @@ socket.on('ice_candidate', async (data) => {
         if (peer && !peer.pendingCandidates) peer.pendingCandidates = [];
         addIceCandidateSafe(pc, candidate, peer && peer.pendingCandidates);
     }
+}
+
+socket.on('ice_candidate', (data) => {
+    handleRemoteIceCandidate(data.sender, data.candidate);
 });
 
+socket.on('ice_candidates', (data) => {
+    (data.candidates || []).forEach(function (candidate) {
+        handleRemoteIceCandidate(data.sender, candidate);
+    });
+});
+
+// 送信する ICE candidate は宛先ごとに短時間ためて ice_candidates で1回にまとめる（入室直後の emit 数を減らす）。
+// 収集完了（event.candidate === null）の時点で待たずに送る。
+var ICE_BATCH_WINDOW_MS = 50;
+var iceOutbox = {};  // targetId -> { candidates: [], timer }
+
+function queueIceCandidate(targetId, candidate) {
+    var box = iceOutbox[targetId] || (iceOutbox[targetId] = { candidates: [], timer: null });
+    if (!candidate) {
+        flushIceCandidates(targetId);
+        return;
+    }
+    box.candidates.push(candidate);
+    if (!box.timer) box.timer = setTimeout(function () { flushIceCandidates(targetId); }, ICE_BATCH_WINDOW_MS);
+}
+
+function flushIceCandidates(targetId) {
+    var box = iceOutbox[targetId];
+    if (!box) return;
+    delete iceOutbox[targetId];
+    if (box.timer) clearTimeout(box.timer);
+    if (box.candidates.length) {
+        socket.emit('ice_candidates', { target: targetId, candidates: box.candidates });
+    }
+}
+
 var WEBRTC_DEBUG = true;
 function webrtcLog(prefix, targetId, msg, extra) {
     if (!WEBRTC_DEBUG) return;
@@ -686,6 +828,40 @@ function webrtcLog(prefix, targetId, msg, extra) {
     console.log(s);
 }
 
+// 相手の映像を受け取り始める。大部屋は中継サーバーから受信するだけ、mesh は相手と直接つなぐ
+function connectPeer(targetId) {
+    if (roomMode === 'sfu') {
+        if (!sfu || peers[targetId]) return;
+        var pc = sfu.subscribe(targetId, sfuQuality(targetId), function (stream) {
+            attachRemoteStream(targetId, stream);
+        });
+        peers[targetId] = { connection: pc, pendingCandidates: [] };  // 退出・再接続時は mesh と同じく閉じる
+        return;
+    }
+    createPeerConnection(targetId, socket.id < targetId);
+}
+
+// 大部屋ではホストと挙手中の人だけ元の解像度、ほかは縮小版を受け取る
+function sfuQuality(sid) {
+    var isHost = orderedSlots.some(function (s) { return s && s.sid === sid && s.is_host; });
+    return isHost || (handRaiseState[sid] && handRaiseState[sid].raised) ? 'full' : 'thumb';
+}
+
+function startSfu(info) {
+    stopSfu();
+    sfu = new SfuClient(info.url, info.token, rtcConfig);
+    if (!localStream) return;
+    sfu.publish(localStream).catch(function (err) {
+        console.warn('[SFU] publish failed', err);
+        showToast('映像の送信を開始できませんでした');
+    });
+}
+
+function stopSfu() {
+    if (sfu) sfu.close();
+    sfu = null;
+}
+
 function createPeerConnection(targetId, isInitiator) {
     // #region agent log
     if (peers[targetId]) {
@@ -714,7 +890,7 @@ function createPeerConnection(targetId, isInitiator) {
                 pc.createOffer({ iceRestart: true }).then(function (offer) {
                     return pc.setLocalDescription(offer);
                 }).then(function () {
-                    socket.emit('offer', { target: targetId, description: pc.localDescription, sender: socket.id });
+                    socket.emit('offer', { target: targetId, description: pc.localDescription });
                     setTimeout(function () { if (peer) peer.iceRestarting = false; }, 3000);
                 }).catch(function (err) {
                     console.warn('[WebRTC] ICE restart error', err);
@@ -731,61 +907,11 @@ function createPeerConnection(targetId, isInitiator) {
             return;
         }
         webrtcLog('ontrack', targetId, 'stream received', { id: remoteStream.id, tracks: remoteStream.getTracks().length });
-        const wrap = document.getElementById('video-wrapper-' + targetId);
-        if (wrap && wrap.classList.contains('video-slot-placeholder')) {
-            wrap.classList.remove('video-slot-placeholder');
-            var connLabel = wrap.querySelector('.video-connecting-label');
-            if (connLabel) connLabel.remove();
-            const video = wrap.querySelector('video');
-            if (video) {
-                video.setAttribute('autoplay', '');
-                video.setAttribute('playsinline', '');
-                video.muted = true;
-                video.srcObject = remoteStream;
-                video.play().then(function () {
-                    webrtcLog('ontrack', targetId, 'video.play() ok');
-                }).catch(function (err) {
-                    console.warn('[WebRTC] video.play() blocked', err);
-                    video.muted = true;
-                    video.play().catch(function () {});
-                    showToast('画面をクリックすると映像が表示されます');
-                });
-                var s = wrap.querySelector('.video-loading-spinner');
-                if (s) s.classList.add('is-hidden');
-                function onReady() {
-                    video.removeEventListener('loadeddata', onReady);
-                    video.removeEventListener('playing', onReady);
-                    var sp = wrap.querySelector('.video-loading-spinner');
-                    if (sp) sp.classList.add('is-hidden');
-                }
-                video.addEventListener('loadeddata', onReady);
-                video.addEventListener('playing', onReady);
-                if (video.readyState >= 2) onReady();
-            }
-            var label = wrap.querySelector('h3');
-            if (label) label.textContent = (handRaiseState[targetId] && handRaiseState[targetId].user_name) || (roomParticipants[targetId] && roomParticipants[targetId].user_name) || ('参加者 ' + targetId.substr(0, 6));
-            var studyTimeEl = wrap.querySelector('.video-wrapper-study-time');
-            if (studyTimeEl && roomParticipants[targetId] && roomParticipants[targetId].total_study_time_minutes != null) {
-                studyTimeEl.textContent = '総勉強時間: ' + formatStudyTime(roomParticipants[targetId].total_study_time_minutes);
-            }
-            if (handRaiseState[targetId]) updateHandIndicator(wrap, handRaiseState[targetId].raised);
-        } else if (!wrap) {
-            const userName = (handRaiseState[targetId] && handRaiseState[targetId].user_name) || (roomParticipants[targetId] && roomParticipants[targetId].user_name) || ('参加者 ' + targetId.substr(0, 6));
-            addVideoElement(targetId, remoteStream, userName);
-            var wrapAfter = document.getElementById('video-wrapper-' + targetId);
-            if (wrapAfter) {
-                var st = wrapAfter.querySelector('.video-wrapper-study-time');
-                if (st && roomParticipants[targetId] && roomParticipants[targetId].total_study_time_minutes != null) {
-                    st.textContent = '総勉強時間: ' + formatStudyTime(roomParticipants[targetId].total_study_time_minutes);
-                }
-            }
-        }
+        attachRemoteStream(targetId, remoteStream);
     };
 
     pc.onicecandidate = (event) => {
-        if (event.candidate) {
-            socket.emit('ice_candidate', { target: targetId, candidate: event.candidate, sender: socket.id });
-        }
+        queueIceCandidate(targetId, event.candidate);
     };
 
     peers[targetId] = { connection: pc, pendingCandidates: [] };
@@ -796,11 +922,64 @@ function createPeerConnection(targetId, isInitiator) {
     return pc;
 }
 
+// 受信した相手の映像を、その人の枠（接続待ちの枠があればそこ、なければ新しく）に表示する
+function attachRemoteStream(targetId, remoteStream) {
+    const wrap = document.getElementById('video-wrapper-' + targetId);
+    if (wrap && wrap.classList.contains('video-slot-placeholder')) {
+        wrap.classList.remove('video-slot-placeholder');
+        var connLabel = wrap.querySelector('.video-connecting-label');
+        if (connLabel) connLabel.remove();
+        const video = wrap.querySelector('video');
+        if (video) {
+            video.setAttribute('autoplay', '');
+            video.setAttribute('playsinline', '');
+            video.muted = true;
+            video.srcObject = remoteStream;
+            video.play().then(function () {
+                webrtcLog('ontrack', targetId, 'video.play() ok');
+            }).catch(function (err) {
+                console.warn('[WebRTC] video.play() blocked', err);
+                video.muted = true;
+                video.play().catch(function () {});
+                showToast('画面をクリックすると映像が表示されます');
+            });
+            var s = wrap.querySelector('.video-loading-spinner');
+            if (s) s.classList.add('is-hidden');
+            function onReady() {
+                video.removeEventListener('loadeddata', onReady);
+                video.removeEventListener('playing', onReady);
+                var sp = wrap.querySelector('.video-loading-spinner');
+                if (sp) sp.classList.add('is-hidden');
+            }
+            video.addEventListener('loadeddata', onReady);
+            video.addEventListener('playing', onReady);
+            if (video.readyState >= 2) onReady();
+        }
+        var label = wrap.querySelector('h3');
+        if (label) label.textContent = (handRaiseState[targetId] && handRaiseState[targetId].user_name) || (roomParticipants[targetId] && roomParticipants[targetId].user_name) || ('参加者 ' + targetId.substr(0, 6));
+        var studyTimeEl = wrap.querySelector('.video-wrapper-study-time');
+        if (studyTimeEl && roomParticipants[targetId] && roomParticipants[targetId].total_study_time_minutes != null) {
+            studyTimeEl.textContent = '総勉強時間: ' + formatStudyTime(roomParticipants[targetId].total_study_time_minutes);
+        }
+        if (handRaiseState[targetId]) updateHandIndicator(wrap, handRaiseState[targetId].raised);
+    } else if (!wrap) {
+        const userName = (handRaiseState[targetId] && handRaiseState[targetId].user_name) || (roomParticipants[targetId] && roomParticipants[targetId].user_name) || ('参加者 ' + targetId.substr(0, 6));
+        addVideoElement(targetId, remoteStream, userName);
+        var wrapAfter = document.getElementById('video-wrapper-' + targetId);
+        if (wrapAfter) {
+            var st = wrapAfter.querySelector('.video-wrapper-study-time');
+            if (st && roomParticipants[targetId] && roomParticipants[targetId].total_study_time_minutes != null) {
+                st.textContent = '総勉強時間: ' + formatStudyTime(roomParticipants[targetId].total_study_time_minutes);
+            }
+        }
+    }
+}
+
 async function makeOffer(pc, targetId) {
     try {
         const offer = await pc.createOffer();
         await pc.setLocalDescription(offer);
-        socket.emit('offer', { target: targetId, description: pc.localDescription, sender: socket.id });
+        socket.emit('offer', { target: targetId, description: pc.localDescription });
         // #region agent log
         debugLog('room.js:makeOffer', 'offer_sent', { mySid: socket.id, targetId: targetId }, 'H1');
         // #endregion
@@ -827,6 +1006,7 @@ var mainRoomContent = document.getElementById('mainRoomContent');
 var privateRoomContent = document.getElementById('privateRoomContent');
 var privateVideosContainer = document.getElementById('privateVideosContainer');
 var privatePendingOthers = [];
+var lastChatId = 0;  // 個別指導チャットで表示済みの最後の発言 id（履歴の取り直しはこれより後だけ）
 var endPrivateSessionBtn = document.getElementById('endPrivateSessionBtn');
 var privateMicBtn = document.getElementById('privateMicBtn');
 var privateCameraBtn = document.getElementById('privateCameraBtn');
@@ -844,6 +1024,7 @@ function setRoomContext(context) {
 function closePrivateRoom() {
     currentPrivateSessionId = null;
     privatePendingOthers = [];
+    lastChatId = 0;
     setRoomContext('main');
     if (privatePeers) {
         Object.keys(privatePeers).forEach(function (sid) {
@@ -875,6 +1056,7 @@ socket.on('private_participants', function (data) {
     fetch('http://127.0.0.1:7242/ingest/57d916de-fd2e-49ae-86c2-8155e201bf60',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({location:'room.js:private_participants',message:'private_participants',data:{mySid:socket.id,participantsCount:data.participants?data.participants.length:0,hasContainer:!!privateVideosContainer,hasPrivateSession:!!currentPrivateSessionId},timestamp:Date.now(),sessionId:'debug-session',hypothesisId:'H3'})}).catch(function(){});
     // #endregion
     if (!currentPrivateSessionId || !data.participants || !privateVideosContainer) return;
+    fetchPrivateChatHistory();
     var others = data.participants.filter(function (p) { return p.sid !== socket.id; });
     // #region agent log
     fetch('http://127.0.0.1:7242/ingest/57d916de-fd2e-49ae-86c2-8155e201bf60',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({location:'room.js:private_participants',message:'others_and_local',data:{othersCount:others.length,otherSids:others.map(function(p){return p.sid;}),hasPrivateLocalStream:!!privateLocalStream},timestamp:Date.now(),sessionId:'debug-session',hypothesisId:'H3,H5'})}).catch(function(){});
@@ -1052,14 +1234,14 @@ function privateCreatePeerConnection(targetId, userName, isInitiator) {
                     pc.createOffer({ iceRestart: true }).then(function (offer) {
                         return pc.setLocalDescription(offer);
                     }).then(function () {
-                        socket.emit('offer', { target: targetId, description: pc.localDescription, sender: socket.id });
+                        socket.emit('offer', { target: targetId, description: pc.localDescription });
                     }).catch(function (err) { console.warn('Private ICE restart error', err); });
                 } catch (e) { console.warn('Private ICE restart', e); }
             }
         }
     };
     pc.onicecandidate = function (event) {
-        if (event.candidate) socket.emit('ice_candidate', { target: targetId, candidate: event.candidate, sender: socket.id });
+        queueIceCandidate(targetId, event.candidate);
     };
     privatePeers[targetId] = { connection: pc, pendingCandidates: [] };
     if (isInitiator) privateMakeOffer(pc, targetId);
@@ -1073,7 +1255,7 @@ function privateMakeOffer(pc, targetId) {
     pc.createOffer().then(function (offer) {
         return pc.setLocalDescription(offer);
     }).then(function () {
-        socket.emit('offer', { target: targetId, description: pc.localDescription, sender: socket.id });
+        socket.emit('offer', { target: targetId, description: pc.localDescription });
     }).catch(function (err) { console.error('Private offer error', err); });
 }
 
@@ -1116,6 +1298,7 @@ socket.on('redirect_to_private', function (data) {
     setRoomContext('private');
     if (mainRoomContent) mainRoomContent.hidden = true;
     if (privateRoomContent) privateRoomContent.hidden = false;
+    stopSfu();
     Object.keys(peers).forEach(function (sid) {
         if (peers[sid] && peers[sid].connection) peers[sid].connection.close();
         removeVideoElement(sid);
@@ -1177,7 +1360,7 @@ function startPrivateRoomMedia() {
             if (pc && pc.getSenders && pc.getSenders().length === 0 && privateLocalStream) {
                 privateLocalStream.getTracks().forEach(function (t) { pc.addTrack(t, privateLocalStream); });
                 pc.createOffer().then(function (offer) { return pc.setLocalDescription(offer); }).then(function () {
-                    socket.emit('offer', { target: sid, description: pc.localDescription, sender: socket.id });
+                    socket.emit('offer', { target: sid, description: pc.localDescription });
                 }).catch(function (err) { console.warn('Private re-offer error', err); });
             }
         });
@@ -1275,15 +1458,31 @@ function appendChatMessage(userName, text, isImage, dataUrl) {
     privateChatMessages.scrollTop = privateChatMessages.scrollHeight;
 }
 
-socket.on('private_chat', function (data) {
-    // 送信者本人にはサーバーから返さない（ローカルで既に追加済みのため二重表示を防ぐ）
-    if (data.sender_sid === socket.id) return;
-    appendChatMessage(data.user_name || '', data.text || '', false);
-});
-socket.on('private_chat_image', function (data) {
-    if (data.sender_sid === socket.id) return;
-    appendChatMessage(data.user_name || '', '', true, data.data_url);
-});
+// 届いた発言を表示する。id が表示済み（lastChatId 以下）なら出さない（ライブ配信と履歴の両方で届くため）。
+// 自分の発言は送信時にローカルで追加済みなので、ライブ配信では id だけ控える（fromHistory なら表示する）
+function showChatPayload(data, isImage, fromHistory) {
+    if (data.id != null) {
+        if (data.id <= lastChatId) return;
+        lastChatId = data.id;
+    }
+    if (data.sender_sid === socket.id && !fromHistory) return;
+    // 新形式は添付ID（サーバーから URL で取得）、旧形式は data_url
+    if (isImage) appendChatMessage(data.user_name || '', '', true, data.url || data.data_url);
+    else appendChatMessage(data.user_name || '', data.text || '', false);
+}
+
+socket.on('private_chat', function (data) { showChatPayload(data, false, false); });
+socket.on('private_chat_image', function (data) { showChatPayload(data, true, false); });
+
+// 入室後（private_participants を受けるたび）に、見逃した発言だけをサーバーの履歴から取り直す
+function fetchPrivateChatHistory() {
+    var sessionId = currentPrivateSessionId;
+    socket.emit('private_chat_history', { after: lastChatId }, function (ack) {
+        if (!ack || !ack.ok || sessionId !== currentPrivateSessionId) return;
+        if (ack.truncated) appendChatMessage('お知らせ', '古いメッセージの一部は表示できません', false);
+        ack.messages.forEach(function (m) { showChatPayload(m, !!m.attachment_id, true); });
+    });
+}
 
 if (privateChatSendBtn && privateChatInput) {
     privateChatSendBtn.addEventListener('click', function () {
@@ -1298,40 +1497,162 @@ if (privateChatSendBtn && privateChatInput) {
     });
 }
 
-function resizeImageToDataUrl(file, maxSize, quality, callback) {
+// 画像を縮小して JPEG の Blob にする（base64 にせずバイナリのまま送る）
+function resizeImageToBlob(file, maxSize, quality, callback) {
     var img = document.createElement('img');
     var url = URL.createObjectURL(file);
     img.onload = function () {
         URL.revokeObjectURL(url);
         var w = img.naturalWidth, h = img.naturalHeight;
-        if (w <= maxSize && h <= maxSize) {
-            var c = document.createElement('canvas');
-            c.width = w; c.height = h;
-            c.getContext('2d').drawImage(img, 0, 0);
-            callback(c.toDataURL('image/jpeg', quality));
-            return;
-        }
-        var scale = maxSize / Math.max(w, h);
+        var scale = (w <= maxSize && h <= maxSize) ? 1 : maxSize / Math.max(w, h);
         var nw = Math.round(w * scale), nh = Math.round(h * scale);
         var canvas = document.createElement('canvas');
         canvas.width = nw; canvas.height = nh;
         canvas.getContext('2d').drawImage(img, 0, 0, nw, nh);
-        callback(canvas.toDataURL('image/jpeg', quality));
+        canvas.toBlob(function (blob) { callback(blob); }, 'image/jpeg', quality);
     };
     img.onerror = function () { URL.revokeObjectURL(url); callback(null); };
     img.src = url;
 }
 
+// /attachments にアップロードし、返ってきた添付IDだけを Socket.IO で送る
+function uploadChatImage(blob) {
+    return fetch('/attachments', {
+        method: 'POST',
+        headers: { 'Content-Type': blob.type || 'application/octet-stream' },
+        body: blob,
+        credentials: 'same-origin'
+    }).then(function (res) {
+        if (!res.ok) throw new Error('upload failed: ' + res.status);
+        return res.json();
+    });
+}
+
 if (privatePhotoInput) {
     privatePhotoInput.addEventListener('change', function () {
         var file = this.files[0];
         if (!file || !file.type.startsWith('image/') || !currentPrivateSessionId) return;
         this.value = '';
-        resizeImageToDataUrl(file, 800, 0.8, function (dataUrl) {
-            if (dataUrl) {
-                socket.emit('private_chat_image', { data_url: dataUrl });
-                appendChatMessage(USER_NAME || '自分', '', true, dataUrl);
+        resizeImageToBlob(file, 800, 0.8, function (blob) {
+            if (!blob) return;
+            appendChatMessage(USER_NAME || '自分', '', true, URL.createObjectURL(blob));
+            uploadChatImage(blob).then(function (att) {
+                socket.emit('private_chat_image', { attachment_id: att.id }, function (ack) {
+                    if (!ack || !ack.ok) showToast('画像を送信できませんでした');
+                    else if (ack.id > lastChatId) lastChatId = ack.id;
+                });
+            }).catch(function (err) {
+                console.warn('Image upload error', err);
+                showToast('画像を送信できませんでした');
+            });
+        });
+    });
+}
+
+// ---------- 映像の送信品質（getStats() の要約をサーバーへ送り、返ってきた上限を setParameters で当てる） ----------
+// 要約の形は media_quality.py を参照。サーバーは送信本数・回線・相手の受信状況から送信ごとの上限を決め、
+// 変わったときだけ encoding_hints（相手 -> [maxBitrate, scaleResolutionDownBy, maxFramerate]）で送ってくる
+var MEDIA_STATS_INTERVAL_MS = window.MEDIA_STATS_INTERVAL_MS || 0;
+var mediaStatsPrev = {};  // 'o:' / 'i:' + 相手 -> 前回のバイト数・フレーム数（kbps・捨てたフレームの割合を差分で出す）
+var encodingHints = {};   // 相手 -> サーバーから届いた最新の上限
+var appliedEncodings = new WeakMap();  // RTCRtpSender -> 当て済みの上限（同じ値を当て直さない）
+
+// 今つないでいる接続: out = 送信（相手 -> RTCPeerConnection）、inb = 受信。大部屋の送信は中継サーバーへの1本（'sfu'）
+function mediaLinks() {
+    var out = {}, inb = {};
+    var table = currentPrivateSessionId ? privatePeers : peers;
+    Object.keys(table).forEach(function (sid) {
+        var pc = table[sid] && table[sid].connection;
+        if (!pc) return;
+        inb[sid] = pc;
+        if (currentPrivateSessionId || roomMode !== 'sfu') out[sid] = pc;
+    });
+    if (!currentPrivateSessionId && roomMode === 'sfu' && sfu && sfu.publisher) out.sfu = sfu.publisher;
+    return { out: out, inb: inb };
+}
+
+function statDelta(key, now, bytes, frames, dropped) {
+    var prev = mediaStatsPrev[key];
+    mediaStatsPrev[key] = { at: now, bytes: bytes, frames: frames, dropped: dropped };
+    if (!prev || now <= prev.at || bytes < prev.bytes) return null;
+    return { kbps: (bytes - prev.bytes) * 8 / (now - prev.at), frames: frames - prev.frames, dropped: dropped - prev.dropped };
+}
+
+function summarizeRtcStats(stats) {
+    var s = { out: null, inb: null, loss: 0, rtt: 0, available: 0 };
+    stats.forEach(function (r) {
+        if (r.type === 'outbound-rtp' && r.kind === 'video') s.out = r;
+        else if (r.type === 'inbound-rtp' && r.kind === 'video') s.inb = r;
+        else if (r.type === 'remote-inbound-rtp' && r.kind === 'video') {
+            s.loss = (r.fractionLost || 0) * 100;
+            s.rtt = (r.roundTripTime || 0) * 1000;
+        } else if (r.type === 'candidate-pair' && r.nominated && r.state === 'succeeded') {
+            s.available = (r.availableOutgoingBitrate || 0) / 1000;
+        }
+    });
+    return s;
+}
+
+function reportMediaStats() {
+    if (!socket.connected) return;
+    var links = mediaLinks();
+    applyEncodingHints();
+    var names = Object.keys(links.out).concat(Object.keys(links.inb).filter(function (sid) { return !links.out[sid]; }));
+    if (!names.length) return;
+    Promise.all(names.map(function (peer) {
+        return (links.out[peer] || links.inb[peer]).getStats().then(function (stats) {
+            return [peer, summarizeRtcStats(stats)];
+        }).catch(function () { return null; });
+    })).then(function (results) {
+        var now = Date.now(), o = [], i = [], b = 0, seen = {};
+        results.forEach(function (r) {
+            if (!r) return;
+            var peer = r[0], s = r[1], d;
+            if (links.out[peer] && s.out) {
+                seen['o:' + peer] = true;
+                d = statDelta('o:' + peer, now, s.out.bytesSent || 0, s.out.framesEncoded || 0, 0);
+                o.push([peer, d ? Math.round(d.kbps) : 0, Math.round(s.out.framesPerSecond || 0), s.out.frameHeight || 0,
+                    s.out.qualityLimitationReason || 'none', Math.round(s.loss * 10) / 10, Math.round(s.rtt)]);
             }
+            if (links.inb[peer] && s.inb) {
+                seen['i:' + peer] = true;
+                d = statDelta('i:' + peer, now, s.inb.bytesReceived || 0, s.inb.framesReceived || 0, s.inb.framesDropped || 0);
+                if (d) i.push([peer, Math.round(d.kbps), Math.round(s.inb.framesPerSecond || 0),
+                    d.frames > 0 ? Math.round(d.dropped * 1000 / d.frames) / 10 : 0]);
+            }
+            b = Math.max(b, Math.round(s.available));
         });
+        Object.keys(mediaStatsPrev).forEach(function (key) { if (!seen[key]) delete mediaStatsPrev[key]; });
+        if (o.length || i.length) socket.emit('media_stats', { o: o, i: i, b: b });
     });
 }
+
+// サーバーから届いた上限を送信中の映像に当てる。まだネゴシエーション前の送信は、次の統計の送信時に当て直す
+function applyEncodingHints() {
+    var out = mediaLinks().out;
+    Object.keys(encodingHints).forEach(function (peer) {
+        var pc = out[peer], hint = encodingHints[peer], key = hint.join(',');
+        if (!pc || !pc.getSenders) return;
+        pc.getSenders().forEach(function (sender) {
+            if (!sender.track || sender.track.kind !== 'video' || !sender.getParameters) return;
+            if (appliedEncodings.get(sender) === key) return;
+            var params = sender.getParameters();
+            if (!params.encodings || !params.encodings.length) return;
+            params.encodings[0].maxBitrate = hint[0];
+            params.encodings[0].scaleResolutionDownBy = hint[1];
+            params.encodings[0].maxFramerate = hint[2];
+            appliedEncodings.set(sender, key);
+            sender.setParameters(params).catch(function (err) {
+                appliedEncodings.delete(sender);
+                console.warn('[quality] setParameters', peer, err);
+            });
+        });
+    });
+}
+
+socket.on('encoding_hints', function (data) {
+    encodingHints = (data && data.h) || {};
+    applyEncodingHints();
+});
+
+if (MEDIA_STATS_INTERVAL_MS > 0) setInterval(reportMediaStats, MEDIA_STATS_INTERVAL_MS);
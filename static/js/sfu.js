@@ -0,0 +1,98 @@
+// 大部屋（SFU）用: 中継サーバー（media_relay.py）への送信1本と、参加者ごとの受信をまとめる。
+// シグナリングは HTTP の offer / answer 1往復（ICE 候補は集め終わってから SDP にまとめて送る）。
+// 本文は text/plain で送る（中継サーバーは JSON として読む）。CORS の preflight が要らない。
+function SfuClient(url, token, rtcConfig) {
+    this.url = url;
+    this.token = token;
+    this.rtcConfig = rtcConfig;
+    this.publisher = null;
+    this.subscriptions = {};  // publisher sid -> RTCPeerConnection
+}
+
+SfuClient.prototype._post = function (path, body) {
+    body.token = this.token;
+    return fetch(this.url + path, {
+        method: 'POST',
+        headers: { 'Content-Type': 'text/plain' },
+        body: JSON.stringify(body)
+    }).then(function (res) {
+        if (!res.ok) throw new Error('SFU ' + path + ' ' + res.status);
+        return res.json();
+    });
+};
+
+function waitIceGatheringComplete(pc, timeoutMs) {
+    return new Promise(function (resolve) {
+        if (pc.iceGatheringState === 'complete') return resolve();
+        function check() {
+            if (pc.iceGatheringState !== 'complete') return;
+            pc.removeEventListener('icegatheringstatechange', check);
+            resolve();
+        }
+        pc.addEventListener('icegatheringstatechange', check);
+        setTimeout(resolve, timeoutMs);  // 集まった分だけで送る
+    });
+}
+
+SfuClient.prototype._negotiate = function (pc, path, body) {
+    var self = this;
+    return pc.createOffer().then(function (offer) {
+        return pc.setLocalDescription(offer);
+    }).then(function () {
+        return waitIceGatheringComplete(pc, 2000);
+    }).then(function () {
+        body.sdp = pc.localDescription.sdp;
+        body.type = pc.localDescription.type;
+        return self._post(path, body);
+    }).then(function (answer) {
+        return pc.setRemoteDescription(answer);
+    });
+};
+
+// 自分の映像・音声を中継サーバーへ送る（人数によらず1本）
+SfuClient.prototype.publish = function (stream) {
+    if (this.publisher) this.publisher.close();
+    var pc = new RTCPeerConnection(this.rtcConfig);
+    stream.getTracks().forEach(function (track) { pc.addTrack(track, stream); });
+    this.publisher = pc;
+    return this._negotiate(pc, '/publish', {});
+};
+
+// publisherSid の映像・音声を受け取る。quality は 'full'（元の解像度）か 'thumb'（縮小版）。
+// 最初のトラックが届いたら onStream(MediaStream) を1回呼ぶ（後から届いたトラックは同じ stream に足す）
+SfuClient.prototype.subscribe = function (publisherSid, quality, onStream) {
+    if (this.subscriptions[publisherSid]) this.subscriptions[publisherSid].close();
+    var pc = new RTCPeerConnection(this.rtcConfig);
+    pc.addTransceiver('video', { direction: 'recvonly' });
+    pc.addTransceiver('audio', { direction: 'recvonly' });
+    var stream = new MediaStream();
+    pc.ontrack = function (event) {
+        stream.addTrack(event.track);
+        if (stream.getTracks().length === 1) onStream(stream);
+    };
+    this.subscriptions[publisherSid] = pc;
+    this._negotiate(pc, '/subscribe', { publisher: publisherSid, quality: quality }).catch(function (err) {
+        console.warn('[SFU] subscribe failed', publisherSid, err);
+    });
+    return pc;
+};
+
+// 受信中の映像の画質を切り替える（再ネゴシエーションなし）
+SfuClient.prototype.setQuality = function (publisherSid, quality) {
+    if (!this.subscriptions[publisherSid]) return;
+    this._post('/quality', { publisher: publisherSid, quality: quality }).catch(function (err) {
+        console.warn('[SFU] quality', publisherSid, err);
+    });
+};
+
+// 送受信をすべて止める。ページを閉じるときにも届くよう sendBeacon で中継サーバーに知らせる
+SfuClient.prototype.close = function () {
+    var self = this;
+    if (this.publisher) this.publisher.close();
+    Object.keys(this.subscriptions).forEach(function (sid) { self.subscriptions[sid].close(); });
+    this.publisher = null;
+    this.subscriptions = {};
+    try {
+        navigator.sendBeacon(this.url + '/leave', JSON.stringify({ token: this.token }));
+    } catch (e) {}
+};
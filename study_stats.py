@@ -0,0 +1,82 @@
+"""
+学習時間の集計（日別・週別・月別の合計、連続学習日数、全体ランキング）
+
+学習記録をまとめて書き込むたびに、日別の合計（study_daily）と連続学習日数（user_stats）を加算で更新する。
+ダッシュボードは本人の直近1か月分の日別の行を読むだけで、全ユーザーを並べ替えることはしない。
+
+総学習時間（分）ごとのユーザー数（study_rank_buckets）も、書き込みのたびに加算前の分数から加算後の分数へ移す。
+全体ランキングはバックグラウンドで定期的に作り直し、上位 N 件（ORDER BY ... LIMIT）と分数ごとの人数を
+Leaderboard に置く。順位は「自分より多い人数 + 1」で、分数ごとの人数の累積和を二分探索して引く（DB は引かない）。
+行数はユーザー数ではなく分数の種類の数。値はワーカーごと。
+"""
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta, time as dt_time
+
+
+def local_day(ts, tz):
+    return datetime.fromtimestamp(ts, tz).date()
+
+
+def split_by_day(started_at, ended_at, tz):
+    """[started_at, ended_at) を tz の0時で区切り、{日付: 秒数} にする（日をまたぐ学習は両方の日に入る）。"""
+    days = {}
+    t = started_at
+    while t < ended_at:
+        day = local_day(t, tz)
+        next_midnight = datetime.combine(day + timedelta(days=1), dt_time.min, tz).timestamp()
+        end = min(ended_at, next_midnight)
+        days[day] = days.get(day, 0) + (end - t)
+        t = end
+    return {day: int(seconds) for day, seconds in days.items() if seconds >= 1}
+
+
+def period_starts(today):
+    """今週（月曜始まり）と今月の初日。"""
+    return today - timedelta(days=today.weekday()), today.replace(day=1)
+
+
+def advance_streak(current, longest, last_day, day):
+    """day に学習したときの (連続日数, 最長連続日数, 最終学習日)。day は日付の昇順で渡すこと。"""
+    if last_day is not None and day <= last_day:
+        return current, longest, last_day
+    current = current + 1 if last_day is not None and day - last_day == timedelta(days=1) else 1
+    return current, max(longest, current), day
+
+
+def current_streak(current, last_day, today):
+    """表示用の連続日数。最終学習日が今日か昨日でなければ途切れているので 0。"""
+    if last_day is None or (today - last_day).days > 1:
+        return 0
+    return current
+
+
+class Leaderboard:
+    def __init__(self, size=10):
+        self.size = size
+        self.top = {}                  # 期間（'week' / 'all'）-> [{ name, profile_image, minutes }, ...]
+        self._minutes = array('q')     # 総学習時間（分）の昇順（人数のいる分数だけ）
+        self._above = array('q', [0])  # _above[i]: _minutes[i] 以上のユーザー数（末尾は 0）
+        self.refreshed_at = None
+
+    def replace(self, top, buckets):
+        """buckets は (総学習時間（分）, 人数) の昇順。"""
+        self.top = top
+        self._minutes = array('q', (minutes for minutes, _ in buckets))
+        above = array('q', [0] * (len(buckets) + 1))
+        for i in range(len(buckets) - 1, -1, -1):
+            above[i] = above[i + 1] + buckets[i][1]
+        self._above = above
+        self.refreshed_at = time.time()
+
+    @property
+    def population(self):
+        """総学習時間が 0 より多いユーザーの数。"""
+        return self._above[0]
+
+    def rank(self, total_minutes):
+        """総学習時間が total_minutes の人の順位（自分より多い人数 + 1）。まだ集計していなければ None。"""
+        if self.refreshed_at is None or total_minutes <= 0:
+            return None
+        return self._above[bisect_right(self._minutes, total_minutes)] + 1
@@ -0,0 +1,23 @@
+"""
+アプリをこのプロセスに import するテスト用の共通 fixture
+
+app.py は import 時に環境変数を読むので、最初に import する前にテスト用の設定（一時ディレクトリの SQLite・
+アセットの出力先・大部屋の中継サーバー URL など）をまとめて入れる。
+app を使わないモジュール（縮小・集計など）のテストのために、リポジトリ直下を import パスに入れておく。
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def videodesk(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('app')
+    os.environ.update(SNAPSHOT_ENABLED='0', METRICS_ENABLED='0', SFU_URL='http://relay.test',
+                      ASSET_DIR=str(workdir / 'assets'), DATABASE_URL='sqlite:///' + str(workdir / 'db.sqlite3'))
+    import app
+    return app
@@ -0,0 +1,64 @@
+"""
+ハッシュ付き静的ファイル（/assets/）の配信のテスト
+
+app をこのプロセスに import し（conftest.py）、Flask のテストクライアントでログイン済みのセッション Cookie を付けて取得する。
+/assets/ のレスポンスはだれに返しても同じなので、セッションに触れず Vary: Cookie を付けないことを確かめる
+（付くと共有キャッシュや CDN が Cookie ごとに別々に持つことになる）。
+縮小（minify_css / minify_js）は app を使わずに直接呼び、コメントと空白だけが消えて文字列などが残ることを確かめる。
+"""
+import re
+
+import pytest
+
+from assets import minify_css, minify_js
+
+
+@pytest.fixture(scope='module')
+def client(videodesk):
+    client = videodesk.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+    return client
+
+
+def test_assets_do_not_vary_on_cookie(client):
+    html = client.get('/').data.decode()
+    urls = re.findall(r'(?:href|src)="(/assets/[^"]+)"', html)
+    assert urls
+    for url in urls:
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert 'immutable' in response.headers['Cache-Control']
+        assert response.vary.as_set() == {'accept-encoding'}
+        assert 'Set-Cookie' not in response.headers
+
+
+def test_minify_js_keeps_whitespace_inside_literals():
+    source = 'var s = "a  b",  t = `x\n    y  z`;\nvar r = /a  b/;\n'
+    assert minify_js(source) == 'var s = "a  b", t = `x\n    y  z`;\nvar r = /a  b/;\n'
+
+
+def test_minify_css_drops_comments_and_spaces_but_not_strings():
+    source = '/* head */\na  {  color: red ;  }\n\nb > i , p::after { content: "  /* x */ ;  " ; }\n'
+    assert minify_css(source) == 'a{color: red}b>i,p::after{content: "  /* x */ ;  "}\n'
+    assert minify_css("q::before { content: '\\'' }") == "q::before{content: '\\''}\n"
+
+
+def test_minify_js_drops_comments_and_blank_lines():
+    source = '// head\nvar a = 1;   /* one */\n\n\n  if (a) {\n    /* multi\n       line */\n    go();  // tail\n  }\n'
+    assert minify_js(source) == 'var a = 1;\nif (a) {\ngo();\n}\n'
+
+
+def test_minify_js_keeps_comment_markers_inside_literals():
+    source = 'var u = "http://x/*y*/"; var r = /\\/\\/[/*]/g; var t = `//`;\n'
+    assert minify_js(source) == source
+
+
+def test_minify_js_tells_regex_from_division():
+    source = 'var d = a / 2 / b; // half\nvar r = x.split(/ +/); return /a  b/.test(s)\nvar e = (a) / 2 /* c */;\n'
+    assert minify_js(source) == 'var d = a / 2 / b;\nvar r = x.split(/ +/); return /a  b/.test(s)\nvar e = (a) / 2 ;\n'
+
+
+def test_minify_js_keeps_line_breaks_for_semicolon_insertion():
+    assert minify_js('a = b\n(c)\nreturn\n  x\n') == 'a = b\n(c)\nreturn\nx\n'
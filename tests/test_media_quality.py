@@ -0,0 +1,136 @@
+"""
+media_quality（映像の送信品質の段の決め方）のテスト
+
+MediaReport.update_levels を報告ごとに呼び、前回の報告から段の履歴を引き継がせて段の移り変わりを確かめる。
+"""
+import pytest
+
+from media_quality import (BANDWIDTH_SHORTFALL, DROP_STEP_DOWN_PCT, LADDER, LOSS_STEP_DOWN_PCT, MIN_BITRATE_KBPS,
+                           STEP_UP_AFTER, UPLINK_HEADROOM, MediaReport, base_level)
+
+
+def _out(kbps=1400, reason='none', loss=0):
+    return [kbps, 30, 720, reason, loss, 40]
+
+
+class _Sender:
+    """1クライアントの報告を続けて送る（前回の報告を previous として渡す）。"""
+
+    def __init__(self, sid='me'):
+        self.sid = sid
+        self.report = None
+
+    def send(self, outbound, receivers=None, available_kbps=0):
+        report = MediaReport('room', 0, outbound, {}, available_kbps)
+        report.update_levels(self.sid, self.report, receivers or {})
+        self.report = report
+        return {peer: level for peer, (level, _) in report.levels.items()}
+
+
+def _receiver(sender_sid, dropped):
+    return MediaReport('room', 0, {}, {sender_sid: [900, 20, dropped]}, 0)
+
+
+def test_base_level_follows_link_count():
+    assert [base_level(n) for n in (0, 1, 2, 3, 5, 50)] == [0, 0, 1, 2, 4, len(LADDER) - 1]
+
+
+def test_parse_clamps_and_rejects_malformed_rows():
+    report = MediaReport.parse('room', {
+        'o': [['p', 1e9, -5, 'x', 'weird', float('nan'), 20], ['short', 1], [3, 1, 1, 1, 'none', 0, 0]],
+        'i': [['p', 100, 30, 250], 'junk'],
+        'b': 'n/a',
+    }, now=5)
+    assert report.outbound == {'p': [1e5, 0, 0, 'other', 0, 20]}
+    assert report.inbound == {'p': [100, 30, 100]}
+    assert (report.available_kbps, report.at) == (0, 5)
+    assert MediaReport.parse('room', ['not', 'a', 'dict']) is None
+
+
+def test_healthy_single_link_stays_at_top():
+    sender = _Sender()
+    for _ in range(5):
+        assert sender.send({'p': _out()}) == {'p': 0}
+    assert sender.report.hints == {'p': [LADDER[0][0] * 1000, LADDER[0][1], LADDER[0][2]]}
+
+
+@pytest.mark.parametrize('outbound', [
+    _out(reason='cpu'),
+    _out(loss=LOSS_STEP_DOWN_PCT),
+    _out(kbps=LADDER[1][0] * BANDWIDTH_SHORTFALL - 1, reason='bandwidth'),
+])
+def test_steps_down_one_level_under_pressure(outbound):
+    sender = _Sender()
+    sender.send({'p': _out()})
+    assert sender.send({'p': outbound}) == {'p': 1}
+    assert sender.send({'p': outbound}) == {'p': 2}
+
+
+def test_bandwidth_limit_at_the_cap_or_unmeasured_is_not_pressure():
+    sender = _Sender()
+    assert sender.send({'p': _out(kbps=LADDER[0][0], reason='bandwidth')}) == {'p': 0}
+    assert sender.send({'p': _out(kbps=0, reason='bandwidth')}) == {'p': 0}
+
+
+def test_steps_up_one_level_after_clean_reports():
+    sender = _Sender()
+    for _ in range(3):
+        sender.send({'p': _out(reason='cpu')})
+    assert sender.send({'p': _out(reason='cpu')}) == {'p': 4}
+    levels = [sender.send({'p': _out()})['p'] for _ in range(STEP_UP_AFTER * 4)]
+    assert levels == [4] * (STEP_UP_AFTER - 1) + [3] * STEP_UP_AFTER + [2] * STEP_UP_AFTER + \
+        [1] * STEP_UP_AFTER + [0]
+
+
+def test_pressure_during_recovery_resets_the_clean_count():
+    sender = _Sender()
+    sender.send({'p': _out(reason='cpu')})
+    for _ in range(STEP_UP_AFTER - 1):
+        assert sender.send({'p': _out()}) == {'p': 1}
+    assert sender.send({'p': _out(loss=LOSS_STEP_DOWN_PCT)}) == {'p': 2}
+    for _ in range(STEP_UP_AFTER - 1):
+        assert sender.send({'p': _out()}) == {'p': 2}
+    assert sender.send({'p': _out()}) == {'p': 1}
+
+
+def test_never_goes_below_the_bottom_level():
+    sender = _Sender()
+    for _ in range(len(LADDER) + 3):
+        levels = sender.send({'p': _out(reason='cpu')})
+    assert levels == {'p': len(LADDER) - 1}
+
+
+def test_more_links_start_lower_and_step_down_from_there():
+    sender = _Sender()
+    outbound = {'a': _out(), 'b': _out(), 'c': _out()}
+    assert sender.send(outbound) == {'a': 2, 'b': 2, 'c': 2}
+    outbound['b'] = _out(reason='cpu')
+    assert sender.send(outbound) == {'a': 2, 'b': 3, 'c': 2}
+    # 本数が減って基準の段が上がっても、上げるのは問題のない報告が続いてから1段ずつ
+    for _ in range(STEP_UP_AFTER - 1):
+        assert sender.send({'a': _out(), 'b': _out()}) == {'a': 2, 'b': 3}
+    assert sender.send({'a': _out(), 'b': _out()}) == {'a': 1, 'b': 2}
+
+
+def test_receiver_drops_step_down_only_that_link():
+    sender = _Sender()
+    receivers = {'a': [_receiver('me', DROP_STEP_DOWN_PCT)], 'b': [_receiver('me', 0)]}
+    assert sender.send({'a': _out(), 'b': _out()}, receivers) == {'a': 2, 'b': 1}
+
+
+def test_hall_link_uses_the_median_receiver():
+    sender = _Sender()
+    one_slow = [_receiver('me', 90), _receiver('me', 0), _receiver('me', 0)]
+    assert sender.send({'sfu': _out()}, {'sfu': one_slow}) == {'sfu': 0}
+    most_slow = [_receiver('me', 90), _receiver('me', DROP_STEP_DOWN_PCT), _receiver('me', 0)]
+    assert sender.send({'sfu': _out()}, {'sfu': most_slow}) == {'sfu': 1}
+    not_receiving = [_receiver('other', 90)]
+    assert sender.send({'sfu': _out()}, {'sfu': not_receiving}) == {'sfu': 1}
+
+
+def test_uplink_estimate_caps_each_link():
+    sender = _Sender()
+    sender.send({'a': _out(), 'b': _out()}, available_kbps=1000)
+    assert sender.report.hints['a'][0] == int(1000 * UPLINK_HEADROOM / 2 * 1000)
+    sender.send({'a': _out(), 'b': _out()}, available_kbps=50)
+    assert sender.report.hints['a'][0] == MIN_BITRATE_KBPS * 1000
@@ -0,0 +1,52 @@
+"""
+media_stats（映像の送信品質の調整）のテスト
+
+app をこのプロセスに import し（conftest.py）、Flask-SocketIO のテストクライアントで大部屋に入室させて報告を送る。
+大部屋の送信（'sfu'）でも、受信しているほかの参加者の報告（捨てたフレームの割合）で段が下がることを確かめる。
+"""
+import uuid
+
+from media_quality import DROP_STEP_DOWN_PCT, LADDER
+
+
+def _hints(client):
+    return [m['args'][0]['h'] for m in client.get_received() if m['name'] == 'encoding_hints']
+
+
+def _join_hall(videodesk, n):
+    room = 'hall_' + uuid.uuid4().hex[:8]
+    videodesk.room_configs[room] = {'mode': 'sfu', 'capacity': 8, 'idle_since': 0}
+    clients = []
+    for i in range(n):
+        client = videodesk.socketio.test_client(videodesk.app)
+        client.emit('join_room', {'room': room, 'user_name': f'u{i}'})
+        clients.append(client)
+    sids = [videodesk.socketio.server.manager.sid_from_eio_sid(c.eio_sid, '/') for c in clients]
+    assert all(videodesk.sid_to_room.get(sid) == room for sid in sids)
+    return clients, sids
+
+
+def _publish(client):
+    client.emit('media_stats', {'o': [['sfu', 1400, 30, 720, 'none', 0, 40]], 'i': [], 'b': 0})
+    return _hints(client)[-1]['sfu']
+
+
+def test_hall_sender_steps_down_when_receivers_drop_frames(videodesk):
+    (publisher, *receivers), (publisher_sid, *_) = _join_hall(videodesk, 4)
+    assert _publish(publisher)[0] == LADDER[0][0] * 1000
+
+    # 3人中2人（中央値）が publisher の映像のフレームを捨てている
+    for receiver, dropped in zip(receivers, (DROP_STEP_DOWN_PCT + 10, DROP_STEP_DOWN_PCT + 5, 0)):
+        receiver.emit('media_stats', {'o': [], 'i': [[publisher_sid, 900, 20, dropped]], 'b': 0})
+    assert _publish(publisher)[0] == LADDER[1][0] * 1000
+    for client in [publisher] + receivers:
+        client.disconnect()
+
+
+def test_hall_sender_ignores_a_single_slow_receiver(videodesk):
+    (publisher, *receivers), (publisher_sid, *_) = _join_hall(videodesk, 4)
+    for receiver, dropped in zip(receivers, (90, 0, 0)):
+        receiver.emit('media_stats', {'o': [], 'i': [[publisher_sid, 900, 20, dropped]], 'b': 0})
+    assert _publish(publisher)[0] == LADDER[0][0] * 1000
+    for client in [publisher] + receivers:
+        client.disconnect()
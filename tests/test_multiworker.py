@@ -0,0 +1,236 @@
+"""
+複数ワーカー構成のシグナリング中継のテスト
+
+bench/server.py を2プロセス起動し、どちらも同じ Redis 互換サーバー（fakeredis の TCP サーバー）を
+STATE_STORE_URL（ルーム状態）とメッセージキューに使う。ワーカーごとに1人ずつ同じルームへ入室させ、
+offer / answer / ICE candidate が別プロセスの相手に届くことと、両方のワーカーで同時に起きた
+ルームの変化が差分ログに欠けなく rev 順に残ること、席をキープしたワーカーが落ちても
+別のワーカーの監査がその席を期限切れにすることを確かめる。
+
+    pip install -r tests/requirements.txt
+    python -m pytest -q tests
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import pytest
+import requests
+import socketio
+
+fakeredis = pytest.importorskip('fakeredis')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 10
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_server(url, proc):
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'worker exited with code {proc.returncode}')
+        try:
+            if requests.get(url + '/bench/ping', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'worker {url} did not start')
+
+
+@pytest.fixture(scope='module')
+def redis_url():
+    port = _free_port()
+    server = fakeredis.TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'redis://127.0.0.1:{port}/0'
+    server.shutdown()
+    server.server_close()
+
+
+def _start_workers(redis_url, tmp_path_factory, envs):
+    """同じ STATE_STORE_URL を使う bench/server.py を envs（ワーカーごとに足す環境変数）の数だけ起動する。"""
+    procs, urls = [], []
+    for extra in envs:
+        workdir = tmp_path_factory.mktemp('worker')
+        port = _free_port()
+        env = dict(os.environ, STATE_STORE_URL=redis_url, SNAPSHOT_ENABLED='0', METRICS_ENABLED='0',
+                   DATABASE_URL='sqlite:///' + str(workdir / 'db.sqlite3'), **extra)
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'bench', 'server.py'), '--port', str(port)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f'http://127.0.0.1:{port}')
+    try:
+        for url, proc in zip(urls, procs):
+            _wait_for_server(url, proc)
+    except Exception:
+        _stop_workers(procs)
+        raise
+    return procs, urls
+
+
+def _stop_workers(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+    for proc in procs:
+        proc.wait(timeout=10)
+
+
+@pytest.fixture(scope='module')
+def workers(redis_url, tmp_path_factory):
+    """2つのワーカーの URL のリスト。"""
+    procs, urls = _start_workers(redis_url, tmp_path_factory, [{}, {}])
+    yield urls
+    _stop_workers(procs)
+
+
+class Peer:
+    """1ワーカーにつないだ socket.io クライアント。受け取ったイベントを名前ごとに待てる。"""
+
+    def __init__(self, url):
+        self.received = {}
+        self.log = []  # 受け取った順の (event, data)
+        self.cond = threading.Condition()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('*', self._on_any)
+        self.sio.connect(url, transports=['websocket'])
+
+    @property
+    def sid(self):
+        return self.sio.get_sid()
+
+    def _on_any(self, event, data=None):
+        with self.cond:
+            self.received.setdefault(event, []).append(data)
+            self.log.append((event, data))
+            self.cond.notify_all()
+
+    def wait(self, event, predicate=lambda data: True):
+        deadline = time.time() + TIMEOUT
+        with self.cond:
+            while True:
+                for data in self.received.get(event, []):
+                    if predicate(data):
+                        return data
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AssertionError(f'{event} not received; got {sorted(self.received)}')
+                self.cond.wait(remaining)
+
+
+def test_signaling_is_relayed_between_workers(workers):
+    room = 'mw_' + uuid.uuid4().hex[:8]
+    a, b = Peer(workers[0]), Peer(workers[1])
+    try:
+        a.sio.emit('join_room', {'room': room, 'user_name': 'A'})
+        assigned_a = a.wait('room_assigned')
+        b.sio.emit('join_room', {'room': room, 'user_name': 'B'})
+        assigned_b = b.wait('room_assigned')
+        assert assigned_a['room_id'] == assigned_b['room_id'] == room
+        assert {p['s'] for p in assigned_b['participants']} == {a.sid, b.sid}
+
+        description = {'type': 'offer', 'sdp': 'v=0\r\n'}
+        a.sio.emit('offer', {'target': b.sid, 'description': description})
+        offer = b.wait('offer')
+        assert offer == {'sender': a.sid, 'description': description}
+
+        answer_description = {'type': 'answer', 'sdp': 'v=0\r\n'}
+        b.sio.emit('answer', {'target': a.sid, 'description': answer_description})
+        answer = a.wait('answer')
+        assert answer == {'sender': b.sid, 'description': answer_description}
+
+        candidate = {'candidate': 'candidate:1 1 udp 2122252543 192.0.2.1 50000 typ host',
+                     'sdpMid': '0', 'sdpMLineIndex': 0}
+        a.sio.emit('ice_candidate', {'target': b.sid, 'candidate': candidate})
+        assert b.wait('ice_candidate') == {'sender': a.sid, 'candidate': candidate}
+        b.sio.emit('ice_candidates', {'target': a.sid, 'candidates': [candidate, candidate]})
+        assert a.wait('ice_candidates') == {'sender': b.sid, 'candidates': [candidate, candidate]}
+    finally:
+        a.sio.disconnect()
+        b.sio.disconnect()
+
+
+def test_room_deltas_stay_contiguous_across_workers(workers):
+    room = 'mw_' + uuid.uuid4().hex[:8]
+    a, b = Peer(workers[0]), Peer(workers[1])
+    late = [Peer(workers[0]), Peer(workers[1])]
+    try:
+        a.sio.emit('join_room', {'room': room, 'user_name': 'A'})
+        a.wait('room_assigned')
+        b.sio.emit('join_room', {'room': room, 'user_name': 'B'})
+        b.wait('room_assigned')
+        rev = a.wait('user_joined')['rev']
+
+        # 入室（user_joined）と挙手（hand_raise_update）を両方のワーカーで同時に起こす
+        def raise_hands(peer):
+            for raised in (True, False, True):
+                peer.sio.emit('hand_raise', {'raised': raised})
+
+        threads = [threading.Thread(target=raise_hands, args=(peer,)) for peer in (a, b)]
+        threads += [threading.Thread(target=peer.sio.emit, args=('join_room', {'room': room, 'user_name': 'L'}))
+                    for peer in late]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for peer in late:
+            assert peer.wait('room_assigned')['room_id'] == room
+        expected = 2 + 6
+        deadline = time.time() + TIMEOUT
+        with a.cond:  # 最後の差分は入室・挙手のどちらの場合もある
+            while max(data['rev'] for _, data in a.log if isinstance(data, dict) and 'rev' in data) < rev + expected:
+                assert time.time() < deadline, 'room deltas not received'
+                a.cond.wait(deadline - time.time())
+
+        with a.cond:
+            a.log.clear()
+        a.sio.emit('request_room_state', {'room_id': room, 'rev': rev})
+        deadline = time.time() + TIMEOUT
+        with a.cond:
+            while len(a.log) < expected and 'room_state' not in [e for e, _ in a.log] and time.time() < deadline:
+                a.cond.wait(deadline - time.time())
+            replayed = list(a.log)
+        assert 'room_state' not in [event for event, _ in replayed]
+        assert [data['rev'] for _, data in replayed] == list(range(rev + 1, rev + expected + 1))
+        assert sorted(event for event, _ in replayed) == ['hand_raise_update'] * 6 + ['user_joined'] * 2
+    finally:
+        for peer in [a, b] + late:
+            peer.sio.disconnect()
+
+
+def test_held_seat_expires_after_its_worker_dies(redis_url, tmp_path_factory):
+    # 0: 切断した人の席を2秒キープする（監査なし）。1: 毎秒監査する
+    procs, urls = _start_workers(redis_url, tmp_path_factory, [
+        {'RECONNECT_GRACE_SECONDS': '2', 'STATE_AUDIT_INTERVAL': '0'},
+        {'STATE_AUDIT_INTERVAL': '1'},
+    ])
+    room = 'mw_' + uuid.uuid4().hex[:8]
+    a, b = Peer(urls[0]), Peer(urls[1])
+    try:
+        a.sio.emit('join_room', {'room': room, 'user_name': 'A', 'user_id': uuid.uuid4().hex})
+        a.wait('room_assigned')
+        b.sio.emit('join_room', {'room': room, 'user_name': 'B', 'user_id': uuid.uuid4().hex})
+        b.wait('room_assigned')
+        a_sid = a.sid
+        a.sio.disconnect()
+        assert b.wait('participant_disconnected')['sid'] == a_sid
+        # キープの期限切れを処理するはずだったワーカーを、期限より前に落とす
+        procs[0].send_signal(signal.SIGKILL)
+        procs[0].wait(timeout=10)
+        left = b.wait('user_left')
+        assert left['sid'] == a_sid
+    finally:
+        b.sio.disconnect()
+        _stop_workers(procs)
@@ -0,0 +1,43 @@
+"""
+個別指導の画像チャット（private_chat_image）のテスト
+
+app をこのプロセスに import し（conftest.py）、Flask-SocketIO のテストクライアントで個別ルームに入室させて送る。
+旧クライアントの data_url 直送は SOCKET_MAX_IMAGE_BYTES までを相手に届け、それを超えるものは ack で too_large を返す
+（上限は engine.io が接続ごと切る SOCKET_MAX_MESSAGE_BYTES より小さい）。
+"""
+import uuid
+
+
+def _join_private(videodesk):
+    session_id = 'private_' + uuid.uuid4().hex[:16]
+    clients = [videodesk.socketio.test_client(videodesk.app) for _ in range(2)]
+    admin_sid, student_sid = [videodesk.socketio.server.manager.sid_from_eio_sid(c.eio_sid, '/') for c in clients]
+    videodesk.private_rooms[session_id] = videodesk.PrivateSession(session_id, 'main', admin_sid, student_sid)
+    for client, name in zip(clients, ('admin', 'student')):
+        client.emit('join_private_room', {'session_id': session_id, 'user_name': name, 'role': name})
+    return clients
+
+
+def _images(client):
+    return [m['args'][0] for m in client.get_received() if m['name'] == 'private_chat_image']
+
+
+def test_legacy_image_within_cap_is_relayed(videodesk):
+    admin, student = _join_private(videodesk)
+    data_url = 'data:image/png;base64,' + 'A' * 1000
+    assert admin.emit('private_chat_image', {'data_url': data_url}, callback=True)['ok']
+    assert [m['data_url'] for m in _images(student)] == [data_url]
+    admin.disconnect()
+    student.disconnect()
+
+
+def test_oversized_legacy_image_returns_too_large(videodesk):
+    assert videodesk.SOCKET_MAX_IMAGE_BYTES < videodesk.SOCKET_MAX_MESSAGE_BYTES
+    admin, student = _join_private(videodesk)
+    data_url = 'data:image/png;base64,' + 'A' * videodesk.SOCKET_MAX_IMAGE_BYTES
+    ack = admin.emit('private_chat_image', {'data_url': data_url}, callback=True)
+    assert ack == {'ok': False, 'error': 'too_large'}
+    assert _images(student) == []
+    assert admin.is_connected()
+    admin.disconnect()
+    student.disconnect()
@@ -0,0 +1,161 @@
+"""
+ratelimit（Socket.IO イベントの流量制限と送信キューの監視）のテスト
+
+時計（time.monotonic）は固定値に差し替え、トークンの補充を秒単位で進めて確かめる。
+Socket.IO のサーバーは、RateLimiter / OutboundMonitor が触る属性だけを持つ小さな偽物で代える。
+"""
+from types import SimpleNamespace
+
+import pytest
+
+import ratelimit
+from ratelimit import OutboundMonitor, RateLimiter, parse_rules, payload_size
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def _drain(limiter, sid='a', event='offer', n=100):
+    """受け付けられた回数（最初に捨てられるまで）。"""
+    for i in range(n):
+        if limiter.check(sid, event, {}) is not None:
+            return i
+    return n
+
+
+def test_parse_rules():
+    assert parse_rules('offer=5/20, ice_candidate=50 ,,') == {'offer': (5.0, 20.0), 'ice_candidate': (50.0, 50.0)}
+    assert parse_rules('') == {}
+
+
+def test_payload_size_stops_counting_past_limit():
+    assert payload_size({'k': 'abc', 'n': [1, b'xy']}, 100) == 1 + 3 + 1 + 8 + 2
+    assert payload_size(['x' * 10] * 1000, 25) <= 35
+
+
+def test_bucket_starts_full_and_refills_at_rate(clock):
+    limiter = RateLimiter({'offer': (4, 5)})
+    assert _drain(limiter) == 5
+    clock[0] += 0.125  # 0.5 トークン: まだ足りない
+    assert limiter.check('a', 'offer', {}) == 'rate_limited'
+    clock[0] += 0.125  # 前回の判定で 0.5 まで補充済み、+0.5 でちょうど 1
+    assert limiter.check('a', 'offer', {}) is None
+    assert limiter.check('a', 'offer', {}) == 'rate_limited'
+
+
+def test_refill_is_capped_at_burst_after_idle(clock):
+    limiter = RateLimiter({'offer': (2, 5)})
+    _drain(limiter)
+    clock[0] += 3600
+    assert _drain(limiter) == 5
+
+
+def test_refill_does_not_go_negative_when_clock_stands_still(clock):
+    limiter = RateLimiter({'offer': (1, 1)})
+    assert limiter.check('a', 'offer', {}) is None
+    for _ in range(3):
+        assert limiter.check('a', 'offer', {}) == 'rate_limited'
+    clock[0] += 1
+    assert limiter.check('a', 'offer', {}) is None
+
+
+def test_buckets_are_per_sid_and_event(clock):
+    limiter = RateLimiter({'offer': (1, 2)}, default=(1, 3))
+    assert _drain(limiter, 'a', 'offer') == 2
+    assert _drain(limiter, 'b', 'offer') == 2
+    assert _drain(limiter, 'a', 'answer') == 3
+    limiter.forget('a')
+    assert _drain(limiter, 'a', 'offer') == 2
+
+
+def test_events_without_rule_are_not_limited(clock):
+    assert _drain(RateLimiter({'offer': (1, 1)}), event='answer', n=50) == 50
+
+
+def test_too_large_is_checked_before_the_bucket(clock):
+    limiter = RateLimiter({'offer': (1, 1)}, max_bytes={'*': 10, 'image': 100})
+    assert limiter.check('a', 'offer', {'sdp': 'x' * 20}) == 'too_large'
+    assert limiter.check('a', 'offer', {'sdp': 'x'}) is None  # 大きすぎたイベントはトークンを使わない
+    assert limiter.check('a', 'image', {'d': 'x' * 50}) is None
+
+
+def _fake_socketio(handlers):
+    disconnected = []
+    server = SimpleNamespace(handlers={'/': handlers},
+                             disconnect=lambda sid, namespace: disconnected.append(sid))
+    return SimpleNamespace(server=server), disconnected
+
+
+def test_instrumented_handler_acks_and_disconnects_after_strikes(clock):
+    calls = []
+    socketio, disconnected = _fake_socketio({'offer': lambda sid, data: calls.append(sid) or 'ok',
+                                             'connect': lambda sid, environ: None})
+    limiter = RateLimiter({'offer': (1, 1)}, disconnect_after=3)
+    limiter.instrument_socketio(socketio)
+    limiter.instrument_socketio(socketio)  # 二重に包まない
+    handler = socketio.server.handlers['/']['offer']
+    assert handler('a', {}) == 'ok'
+    assert handler('a', {}) == {'ok': False, 'error': 'rate_limited'}
+    assert handler('a', {}) == {'ok': False, 'error': 'rate_limited'}
+    assert disconnected == []
+    assert handler('a', {}) == {'ok': False, 'error': 'rate_limited'}
+    assert disconnected == ['a'] and limiter.disconnects == 1
+    assert limiter.dropped == {('offer', 'rate_limited'): 3}
+    assert calls == ['a']
+    assert not getattr(socketio.server.handlers['/']['connect'], '_ratelimit', False)
+
+
+def test_accepted_event_resets_strikes(clock):
+    socketio, disconnected = _fake_socketio({'offer': lambda sid, data: 'ok'})
+    limiter = RateLimiter({'offer': (1, 1)}, disconnect_after=2)
+    limiter.instrument_socketio(socketio)
+    handler = socketio.server.handlers['/']['offer']
+    for _ in range(3):
+        assert handler('a', {}) == 'ok'
+        assert handler('a', {}) == {'ok': False, 'error': 'rate_limited'}
+        clock[0] += 1
+    assert disconnected == []
+
+
+class _Sock:
+    def __init__(self, depth):
+        self.queue = SimpleNamespace(qsize=lambda: depth)
+        self.closed = False
+
+    def close(self, wait=True, abort=False):
+        self.closed = True
+
+
+def _monitor(depths, **kwargs):
+    sockets = {'e' + sid: _Sock(depth) for sid, depth in depths.items()}
+    manager = SimpleNamespace(eio_sid_from_sid=lambda sid, namespace: 'e' + sid if 'e' + sid in sockets else None)
+    socketio = SimpleNamespace(server=SimpleNamespace(manager=manager, eio=SimpleNamespace(sockets=sockets)))
+    return OutboundMonitor(socketio, **kwargs), sockets
+
+
+def test_outbound_drops_relays_to_slow_receivers():
+    monitor, _ = _monitor({'fast': 3, 'slow': 10}, drop_depth=10, disconnect_depth=20)
+    assert not monitor.should_drop('fast', 'ice_candidate')
+    assert monitor.should_drop('slow', 'ice_candidate')
+    assert not monitor.should_drop('elsewhere', 'ice_candidate')  # ほかのワーカーの接続
+    assert monitor.dropped == {'ice_candidate': 1}
+    assert monitor.max_depth() == 10
+
+
+def test_outbound_sweep_disconnects_at_threshold():
+    monitor, sockets = _monitor({'a': 19, 'b': 20}, drop_depth=10, disconnect_depth=20)
+    monitor.sweep()
+    monitor.sweep()  # 閉じたソケットは数え直さない
+    assert (sockets['ea'].closed, sockets['eb'].closed) == (False, True)
+    assert monitor.disconnects == 1
+
+
+def test_outbound_thresholds_of_zero_are_disabled():
+    monitor, sockets = _monitor({'a': 5000}, drop_depth=0, disconnect_depth=0)
+    assert not monitor.should_drop('a', 'ice_candidate')
+    monitor.sweep()
+    assert not sockets['ea'].closed
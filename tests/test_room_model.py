@@ -0,0 +1,65 @@
+"""
+room_model.ChatHistory（個別指導チャットの直近の発言）のテスト
+"""
+from room_model import ChatHistory
+
+
+def _ids(history):
+    return [m[0] for m in history.messages]
+
+
+def test_append_numbers_messages_and_counts_bytes():
+    history = ChatHistory()
+    assert history.first_id == 1
+    first = history.append('s1', 'あ', 'text', 'hello', 10, 1000)
+    history.append('s2', 'b', 'image', 'att123', 10, 1000)
+    assert first[:5] == [1, 's1', 'あ', 'text', 'hello']
+    assert _ids(history) == [1, 2] and history.next_id == 3
+    assert history.size == len('あ'.encode()) + 5 + 1 + 6
+
+
+def test_evicts_oldest_past_max_messages():
+    history = ChatHistory()
+    for i in range(5):
+        history.append('s', 'u', 'text', str(i), 3, 1000)
+    assert _ids(history) == [3, 4, 5]
+    assert history.first_id == 3
+    assert history.size == 3 * 2
+
+
+def test_evicts_oldest_past_max_bytes_but_keeps_latest():
+    history = ChatHistory()
+    history.append('s', 'u', 'text', 'x' * 10, 100, 25)
+    history.append('s', 'u', 'text', 'x' * 10, 100, 25)
+    assert _ids(history) == [1, 2]
+    history.append('s', 'u', 'text', 'x' * 10, 100, 25)
+    assert _ids(history) == [2, 3] and history.size == 22
+    history.append('s', 'u', 'text', 'x' * 100, 100, 25)  # 1件で上限を超えても最新は残す
+    assert _ids(history) == [4] and history.size == 101
+
+
+def test_after_returns_newer_messages_in_order():
+    history = ChatHistory()
+    for i in range(4):
+        history.append('s', 'u', 'text', str(i), 10, 1000)
+    assert [m[0] for m in history.after(2)] == [3, 4]
+    assert [m[0] for m in history.after(0)] == [1, 2, 3, 4]
+    assert history.after(4) == []
+
+
+def test_first_id_after_everything_is_evicted_shows_the_gap():
+    history = ChatHistory()
+    for i in range(6):
+        history.append('s', 'u', 'text', str(i), 2, 1000)
+    # after=1 のクライアントは 2〜4 を見逃している（first_id > after + 1）
+    assert history.first_id == 5 and [m[0] for m in history.after(1)] == [5, 6]
+
+
+def test_json_round_trip_keeps_ids_and_size():
+    history = ChatHistory()
+    for i in range(3):
+        history.append('s', 'ユーザー', 'text', 'メッセージ' + str(i), 10, 1000)
+    restored = ChatHistory.from_json(history.to_json())
+    assert restored.messages == history.messages
+    assert (restored.next_id, restored.size, restored.first_id) == (history.next_id, history.size, history.first_id)
+    assert restored.append('s', 'u', 'text', 'x', 10, 1000)[0] == 4
@@ -0,0 +1,70 @@
+"""
+study_stats（日別の集計・連続学習日数・全体ランキング）のテスト
+"""
+from datetime import date, datetime, timedelta, timezone
+
+from study_stats import Leaderboard, advance_streak, current_streak, period_starts, split_by_day
+
+JST = timezone(timedelta(hours=9))
+
+
+def _ts(*args):
+    return datetime(*args, tzinfo=JST).timestamp()
+
+
+def test_split_by_day_within_one_day():
+    assert split_by_day(_ts(2026, 3, 1, 10), _ts(2026, 3, 1, 11, 30), JST) == {date(2026, 3, 1): 5400}
+
+
+def test_split_by_day_across_midnight_uses_the_given_timezone():
+    started, ended = _ts(2026, 3, 1, 23, 30), _ts(2026, 3, 3, 0, 15)
+    assert split_by_day(started, ended, JST) == {date(2026, 3, 1): 1800, date(2026, 3, 2): 86400,
+                                                 date(2026, 3, 3): 900}
+    # UTC では同じ区間が 3/1 14:30 〜 3/2 15:15
+    assert split_by_day(started, ended, timezone.utc) == {date(2026, 3, 1): 34200, date(2026, 3, 2): 54900}
+
+
+def test_split_by_day_drops_empty_and_sub_second_parts():
+    assert split_by_day(_ts(2026, 3, 1, 10), _ts(2026, 3, 1, 10), JST) == {}
+    assert split_by_day(_ts(2026, 3, 1, 10), _ts(2026, 3, 1, 9), JST) == {}
+    assert split_by_day(_ts(2026, 3, 2) - 0.5, _ts(2026, 3, 2, 0, 1), JST) == {date(2026, 3, 2): 60}
+
+
+def test_period_starts():
+    assert period_starts(date(2026, 3, 4)) == (date(2026, 3, 2), date(2026, 3, 1))
+
+
+def test_advance_streak():
+    state = (0, 0, None)
+    for day in (date(2026, 3, 1), date(2026, 3, 2), date(2026, 3, 3)):
+        state = advance_streak(*state, day)
+    assert state == (3, 3, date(2026, 3, 3))
+    assert advance_streak(*state, date(2026, 3, 3)) == state  # 同じ日・過去の日は数えない
+    assert advance_streak(*state, date(2026, 3, 2)) == state
+    assert advance_streak(*state, date(2026, 3, 5)) == (1, 3, date(2026, 3, 5))
+
+
+def test_current_streak_breaks_after_a_missed_day():
+    last = date(2026, 3, 3)
+    assert current_streak(4, last, last) == 4
+    assert current_streak(4, last, last + timedelta(days=1)) == 4
+    assert current_streak(4, last, last + timedelta(days=2)) == 0
+    assert current_streak(0, None, last) == 0
+
+
+def test_leaderboard_rank_counts_users_above():
+    board = Leaderboard()
+    assert board.rank(100) is None and board.population == 0
+    board.replace({'all': []}, [(10, 3), (50, 2), (120, 1)])
+    assert board.population == 6
+    assert [board.rank(m) for m in (500, 120, 60, 50, 10, 5)] == [1, 1, 2, 2, 4, 7]
+    assert board.rank(0) is None  # 学習していない人は順位なし
+
+
+def test_leaderboard_replace_discards_old_buckets():
+    board = Leaderboard()
+    board.replace({}, [(10, 3), (50, 2)])
+    board.replace({}, [(30, 1)])
+    assert (board.population, board.rank(10), board.rank(30)) == (1, 2, 1)
+    board.replace({}, [])
+    assert (board.population, board.rank(10)) == (0, 1)
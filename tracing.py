@@ -0,0 +1,86 @@
+"""
+イベントトレース（join / leave / ホスト交代 / 個別指導セッション）
+
+ハンドラ内ではメモリ上の有限キューに積むだけで、ファイル書き込みはバックグラウンドで
+まとめて行う（イベントループ上で1件ごとに open/write しない）。無効時の trace() は
+何もしない関数なので、呼び出しコストは関数呼び出し1回だけ。
+
+出力は JSON Lines（1行1イベント）。サイズが max_bytes を超えたら .1, .2 ... にローテーションする。
+"""
+import json
+import os
+import random
+import time
+from collections import deque
+
+
+class Tracer:
+    def __init__(self, path, enabled=False, sample_rate=1.0, queue_size=10000,
+                 max_bytes=5 * 1024 * 1024, backup_count=3, flush_interval=1.0):
+        self.path = path
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        # 満杯時は古いイベントから捨てる（ハンドラを待たせない）
+        self._queue = deque(maxlen=queue_size)
+        self.dropped = 0
+        self._started = False
+        if not enabled:
+            self.trace = self._noop
+
+    def _noop(self, location, message, **data):
+        pass
+
+    def trace(self, location, message, **data):
+        """イベントを1件キューに積む。sample_rate < 1 のときは確率的に間引く。"""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append((time.time() * 1000, location, message, data))
+
+    def start(self, start_background_task, sleep):
+        """バックグラウンドのフラッシャーを起動する（無効時は何もしない）。"""
+        if not self.enabled or self._started:
+            return
+        self._started = True
+
+        def _loop():
+            while True:
+                sleep(self.flush_interval)
+                self.flush()
+
+        start_background_task(_loop)
+
+    def flush(self):
+        if not self._queue:
+            return
+        lines = []
+        while self._queue:
+            ts, location, message, data = self._queue.popleft()
+            lines.append(json.dumps({'location': location, 'message': message, 'data': data, 'timestamp': ts},
+                                    ensure_ascii=False, default=str))
+        try:
+            self._rotate_if_needed()
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+        except OSError:
+            self.dropped += len(lines)
+
+    def _rotate_if_needed(self):
+        try:
+            if os.path.getsize(self.path) < self.max_bytes:
+                return
+        except OSError:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)